@@ -44,6 +44,12 @@ def remove_duplicates(bookmarks):
             unique_items.append(item)
     return unique_items
 
+def get_client_meta(meta):
+    """Visits live in the click table, the legacy history is not sent to the client"""
+    if isinstance(meta, dict) and 'visit_history' in meta:
+        return {key: value for key, value in meta.items() if key != 'visit_history'}
+    return meta
+
 def format_bookmarks(bookmarks, bookmark_type='default'):
     """Format bookmarks into serializable dictionary format
     """
@@ -54,7 +60,7 @@ def format_bookmarks(bookmarks, bookmark_type='default'):
             'url': bm['addr'],
             'folder': bm['path'],
             'is_deleted': bm['is_deleted'],
-            'meta': bm['meta']
+            'meta': get_client_meta(bm['meta'])
         } for bm in bookmarks]
 
     return [{
@@ -62,7 +68,7 @@ def format_bookmarks(bookmarks, bookmark_type='default'):
         'title': bookmark.title,
         'url': bookmark.addr,
         'created_at': bookmark.created_time,
-        'meta': bookmark.meta,
+        'meta': get_client_meta(bookmark.meta),
     } for bookmark in bookmarks]
 
 def save_bookmark_changes(bookmark, changed_fields):
@@ -0,0 +1,85 @@
+"""
+Bookmark click events
+
+Every visit is one row in BookmarkClick, the entry only keeps the clicks counter
+and the last visit time in meta, both updated by one UPDATE.
+meta["visit_history"] of older entries is moved into the table on their next click.
+The old click handler appended every visit twice, identical consecutive timestamps
+of the history count as one visit.
+"""
+
+from datetime import datetime
+from loguru import logger
+from django.db import connection, transaction
+
+from app_dataforge.models import StoreEntry, BookmarkClick
+
+
+def collapse_visit_history(visit_history):
+    """
+    Visits of a legacy visit_history without the duplicated consecutive entries
+    """
+    visits = []
+    for clicked_at in visit_history or []:
+        if len(visits) == 0 or visits[-1] != clicked_at:
+            visits.append(clicked_at)
+    return visits
+
+
+def get_legacy_clicks(bookmark):
+    clicks = []
+    for clicked_at in collapse_visit_history(bookmark.meta.get("visit_history")):
+        try:
+            clicks.append(BookmarkClick(
+                user_id=bookmark.user_id,
+                bookmark_id=bookmark.idx,
+                clicked_at=datetime.fromisoformat(clicked_at),
+            ))
+        except (TypeError, ValueError):
+            continue
+    return clicks
+
+
+def record_click(bookmark, clicked_at):
+    """
+    Insert the click event and count it on the entry, return (clicks, weight)
+    """
+    events = [BookmarkClick(user_id=bookmark.user_id, bookmark_id=bookmark.idx, clicked_at=clicked_at)]
+    legacy_count = None  # the clicks counter of a legacy entry counted the duplicates too
+    if isinstance(bookmark.meta, dict) and "visit_history" in bookmark.meta:
+        legacy_clicks = get_legacy_clicks(bookmark)
+        legacy_count = len(legacy_clicks)
+        events = legacy_clicks + events
+        logger.info(f"move {legacy_count} visits of {bookmark.idx} to the click table")
+
+    with transaction.atomic():
+        BookmarkClick.objects.bulk_create(events)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {StoreEntry._meta.db_table}
+                SET meta = jsonb_set(
+                    jsonb_set(
+                        COALESCE(meta, '{{}}'::jsonb) - 'visit_history',
+                        '{{clicks}}',
+                        to_jsonb((COALESCE(%s::numeric, (meta->>'clicks')::numeric, 0) + 1)::int)
+                    ),
+                    '{{last_visit}}',
+                    to_jsonb(%s::text)
+                )
+                WHERE idx = %s
+                RETURNING (meta->>'clicks')::int, (meta->>'weight')::float8
+                """,
+                [legacy_count, clicked_at.isoformat(), bookmark.idx],
+            )
+            row = cursor.fetchone()
+    return row if row is not None else (0, None)
+
+
+def load_click_times(user_id):
+    """
+    (bookmark_id, clicked_at) of all clicks of the user
+    """
+    return list(
+        BookmarkClick.objects.filter(user_id=user_id).values_list("bookmark_id", "clicked_at")
+    )
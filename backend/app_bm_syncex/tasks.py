@@ -1,65 +1,37 @@
-'''
 from celery import shared_task
+from loguru import logger
 from django.utils import timezone
-from .weight_utils import BookmarkWeightCalculator
-from app_dataforge.models import StoreEntry, BookmarkClick
-from ..app_bm_keeper.cache_manager import BookmarkCacheManager
+from app_dataforge.models import StoreEntry
+from .weight_utils import update_user_weights
 from .views import SOURCE
 
 @shared_task
 def update_all_bookmark_weights():
-    """定期更新所有书签权重的Celery任务"""
+    """定期更新所有书签权重的Celery任务，每个用户一次批量计算"""
     current_time = timezone.now()
-    bookmarks = StoreEntry.objects.filter(
+    user_ids = StoreEntry.objects.filter(
         source=SOURCE,
+        block_id=0,
         is_deleted=False
-    )
-    
+    ).values_list('user_id', flat=True).distinct()
+
     results = {
-        'total': bookmarks.count(),
+        'users': 0,
         'updated': 0,
         'errors': 0
     }
-    
-    for bookmark in bookmarks:
-        try:
-            calculator = BookmarkWeightCalculator(bookmark, current_time)
-            new_weight = calculator.calculate_total_weight()
-
-            bookmark.weight = new_weight
-            bookmark.save(update_fields=['weight'])
 
-            BookmarkCacheManager.set_weight(bookmark.id, new_weight)
-            
-            results['updated'] += 1
-            
+    for user_id in user_ids:
+        try:
+            results['updated'] += update_user_weights(user_id, current_time)
+            results['users'] += 1
         except Exception as e:
+            logger.warning(f"update bookmark weights {user_id} failed {e}")
             results['errors'] += 1
-            
-    return results
 
-def batch_update_weights(batch_size=100):
-    """批量更新书签权重"""
-    bookmarks = StoreEntry.objects.filter(
-        source=SOURCE,
-        is_deleted=False
-    )
-    
-    for i in range(0, bookmarks.count(), batch_size):
-        batch = bookmarks[i:i+batch_size]
-        update_bookmark_weights.delay([b.id for b in batch])
+    return results
 
 @shared_task
-def update_bookmark_weights(bookmark_ids):
-    """处理单个批次的更新"""
-    current_time = timezone.now()
-    for bookmark_id in bookmark_ids:
-        try:
-            bookmark = StoreEntry.objects.get(id=bookmark_id)
-            calculator = BookmarkWeightCalculator(bookmark, current_time)
-            bookmark.weight = calculator.calculate_total_weight()
-            bookmark.save(update_fields=['weight'])
-        except Exception as e:
-            continue
-            
-'''
\ No newline at end of file
+def update_bookmark_weights(user_id):
+    """更新单个用户的书签权重"""
+    return update_user_weights(user_id)
@@ -1,6 +1,6 @@
 import json
+import traceback
 from loguru import logger
-from datetime import datetime
 from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from knox.auth import TokenAuthentication
@@ -11,6 +11,7 @@ from django.utils import timezone
 from app_dataforge.entry import check_entry_exist, delete_entry
 from app_dataforge.misc_tools import add_url
 from app_dataforge.models import StoreEntry
+from .clicks import record_click
 
 SOURCE = "bookmark"
 
@@ -128,6 +129,7 @@ class BookmarkClickAPIView(APIView):
                 'user_id': args['user_id'],
                 'addr': url,
                 'source': SOURCE,
+                'block_id': 0,
                 'is_deleted': False
             }
             
@@ -142,42 +144,17 @@ class BookmarkClickAPIView(APIView):
                     'query_params': query_params
                 }, status=404)
             
-            if not isinstance(bookmark.meta, dict):
-                bookmark.meta = {}
-            
-            current_time = timezone.now().isoformat()
-            visit_record = current_time
-            
-            if 'visit_history' not in bookmark.meta:
-                bookmark.meta['visit_history'] = []
-            bookmark.meta['visit_history'].append(visit_record)
-            
-            if 'visit_history' not in bookmark.meta:
-                bookmark.meta['visit_history'] = []
-            bookmark.meta['visit_history'].append(visit_record)
-
-            clicks = len(bookmark.meta['visit_history'])
-            last_visit_time = datetime.fromisoformat(current_time)
-            age_in_days = (timezone.now() - bookmark.created_at).days
-            
-            frequency_weight = min(1.0, clicks / max(1, age_in_days)) * 0.5
-            recency_weight = min(1.0, 1 / max(1, (timezone.now() - last_visit_time).days)) * 0.3
-            base_weight = float(bookmark.meta.get('base_weight', 0.0)) * 0.2
-            
-            bookmark.meta['clicks'] = clicks
-            bookmark.meta['weight'] = frequency_weight + recency_weight + base_weight
-            bookmark.meta['last_visit'] = current_time
-            
-            bookmark.save()
-            logger.info(f"Successfully updated bookmark: {bookmark.title}, total clicks: {bookmark.meta['clicks']}")
+            clicked_at = timezone.now()
+            clicks, weight = record_click(bookmark, clicked_at)
+            logger.info(f"Successfully updated bookmark: {bookmark.title}, total clicks: {clicks}")
             
             return Response({
                 'status': 'success',
                 'data': {
                     'title': bookmark.title,
-                    'clicks': bookmark.meta['clicks'],
-                    'weight': bookmark.meta['weight'],
-                    'visit_record': visit_record
+                    'clicks': clicks,
+                    'weight': weight,
+                    'visit_record': clicked_at.isoformat()
                 }
             })
             
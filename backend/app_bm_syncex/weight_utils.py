@@ -1,116 +1,129 @@
-
+import numpy as np
+import pandas as pd
+from loguru import logger
+from django.db import connection
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Count
-import math
-
-class BookmarkWeightCalculator:
-    def __init__(self, bookmark, current_time=None):
-        self.bookmark = bookmark
-        self.current_time = current_time or timezone.now()
-        
-    def calculate_total_weight(self):
-        """计算书签的综合权重"""
-        weights = {
-            'freshness': self._calculate_freshness_weight(),
-            'clicks': self._calculate_clicks_weight(),
-            'recent_activity': self._calculate_recent_activity_weight(),
-            'continuous': self._calculate_continuous_clicks_weight()
-        }
-        
-        coefficients = {
-            'freshness': 0.3,       
-            'clicks': 0.3,           
-            'recent_activity': 0.2,  
-            'continuous': 0.2       
-        }
-
-        total_weight = sum(
-            weight * coefficients[factor] 
-            for factor, weight in weights.items()
+
+from app_dataforge.models import StoreEntry
+from .views import SOURCE
+from .clicks import load_click_times, collapse_visit_history
+
+WEIGHT_DB_BATCH_SIZE = 1000
+
+COEFFICIENTS = {
+    'freshness': 0.3,
+    'clicks': 0.3,
+    'recent_activity': 0.2,
+    'continuous': 0.2
+}
+
+# (天数, 权重)
+WINDOW_WEIGHTS = {
+    'day': (1, 0.5),
+    'week': (7, 0.3),
+    'month': (30, 0.2)
+}
+
+
+def load_bookmarks(user_id):
+    """取出用户全部书签的创建时间和点击记录，书签和点击各一次查询"""
+    rows = StoreEntry.objects.filter(
+        user_id=user_id,
+        source=SOURCE,
+        block_id=0,
+        is_deleted=False
+    ).values_list('idx', 'created_time', 'meta__visit_history')
+
+    bookmarks = []
+    legacy_clicks = []
+    for idx, created_time, visit_history in rows:
+        bookmarks.append((idx, created_time))
+        # 还没迁移到点击表的旧访问记录，旧代码每次访问记了两遍
+        if isinstance(visit_history, list):
+            legacy_clicks += [(idx, clicked_at) for clicked_at in collapse_visit_history(visit_history)]
+
+    bookmarks = pd.DataFrame(bookmarks, columns=['idx', 'created_time'])
+    bookmarks['created_time'] = pd.to_datetime(bookmarks['created_time'], utc=True)
+    bookmarks = bookmarks.set_index('idx')
+    clicks = pd.DataFrame(load_click_times(user_id), columns=['bookmark_id', 'clicked_at'])
+    clicks['clicked_at'] = pd.to_datetime(clicks['clicked_at'], utc=True)
+    if len(legacy_clicks) > 0:
+        legacy_clicks = pd.DataFrame(legacy_clicks, columns=['bookmark_id', 'clicked_at'])
+        legacy_clicks['clicked_at'] = pd.to_datetime(
+            legacy_clicks['clicked_at'], utc=True, errors='coerce', format='ISO8601'
         )
-        
-        return round(total_weight, 3)
-    
-    def _calculate_freshness_weight(self):
-        """计算新鲜度权重，考虑创建时间和最后点击时间"""
-        days_since_creation = (self.current_time - self.bookmark.created_time).days
-        
-        last_click = (BookmarkClick.objects.filter(bookmark=self.bookmark)
-                     .order_by('-meta__clicked_at')
-                     .first())
-        
-        if last_click:
-            last_click_time = timezone.datetime.fromisoformat(
-                last_click.meta['clicked_at']
+        clicks = pd.concat([clicks, legacy_clicks], ignore_index=True)
+    return bookmarks, clicks.dropna()
+
+
+def compute_weights(bookmarks, clicks, current_time=None):
+    """按书签分组一次算出全部书签的综合权重，返回以书签 idx 为索引的 Series"""
+    now = pd.Timestamp(current_time or timezone.now())
+    if now.tzinfo is None:
+        now = now.tz_localize('UTC')
+    index = bookmarks.index
+    by_bookmark = clicks.groupby('bookmark_id')['clicked_at']
+
+    # 新鲜度：创建时间和最后点击时间
+    days_since_creation = (now - bookmarks['created_time']).dt.days.clip(lower=0)
+    last_click = by_bookmark.max().reindex(index)
+    days_since_last_click = (now - last_click).dt.days.clip(lower=0).fillna(days_since_creation)
+    creation_weight = 1.0 / (1 + np.log1p(days_since_creation / 30))
+    last_click_weight = 1.0 / (1 + np.log1p(days_since_last_click / 7))
+    freshness = creation_weight * 0.4 + last_click_weight * 0.6
+
+    # 点击总量
+    total_clicks = by_bookmark.size().reindex(index, fill_value=0)
+    clicks_weight = np.log1p(total_clicks)
+
+    # 近期活跃度
+    activity_score = pd.Series(0.0, index=index)
+    for days, weight in WINDOW_WEIGHTS.values():
+        recent = clicks[clicks['clicked_at'] >= now - pd.Timedelta(days=days)]
+        activity_score += recent.groupby('bookmark_id').size().reindex(index, fill_value=0) * weight
+    recent_activity = np.log1p(activity_score)
+
+    # 连续点击：24 小时内相邻点击间隔不超过 1 小时记 1 分，不超过 4 小时记 0.5 分
+    recent = clicks[clicks['clicked_at'] >= now - pd.Timedelta(hours=24)]
+    recent = recent.sort_values(['bookmark_id', 'clicked_at'])
+    hours = recent.groupby('bookmark_id')['clicked_at'].diff().dt.total_seconds() / 3600
+    scores = np.select([hours <= 1, hours <= 4], [1.0, 0.5], default=0.0)
+    continuous_score = pd.Series(scores, index=recent.index).groupby(recent['bookmark_id']).sum()
+    continuous = np.log1p(continuous_score.reindex(index, fill_value=0))
+
+    total_weight = (
+        freshness * COEFFICIENTS['freshness']
+        + clicks_weight * COEFFICIENTS['clicks']
+        + recent_activity * COEFFICIENTS['recent_activity']
+        + continuous * COEFFICIENTS['continuous']
+    )
+    return total_weight.round(3)
+
+
+def save_weights(weights):
+    """把权重写入 meta['weight']，每批一条 UPDATE，只改 weight 一个键"""
+    items = list(weights.items())
+    with connection.cursor() as cursor:
+        for i in range(0, len(items), WEIGHT_DB_BATCH_SIZE):
+            batch = items[i:i + WEIGHT_DB_BATCH_SIZE]
+            cursor.execute(
+                f"""
+                UPDATE {StoreEntry._meta.db_table} AS entry
+                SET meta = jsonb_set(COALESCE(entry.meta, '{{}}'::jsonb), '{{weight}}', to_jsonb(data.weight))
+                FROM unnest(%s::uuid[], %s::float8[]) AS data(idx, weight)
+                WHERE entry.idx = data.idx
+                """,
+                [[str(idx) for idx, _weight in batch], [float(weight) for _idx, weight in batch]],
             )
-            days_since_last_click = (self.current_time - last_click_time).days
-        else:
-            days_since_last_click = days_since_creation
-            
-        creation_weight = 1.0 / (1 + math.log1p(days_since_creation/30))
-        last_click_weight = 1.0 / (1 + math.log1p(days_since_last_click/7))
-        
-        return (creation_weight * 0.4 + last_click_weight * 0.6)
-    
-    def _calculate_clicks_weight(self):
-        """计算点击总量权重"""
-        total_clicks = BookmarkClick.objects.filter(
-            bookmark=self.bookmark
-        ).count()
-        
-
-        return math.log1p(total_clicks)
-    
-    def _calculate_recent_activity_weight(self):
-        """计算近期活跃度权重"""
-        time_windows = {
-            'day': self.current_time - timedelta(days=1),
-            'week': self.current_time - timedelta(days=7),
-            'month': self.current_time - timedelta(days=30)
-        }
-        
-        click_counts = {}
-        for period, start_time in time_windows.items():
-            click_counts[period] = BookmarkClick.objects.filter(
-                bookmark=self.bookmark,
-                meta__clicked_at__gte=start_time.isoformat()
-            ).count()
-        
-        window_weights = {
-            'day': 0.5,
-            'week': 0.3,
-            'month': 0.2
-        }
-        
-        activity_score = sum(
-            count * window_weights[period] 
-            for period, count in click_counts.items()
-        )
-        
-        return math.log1p(activity_score)
-    
-    def _calculate_continuous_clicks_weight(self):
-        """计算连续点击权重"""
-        recent_clicks = BookmarkClick.objects.filter(
-            bookmark=self.bookmark,
-            meta__clicked_at__gte=(self.current_time - timedelta(hours=24)).isoformat()
-        ).order_by('meta__clicked_at')
-        
-        if not recent_clicks:
-            return 0
-            
-        click_times = [
-            timezone.datetime.fromisoformat(click.meta['clicked_at']) 
-            for click in recent_clicks
-        ]
-        
-        continuous_score = 0
-        for i in range(1, len(click_times)):
-            time_diff = (click_times[i] - click_times[i-1]).total_seconds() / 3600  # 转换为小时
-            if time_diff <= 1:  
-                continuous_score += 1.0
-            elif time_diff <= 4:  
-                continuous_score += 0.5
-                
-        return math.log1p(continuous_score)
\ No newline at end of file
+    return len(items)
+
+
+def update_user_weights(user_id, current_time=None):
+    """重新计算一个用户全部书签的权重"""
+    bookmarks, clicks = load_bookmarks(user_id)
+    if len(bookmarks) == 0:
+        return 0
+    weights = compute_weights(bookmarks, clicks, current_time)
+    count = save_weights(weights)
+    logger.info(f"update bookmark weights {user_id}, {count} bookmarks, {len(clicks)} clicks")
+    return count
@@ -0,0 +1,218 @@
+"""
+Conversion artifacts cached next to the source files in the FileManager backend
+
+The front matter, markdown content and chunk list of a converted file are stored as
+.artifacts/<md5>_<converter version>_<chunk size>[_ocr].json of the user.
+A refresh or import of an unchanged source reuses them instead of downloading,
+converting and splitting again, a converter upgrade changes the key.
+md and txt sources are parsed directly and never cached. Artifacts of a source no
+entry of the user refers to any more are deleted, see release.
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from loguru import logger
+
+from backend.common.files import utils_filemanager, filecache
+from backend.common.llm.embedding import embedding_manager, EMBEDDING_CHUNK_SIZE
+from backend.common.parser import converter, utils_md
+from backend.common.parser.conversion_service import ConversionService
+from backend.common.parser.md_parser import MarkdownParser
+from backend.common.utils.file_tools import is_plain_text
+from .models import StoreEntry
+
+REL_DIR_ARTIFACTS = ".artifacts"
+ARTIFACT_MEMORY_SIZE = 32
+
+
+class ConversionArtifact:
+    def __init__(self, md5, meta=None, content=None, chunks=None):
+        self.md5 = md5
+        self.meta = meta or {}
+        self.content = content
+        self.chunks = chunks or []
+
+    def to_dict(self):
+        return {
+            "md5": self.md5,
+            "version": converter.CONVERTER_VERSION,
+            "meta": self.meta,
+            "content": self.content,
+            "chunks": self.chunks,
+        }
+
+    @staticmethod
+    def from_dict(dic):
+        return ConversionArtifact(
+            dic.get("md5"), dic.get("meta"), dic.get("content"), dic.get("chunks")
+        )
+
+    def save_markdown(self, path):
+        """
+        Write the converted markdown with its front matter, as converter.convert does
+        """
+        with open(path, "w", errors="ignore") as fp:
+            if self.meta:
+                utils_md.write_front_matter(fp, self.meta)
+            fp.write(self.content or "")
+
+
+class ConversionArtifactCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if ConversionArtifactCache.__instance is None:
+            ConversionArtifactCache()
+        return ConversionArtifactCache.__instance
+
+    def __init__(self):
+        if ConversionArtifactCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            ConversionArtifactCache.__instance = self
+            self.memory = OrderedDict()  # (user_id, artifact path) -> ConversionArtifact
+            self.lock = threading.Lock()
+
+    @staticmethod
+    def get_artifact_path(md5, use_ocr=False):
+        name = f"{md5}_{converter.CONVERTER_VERSION}_{EMBEDDING_CHUNK_SIZE}"
+        if use_ocr:
+            name += "_ocr"
+        return os.path.join(REL_DIR_ARTIFACTS, f"{name}.json")
+
+    def _remember(self, key, artifact):
+        with self.lock:
+            self.memory[key] = artifact
+            self.memory.move_to_end(key)
+            while len(self.memory) > ARTIFACT_MEMORY_SIZE:
+                self.memory.popitem(last=False)
+
+    def get(self, user_id, md5, use_ocr=False):
+        """
+        Return the artifact of the source with this md5, None if it was never converted
+        """
+        if not md5:
+            return None
+        key = (user_id, self.get_artifact_path(md5, use_ocr))
+        with self.lock:
+            artifact = self.memory.get(key)
+            if artifact is not None:
+                self.memory.move_to_end(key)
+                return artifact
+
+        tmp_path = filecache.get_tmpfile(".json")
+        try:
+            if not utils_filemanager.get_file_manager().get_file(user_id, key[1], tmp_path):
+                return None
+            with open(tmp_path, "r") as fp:
+                dic = json.load(fp)
+            if dic.get("version") != converter.CONVERTER_VERSION or dic.get("md5") != md5:
+                return None
+            artifact = ConversionArtifact.from_dict(dic)
+            self._remember(key, artifact)
+            return artifact
+        except Exception as e:
+            logger.warning(f"load conversion artifact {key} failed {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put(self, user_id, artifact, use_ocr=False):
+        key = (user_id, self.get_artifact_path(artifact.md5, use_ocr))
+        self._remember(key, artifact)
+        tmp_path = filecache.get_tmpfile(".json")
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(artifact.to_dict(), fp, ensure_ascii=False, default=str)
+            utils_filemanager.get_file_manager().save_file(user_id, key[1], tmp_path)
+        except Exception as e:
+            logger.warning(f"save conversion artifact {key} failed {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_release_paths(self, user_id, md5s):
+        """
+        Artifact paths of the md5s no remaining entry of the user refers to,
+        they are dropped from memory, the caller deletes the files
+        """
+        md5s = set(md5 for md5 in md5s if md5)
+        if len(md5s) == 0:
+            return []
+        used = set(
+            StoreEntry.objects.filter(
+                user_id=user_id, md5__in=md5s, block_id=0, is_deleted=False
+            ).values_list("md5", flat=True)
+        )
+        paths = []
+        for md5 in md5s - used:
+            for use_ocr in (False, True):
+                path = self.get_artifact_path(md5, use_ocr)
+                with self.lock:
+                    self.memory.pop((user_id, path), None)
+                paths.append(path)
+        return paths
+
+    def release(self, user_id, md5s):
+        """
+        Delete the artifacts of sources that were deleted or replaced
+        """
+        file_manager = utils_filemanager.get_file_manager()
+        for path in self.get_release_paths(user_id, md5s):
+            file_manager.delete_file(user_id, path)
+
+    @staticmethod
+    def read_plain(path, md5=None):
+        """
+        md and txt need no conversion, reading them is cheaper than the cache
+        """
+        meta_data = {}
+        if converter.is_markdown(path):
+            parser = MarkdownParser(path)
+            meta_data = parser.fm
+            content = parser.content
+        else:
+            content = open(path, "r").read()
+        chunks = (embedding_manager.split(content) or [content]) if content else []
+        return ConversionArtifact(md5, meta_data, content, chunks)
+
+    def convert(self, path, user, md5=None, use_ocr=None, debug=False):
+        """
+        Return the artifact of a local source file, from the cache when the md5 is known,
+        otherwise convert, parse and split it and store the result
+        """
+        if is_plain_text(path):
+            return self.read_plain(path, md5)
+        if use_ocr is None:
+            use_ocr = user.privilege.b_ocr
+        if md5 is None:
+            md5 = utils_md.get_file_md5(path)
+        artifact = self.get(user.user_id, md5, use_ocr)
+        if artifact is not None:
+            if debug:
+                logger.info(f"conversion artifact hit {path} {md5}")
+            return artifact
+
+        meta_data = {}
+        content = None
+        ret_convert = False
+        if converter.is_support(path):
+            # a conversion submitted earlier for this file (e.g. while unzipping) is reused
+            service = ConversionService.get_instance()
+            ret_convert, md_path = service.wait(service.submit(path, use_ocr=use_ocr))
+        if debug:
+            logger.info("after convert")
+        if ret_convert:
+            parser = MarkdownParser(md_path)
+            meta_data = parser.fm
+            content = parser.content
+
+        chunks = (embedding_manager.split(content) or [content]) if content else []
+        artifact = ConversionArtifact(md5, meta_data, content, chunks)
+        if content is not None:
+            self.put(user.user_id, artifact, use_ocr)
+        return artifact
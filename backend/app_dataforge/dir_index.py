@@ -0,0 +1,126 @@
+"""
+Materialized directory index of note and file addrs
+
+store_directory holds one row per directory with the number of entries below it,
+writes mark the directories above the changed addrs dirty and a dirty row is
+recounted with one indexed query when it is read. The file tree asks for the
+directories at one depth instead of splitting every addr of the vault, and the
+entries down to a depth with the indexed addr_depth column of store_entry.
+"""
+
+from collections import Counter
+from loguru import logger
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import StoreEntry, StoreDirectory
+from .sync_manifest import get_ancestors
+
+INDEXED_ETYPES = ["note", "file"]
+
+
+def get_live_entries(uid, etype):
+    return StoreEntry.objects.filter(user_id=uid, etype=etype, block_id=0, is_deleted=False)
+
+
+def get_max_depth(path, depth):
+    """
+    Most "/" in the addrs below path at most depth levels down, compared with the
+    indexed addr_depth of the entries
+    """
+    return max(path.count("/") + depth - 1, 0)
+
+
+class DirectoryIndex:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if DirectoryIndex.__instance is None:
+            DirectoryIndex()
+        return DirectoryIndex.__instance
+
+    def __init__(self):
+        if DirectoryIndex.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            DirectoryIndex.__instance = self
+
+    def mark_dirty(self, uid, etype, addrs):
+        """
+        Called after entries were created, moved or deleted
+        """
+        if etype not in INDEXED_ETYPES:
+            return
+        paths = set()
+        for addr in addrs:
+            if addr:
+                paths.update(get_ancestors(addr))
+        if len(paths) == 0 or not StoreDirectory.objects.filter(user_id=uid, etype=etype, path="").exists():
+            return  # the index is built on the first read
+        table = StoreDirectory._meta.db_table
+        try:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f"INSERT INTO {table} (user_id, etype, path, depth, count, dirty, updated_time) "
+                    f"VALUES (%s, %s, %s, %s, 0, TRUE, clock_timestamp()) "
+                    f"ON CONFLICT (user_id, etype, path) DO UPDATE SET dirty = TRUE, updated_time = clock_timestamp()",
+                    [(uid, etype, path, path.count("/")) for path in paths],
+                )
+        except Exception as e:
+            logger.warning(f"mark directories dirty failed {e}")
+
+    def rebuild(self, uid, etype):
+        counts = Counter()
+        for addr in get_live_entries(uid, etype).values_list("addr", flat=True):
+            if addr:
+                counts.update(get_ancestors(addr))
+        counts[""] += 0
+        rows = [
+            StoreDirectory(user_id=uid, etype=etype, path=path, depth=path.count("/"), count=count, dirty=False)
+            for path, count in counts.items()
+        ]
+        with transaction.atomic():
+            StoreDirectory.objects.filter(user_id=uid, etype=etype).delete()
+            StoreDirectory.objects.bulk_create(rows, batch_size=1000)
+        logger.info(f"rebuild directory index {uid} {etype}, dirs {len(rows)}")
+
+    def _prepare(self, uid, etype, query):
+        """
+        Build the index on first use and recount the dirty directories of the query
+        """
+        if not StoreDirectory.objects.filter(user_id=uid, etype=etype, path="").exists():
+            self.rebuild(uid, etype)
+            return
+        for item in query.filter(dirty=True):
+            count = get_live_entries(uid, etype).filter(addr__startswith=item.path).count()
+            # mark_dirty moves updated_time to clock_timestamp(), a directory marked again
+            # since it was read takes the count but stays dirty for the next read
+            updated = StoreDirectory.objects.filter(pk=item.pk, updated_time=item.updated_time).update(
+                count=count, dirty=False, updated_time=timezone.now()
+            )
+            if updated == 0:
+                StoreDirectory.objects.filter(pk=item.pk).update(count=count)
+
+    def get_dirs(self, uid, etype, path="", depth=None):
+        """
+        Directories below path that hold entries, all of them or those depth levels down,
+        path is "" or ends with "/", returned paths end with "/"
+        """
+        query = StoreDirectory.objects.filter(user_id=uid, etype=etype, path__startswith=path).exclude(path=path)
+        if depth is not None:
+            query = query.filter(depth=path.count("/") + depth)
+        self._prepare(uid, etype, query)
+        return list(query.filter(count__gt=0).order_by("path").values_list("path", flat=True))
+
+    @staticmethod
+    def get_entries(uid, etype, path="", depth=None):
+        """
+        Entries below path at most depth levels down, as the queryset of the file tree
+        """
+        query = get_live_entries(uid, etype)
+        if path != "":
+            query = query.filter(addr__startswith=path)
+        if depth is not None:
+            query = query.filter(addr_depth__lte=get_max_depth(path, depth))
+        return query
@@ -0,0 +1,206 @@
+"""
+ANN index management for StoreEntry.embeddings
+
+embeddings is a VectorField without dimensions, so one HNSW index over the column is not
+possible. Each emb_model gets a partial expression index on embeddings::vector(dim),
+queries that use the same cast expression and emb_model filter can be served by it.
+The index is shared by all users, the user filter is applied while scanning it, so the
+index is only used with hnsw.iterative_scan (pgvector >= 0.8), otherwise a user with
+few vectors could get no rows back. Older pgvector versions fall back to an exact scan.
+"""
+
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+from loguru import logger
+from django.db import connection, transaction
+from django.db.models.functions import Cast
+from pgvector.django import VectorField, CosineDistance
+
+from .models import StoreEntry
+
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+EF_SEARCH_MIN = 40
+EF_SEARCH_MAX = 1000
+INDEX_CHECK_INTERVAL = 300
+ITERATIVE_SCAN_VERSION = (0, 8)
+
+
+class EmbeddingIndexManager:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if EmbeddingIndexManager.__instance is None:
+            EmbeddingIndexManager()
+        return EmbeddingIndexManager.__instance
+
+    def __init__(self):
+        if EmbeddingIndexManager.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            EmbeddingIndexManager.__instance = self
+            self.indexes = {}  # emb_model -> dimension of a ready index
+            self.missing = {}  # (emb_model, dimension) -> time of the last failed check
+            self.building = set()
+            self.iterative_scan = None  # pgvector supports hnsw.iterative_scan, checked once
+            self.lock = threading.Lock()
+
+    @staticmethod
+    def get_index_name(emb_model, dimension):
+        digest = hashlib.md5(f"{emb_model}_{dimension}".encode()).hexdigest()[:12]
+        return f"{StoreEntry._meta.db_table}_hnsw_{digest}"
+
+    def supports_iterative_scan(self):
+        if self.iterative_scan is None:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+                    row = cursor.fetchone()
+                version = tuple(int(part) for part in row[0].split(".")[:2]) if row else (0, 0)
+                self.iterative_scan = version >= ITERATIVE_SCAN_VERSION
+            except Exception as e:
+                logger.warning(f"check pgvector version failed {e}")
+                return False
+            if not self.iterative_scan:
+                logger.warning("pgvector < 0.8 has no iterative index scans, vector search scans exactly")
+        return self.iterative_scan
+
+    @staticmethod
+    def get_index_state(index_name):
+        """
+        Return None when the index does not exist, otherwise whether it is valid
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT x.indisvalid FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid "
+                "WHERE c.relname = %s",
+                [index_name],
+            )
+            row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def has_index(self, emb_model, dimension):
+        if self.indexes.get(emb_model) == dimension:
+            return True
+        checked_time = self.missing.get((emb_model, dimension))
+        if checked_time is not None and time.time() - checked_time < INDEX_CHECK_INTERVAL:
+            return False
+        index_name = self.get_index_name(emb_model, dimension)
+        try:
+            exists = self.get_index_state(index_name) is True
+        except Exception as e:
+            logger.warning(f"check embedding index failed {e}")
+            return False
+        with self.lock:
+            if exists:
+                self.indexes[emb_model] = dimension
+                self.missing.pop((emb_model, dimension), None)
+            else:
+                self.missing[(emb_model, dimension)] = time.time()
+        return exists
+
+    def build_index(self, emb_model, dimension):
+        """
+        Build the HNSW index for one emb_model, CONCURRENTLY so writes are not blocked,
+        an invalid index left by a failed build is dropped first
+        """
+        index_name = self.get_index_name(emb_model, dimension)
+        table = StoreEntry._meta.db_table
+        sql = (
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table} "
+            f"USING hnsw ((embeddings::vector({int(dimension)})) vector_cosine_ops) "
+            f"WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}) "
+            f"WHERE emb_model = %s"
+        )
+        try:
+            logger.info(f"build embedding index {index_name} for {emb_model} dim {dimension}")
+            if self.get_index_state(index_name) is False:
+                logger.warning(f"drop invalid embedding index {index_name}")
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [emb_model])
+            if self.get_index_state(index_name) is not True:
+                raise Exception("index is not valid after the build")
+            with self.lock:
+                self.indexes[emb_model] = dimension
+                self.missing.pop((emb_model, dimension), None)
+            return True
+        except Exception as e:
+            logger.warning(f"build embedding index {index_name} failed {e}")
+            return False
+        finally:
+            with self.lock:
+                self.building.discard(emb_model)
+            connection.close()
+
+    def ensure_index(self, emb_model, dimension):
+        """
+        Called after embeddings are written, the build runs in a background thread
+        """
+        if emb_model is None or dimension is None or dimension <= 0:
+            return
+        if self.indexes.get(emb_model) == dimension:
+            return
+        with self.lock:
+            if emb_model in self.building:
+                return
+            self.building.add(emb_model)
+        if self.has_index(emb_model, dimension):
+            with self.lock:
+                self.building.discard(emb_model)
+            return
+        thread = threading.Thread(
+            target=self.build_index, args=(emb_model, dimension), daemon=True
+        )
+        thread.start()
+
+    def drop_index(self, emb_model, dimension):
+        index_name = self.get_index_name(emb_model, dimension)
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}")
+        with self.lock:
+            self.indexes.pop(emb_model, None)
+
+    @staticmethod
+    def get_ef_search(limit):
+        """
+        ef_search must be at least the number of rows wanted from the index scan
+        """
+        return min(max(limit * 2, EF_SEARCH_MIN), EF_SEARCH_MAX)
+
+    @staticmethod
+    @contextmanager
+    def search_scope(ef_search):
+        """
+        Run the queries inside with SET LOCAL ef_search, the iterative scan keeps reading
+        the index until enough rows pass the user filter, strict_order keeps the rows in
+        distance order. The settings end with the transaction, so they never stay on a
+        persistent connection
+        """
+        if ef_search is None:
+            yield
+            return
+        with transaction.atomic():
+            try:
+                with transaction.atomic(), connection.cursor() as cursor:
+                    cursor.execute("SELECT set_config('hnsw.ef_search', %s, true)", [str(ef_search)])
+                    cursor.execute("SELECT set_config('hnsw.iterative_scan', 'strict_order', true)")
+            except Exception as e:
+                logger.warning(f"set ef_search failed {e}")
+            yield
+
+    def get_distance(self, emb_model, query_vector):
+        """
+        Return the distance expression, the indexed cast when an index for this model exists,
+        otherwise the plain column for an exact scan
+        """
+        dimension = len(query_vector)
+        if self.supports_iterative_scan() and self.has_index(emb_model, dimension):
+            return CosineDistance(
+                Cast("embeddings", output_field=VectorField(dimensions=dimension)), query_vector
+            ), True
+        return CosineDistance("embeddings", query_vector), False
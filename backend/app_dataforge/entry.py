@@ -9,18 +9,19 @@ import re
 from typing import Any
 from loguru import logger
 from django.utils import timezone
-from django.db.models import Q, Case, When
+from django.db.models import Q, F, Window
+from django.db.models.functions import RowNumber
 from django.contrib.postgres.search import TrigramSimilarity
 from django.http import HttpResponse
 from django.utils.translation import gettext as _
-from pgvector.django import CosineDistance
+from django.db import connection
 from django.db.models.query import QuerySet
 
 from backend.common.llm.embedding import embedding_manager
-from backend.common.files import utils_filemanager, filecache
+from backend.common.llm.embedding_service import EMBEDDING_TIMEOUT
+from backend.common.files import utils_filemanager
 from backend.common.parser import converter, utils_md
 from backend.common.parser.md_parser import MarkdownParser
-from backend.common.utils.file_tools import is_plain_text, convert_to_md
 from backend.common.utils.regular_tools import regular_keyword
 from backend.common.utils.web_tools import get_url_content
 from backend.common.user.user import UserManager
@@ -29,10 +30,15 @@ from .models import StoreEntry
 from .feature import EntryFeatureTool, DEFAULT_CATEGORY
 from .entry_item import EntryItem
 from .entry_storage import EntryStorage
+from .embedding_index import EmbeddingIndexManager
+from .conversion_cache import ConversionArtifactCache
 
 REL_DIR_FILES = "files"
 REL_DIR_NOTES = "notes"
 DESC_LENGTH = 50
+RRF_K = 60  # reciprocal rank fusion constant, score = sum(1 / (RRF_K + rank))
+VECTOR_CANDIDATE_FACTOR = 4
+VECTOR_MAX_CANDIDATES = 1000
 # Get PARSE_CONTENT from backend env settings
 
 
@@ -41,6 +47,93 @@ class EmbeddingNotAvailableError(Exception):
     pass
 
 
+class HybridQuerySet:
+    """
+    Fused rows of the hybrid search as dicts of fields. count() and slices run in SQL,
+    so a page of the list view only fetches and builds its own rows
+    """
+    ordered = True
+
+    def __init__(self, ctes, params, fields, offset=0, limit=-1, ef_search=None):
+        self.ctes = ctes
+        self.params = params
+        self.fields = fields
+        self.offset = offset
+        self.limit = limit  # -1: no limit
+        self.ef_search = ef_search  # set locally for the statement when the hnsw index is used
+        self._count = None
+        self._rows = None
+
+    def count(self):
+        if self._rows is not None:
+            return len(self._rows)
+        if self._count is None:
+            rows = self._execute(f"{self.ctes} SELECT COUNT(*) FROM best", self.params)
+            count = max(rows[0][0] - self.offset, 0)
+            self._count = min(count, self.limit) if self.limit >= 0 else count
+        return self._count
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start = k.start or 0
+            if k.step is not None or start < 0 or (k.stop is not None and k.stop < 0):
+                raise ValueError("only positive slices without step are supported")
+            limit = max(self.limit - start, 0) if self.limit >= 0 else -1
+            if k.stop is not None:
+                stop_limit = max(k.stop - start, 0)
+                limit = stop_limit if limit < 0 else min(limit, stop_limit)
+            return HybridQuerySet(self.ctes, self.params, self.fields, self.offset + start, limit,
+                                  self.ef_search)
+        rows = list(self[k:k + 1])
+        if len(rows) == 0:
+            raise IndexError("hybrid search index out of range")
+        return rows[0]
+
+    def _fetch(self):
+        if self._rows is not None:
+            return self._rows
+        if self.limit == 0:
+            self._rows = []
+            return self._rows
+        columns = [StoreEntry._meta.get_field(name) for name in self.fields]
+        sql = (
+            f"{self.ctes} SELECT {', '.join('e.' + field.column for field in columns)} "
+            f"FROM {StoreEntry._meta.db_table} e JOIN best ON e.idx = best.idx "
+            f"ORDER BY best.score DESC, e.updated_time DESC"
+        )
+        params = list(self.params)
+        if self.limit > 0:
+            sql += " LIMIT %s"
+            params.append(self.limit)
+        if self.offset > 0:
+            sql += " OFFSET %s"
+            params.append(self.offset)
+        rows = self._execute(sql, params)
+        self._rows = []
+        for row in rows:
+            item = {}
+            for field, value in zip(columns, row):
+                if hasattr(field, "from_db_value"):
+                    value = field.from_db_value(value, None, connection)
+                item[field.name] = value
+            self._rows.append(item)
+        return self._rows
+
+    def _execute(self, sql, params):
+        with EmbeddingIndexManager.search_scope(self.ef_search), connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __len__(self):
+        return len(self._fetch())
+
+    def __bool__(self):
+        return len(self) > 0
+
+
 class EntryService:
     @staticmethod
     def _apply_meta_to_entry(entry: EntryItem, meta_dic: dict = None):
@@ -98,6 +191,9 @@ class EntryService:
             EntryFeatureTool.get_instance().parse(entry, data['reduce_msg'], use_llm=use_llm)
         if entry.title is None and data is not None and 'default_title' in data:
             entry.title = data['default_title']
+        if data is not None and 'append_content' in data:
+            # chat messages are appended, only the new ones become blocks
+            return EntryStorage.append_entry(entry, data['append_content'], debug=debug)
         content = None
         if data is not None and 'content' in data:
             content = data['content']
@@ -144,12 +240,19 @@ class EntryService:
         else:
             entry.path = os.path.join(REL_DIR_FILES, entry.addr)
             
-        if data is not None and "path" in data:
+        artifact = None
+        if isinstance(data, dict) and data.get("artifact") is not None:
+            # the stored source is unchanged, its cached conversion is used
+            artifact = data["artifact"]
+            path = None
+        elif data is not None and "path" in data:
             path = data["path"]
         else:
             path = data
 
-        if path is None:
+        if artifact is not None:
+            has_new_content = True
+        elif path is None:
             has_new_content = False
             if entry.idx is None:
                 return False, False, _("save_file_failed_excl_")
@@ -161,7 +264,7 @@ class EntryService:
             if not ret:
                 return False, False, _("save_file_failed_excl_")
 
-        if has_new_content and entry.md5 is None:
+        if path is not None and entry.md5 is None:
             entry.md5 = utils_md.get_file_md5(path)
 
         need_feature_extraction = _should_extract_features(entry, user)
@@ -169,11 +272,18 @@ class EntryService:
             logger.info(f"need_feature_extraction {need_feature_extraction}")
         meta_dic = {}
         content = None
+        chunks = None
         if has_new_content:
-            if (entry.etype == "note" and user.get("note_save_content")) or (
+            save_content = (entry.etype == "note" and user.get("note_save_content")) or (
                 entry.etype == "file" and user.get("file_save_content")
-            ):
-                meta_dic, content = get_file_content_by_path(path, user)
+            )
+            if save_content and artifact is None:
+                artifact = ConversionArtifactCache.get_instance().convert(path, user, debug=debug)
+            if artifact is not None:
+                meta_dic = artifact.meta
+                if save_content:
+                    content = artifact.content
+                    chunks = artifact.chunks
             elif converter.is_markdown(path):
                 parser = MarkdownParser(path)
                 meta_dic = parser.fm
@@ -191,7 +301,7 @@ class EntryService:
                     entry, content, use_llm=use_llm
                 )
         
-        return EntryStorage.save_entry(entry, content, has_new_content, debug=debug)
+        return EntryStorage.save_entry(entry, content, has_new_content, chunks=chunks, debug=debug)
 
 
     @staticmethod
@@ -286,17 +396,39 @@ def regerate_embedding(uid, addr, emb_model):
     Regenerate the embedding for the specified user and address
     call from app_sync
     """
-    entries = StoreEntry.objects.filter(user_id=uid, addr=addr)
-    if len(entries) == 0 or not embedding_manager.use_embedding(uid):
-        return False
-    all_splits = [entry.raw for entry in entries]
-    ret_emb, embeddings = embedding_manager.do_embedding(uid, all_splits)
-    if ret_emb:
-        for entry, embedding in zip(entries, embeddings):
-            entry.embeddings = embedding
+    return regerate_embeddings(uid, [addr], emb_model)[addr]
+
+
+def regerate_embeddings(uid, addrs, emb_model):
+    """
+    Regenerate the embeddings of many addresses, all blocks are queued on the
+    embedding service at once and written back with bulk_update
+    return {addr: bool}
+    """
+    result = {addr: False for addr in addrs}
+    if len(addrs) == 0 or not embedding_manager.use_embedding(uid):
+        return result
+    entries = list(StoreEntry.objects.filter(user_id=uid, addr__in=addrs).exclude(raw__isnull=True))
+    futures = embedding_manager.submit_embedding(uid, [entry.raw for entry in entries])
+    if futures is None:
+        return result
+
+    updated = []
+    failed_addrs = set()
+    for entry, future in zip(entries, futures):
+        try:
+            entry.embeddings = future.result(timeout=EMBEDDING_TIMEOUT)
             entry.emb_model = emb_model
-            entry.save()
-    return True
+            updated.append(entry)
+        except Exception as e:
+            logger.warning(f"regerate embedding failed {entry.addr} {e}")
+            failed_addrs.add(entry.addr)
+    StoreEntry.objects.bulk_update(updated, ["embeddings", "emb_model"], batch_size=500)
+    for entry in entries:
+        result[entry.addr] = entry.addr not in failed_addrs
+    if len(updated) > 0:
+        EmbeddingIndexManager.get_instance().ensure_index(emb_model, len(updated[0].embeddings))
+    return result
 
 
 def get_path_by_title(uid, title):
@@ -379,36 +511,33 @@ class EntrySearchBuilder:
                 .values(*fields))
 
     @staticmethod
-    def build_embedding_query(keywords, query_args, fields):
+    def build_embedding_query(keywords, query_args, fields, limit=-1):
+        """
+        return (queryset, ef_search), ef_search is None without an index, the query must be
+        evaluated inside EmbeddingIndexManager.search_scope(ef_search)
+        """
         ret, query_vector = embedding_manager.do_embedding(query_args['user_id'], [keywords])
         if not ret or query_vector is None:
-            return None
+            return None, None
         
         current_model_name = embedding_manager.get_model_name(query_args['user_id'])
         if current_model_name is None:
-            return None
+            return None, None
         
         query_args_emb = query_args.copy()
         #query_args_emb["block_id"] = 0
         query_args_emb['embeddings__isnull'] = False
         query_args_emb['emb_model'] = current_model_name
-        
-        """
-        queryset_with_similarity = StoreEntry.objects.filter(**query_args_emb).annotate(
-            similarity=1 - CosineDistance('embeddings', query_vector[0])
-        ).filter(
-            similarity__gt=0.7
-        ).order_by('-similarity').values(*fields, 'similarity')
-        
-        logger.info(f"Embedding search results for keywords '{keywords}':")
-        for entry in queryset_with_similarity:
-            logger.info(f"  Entry {entry.get('idx', 'N/A')}: {entry.get('title', 'N/A')} - Similarity: {entry['similarity']:.4f}")
-        """
+
+        # the hnsw index of this model serves ORDER BY distance LIMIT, exact scan without index
+        index_manager = EmbeddingIndexManager.get_instance()
+        distance, use_index = index_manager.get_distance(current_model_name, query_vector[0])
+        ef_search = index_manager.get_ef_search(limit) if use_index else None
         return StoreEntry.objects.filter(**query_args_emb).annotate(
-            similarity=1 - CosineDistance('embeddings', query_vector[0])
+            distance=distance
         ).filter(
-            similarity__gt=0.7
-        ).order_by('-similarity').values(*fields)
+            distance__lt=1 - 0.7
+        ).order_by('distance').values(*fields), ef_search
 
     @staticmethod
     def build_trigram_query(keywords, query_args, fields):
@@ -422,66 +551,76 @@ class EntrySearchBuilder:
             .values(*fields)
         )
 
-
-class EntrySearchEngine:
-    
-    def __init__(self):
-        self.builder = EntrySearchBuilder()
-    
     @staticmethod
-    def merge_querysets(all_querysets):
-        all_entries = []
-        seen_ids = set()
-        
-        for qs in all_querysets:
-            if hasattr(qs, '__iter__'):
-                for entry in qs:
-                    if entry['idx'] not in seen_ids:
-                        all_entries.append(entry)
-                        seen_ids.add(entry['idx'])
-        
-        return all_entries
+    def build_exclude_q(exclude):
+        """
+        Translate the comma separated glob rules of should_exclude_entry into a Q on path,
+        a rule matches the whole path, one path part or any trailing sub path
+        """
+        if not exclude or exclude.strip() == '':
+            return None
+        q_obj = Q()
+        rules = [rule.strip() for rule in exclude.split(',') if rule.strip() != '']
+        for rule in rules:
+            suffix_pattern = re.escape(rule).replace(r'\*', '.*')
+            q_obj |= Q(path__regex=f'(^|/){suffix_pattern}$')
+            if '/' not in rule:
+                part_pattern = re.escape(rule).replace(r'\*', '[^/]*')
+                q_obj |= Q(path__regex=f'(^|/){part_pattern}(/|$)')
+        return q_obj
 
     @staticmethod
-    def sort_and_deduplicate_by_addr(queryset):
-        if len(queryset) == 0:
-            return queryset
-        
-        seen_addrs = {}  # addr -> (entry, block_id)
-        unique_entries = []
-        
-        for entry in queryset:
-            addr = entry.get('addr', '')
-            block_id = entry.get('block_id', 0)
-            
-            if addr not in seen_addrs:
-                seen_addrs[addr] = (len(unique_entries), block_id)
-                unique_entries.append(entry)
-            else:
-                existing_index, existing_block_id = seen_addrs[addr]
-                if block_id < existing_block_id:
-                    unique_entries[existing_index] = entry
-                    seen_addrs[addr] = (existing_index, block_id)
-        
-        return unique_entries
+    def build_ranked_branch(queryset, *ordering, limit=-1):
+        """
+        Reduce a branch queryset to (idx, addr, block_id, rnk), rnk is the position inside the branch,
+        with limit the branch keeps its ordering so an index scan can stop early
+        """
+        queryset = (
+            queryset.annotate(rnk=Window(expression=RowNumber(), order_by=list(ordering)))
+            .values("idx", "addr", "block_id", "rnk")
+        )
+        if limit > 0:
+            return queryset.order_by(*ordering)[:limit]
+        return queryset.order_by()
 
     @staticmethod
-    def apply_exclusion_filter(queryset, exclude):
-        if not exclude or exclude.strip() == '':
-            return queryset
-        
-        filtered_entries = []
-        for entry in queryset:
-            should_exclude = False
-            
-            if not should_exclude and 'path' in entry and entry['path']:
-                if EntrySearchEngine.should_exclude_entry(entry['path'], exclude):
-                    should_exclude = True
-            
-            if not should_exclude:
-                filtered_entries.append(entry)
-        
-        return filtered_entries
+    def build_hybrid_query(branches, fields, max_count=-1, ef_search=None):
+        """
+        Build one statement from the ranked branches: every branch becomes a CTE,
+        scores are fused by reciprocal rank, one row per addr (lowest block_id) is kept,
+        and only the final rows are fetched, as dicts of fields.
+        ef_search is set for the statement when the vector branch uses the hnsw index
+        """
+        ctes = []
+        params = []
+        for name, queryset in branches:
+            sql, branch_params = queryset.query.sql_with_params()
+            ctes.append(f"{name} AS ({sql})")
+            params.extend(branch_params)
+        hits = " UNION ALL ".join(
+            f"SELECT idx, addr, block_id, rnk FROM {name}" for name, _qs in branches
+        )
+        ctes = f"""
+            WITH {", ".join(ctes)},
+            hits AS ({hits}),
+            fused AS (
+                SELECT idx, addr, block_id, SUM(1.0 / (%s + rnk)) AS score
+                FROM hits GROUP BY idx, addr, block_id
+            ),
+            best AS (
+                SELECT DISTINCT ON (addr) idx, MAX(score) OVER (PARTITION BY addr) AS score
+                FROM fused ORDER BY addr, block_id
+            )
+        """
+        params.append(RRF_K)
+        return HybridQuerySet(ctes, params, fields, limit=max_count if max_count > 0 else -1,
+                              ef_search=ef_search)
+
+
+class EntrySearchEngine:
+    
+    def __init__(self):
+        self.builder = EntrySearchBuilder()
 
     @staticmethod
     def should_exclude_entry(file_path, exclude_rules):
@@ -591,50 +730,54 @@ class EntrySearchEngine:
         return keyword_array
     
 
-    def execute_keyword_search(self, keyword_array, keywords, query_args, fields, max_count, method, 
-                               case_sensitive=False, debug=False):
-        #debug = True
-        all_querysets = []
-        
+    def execute_keyword_search(self, keyword_array, keywords, query_args, max_count, method,
+                               fields, exclude=None, case_sensitive=False, debug=False):
+        """
+        Title, raw, vector and trigram branches are fused in one statement,
+        so only the final rows come back from postgres
+        """
         if debug:
             logger.debug(f"Executing keyword search with keywords: {keywords}, method: {method}, max_count: {max_count}, query_args: {query_args}")
 
+        branch_fields = ["idx", "addr", "block_id"]
+        exclude_q = self.builder.build_exclude_q(exclude)
+
+        def branch_query(queryset):
+            if exclude_q is None:
+                return queryset
+            return queryset.exclude(exclude_q)
+
+        branches = []
+        ef_search = None
         # 1. Title search
-        title_queryset = self.builder.build_title_query(keyword_array, query_args, fields, case_sensitive)
-        all_querysets.append(title_queryset)
-        if debug:
-            logger.debug(f"title search count {title_queryset.count()}")
-        
-        # 2. Raw content search (if results are insufficient)
-        if max_count == -1 or title_queryset.count() < max_count:
-            raw_queryset = self.builder.build_raw_content_query(keyword_array, query_args, fields, case_sensitive)
-            all_querysets.append(raw_queryset)
-            if debug:
-                logger.debug(f"raw search count after title search {raw_queryset.count()}")
-        
-        # 3. Vector search (if enabled and results are insufficient)
-        current_count = sum(qs.count() for qs in all_querysets)
-        if ((max_count == -1 or current_count < max_count) and 
-            method == "embeddingSearch" and embedding_manager.use_embedding(query_args['user_id'])):
-            embedding_queryset = self.builder.build_embedding_query(keywords, query_args, fields)
+        title_queryset = self.builder.build_title_query(keyword_array, query_args, branch_fields, case_sensitive)
+        branches.append(("title_hits", self.builder.build_ranked_branch(
+            branch_query(title_queryset), F("updated_time").desc())))
+
+        # 2. Raw content search
+        raw_queryset = self.builder.build_raw_content_query(keyword_array, query_args, branch_fields, case_sensitive)
+        branches.append(("raw_hits", self.builder.build_ranked_branch(
+            branch_query(raw_queryset), F("block_id").asc(), F("updated_time").desc())))
+
+        # 3. Vector search
+        if (method in ("embeddingSearch", "hybridSearch") and
+            embedding_manager.use_embedding(query_args['user_id'])):
+            candidates = max_count * VECTOR_CANDIDATE_FACTOR if max_count > 0 else VECTOR_MAX_CANDIDATES
+            embedding_queryset, ef_search = self.builder.build_embedding_query(
+                keywords, query_args, branch_fields, candidates)
             if embedding_queryset is not None:
-                all_querysets.append(embedding_queryset)
-                logger.debug(f"added embedding search {embedding_queryset.count()}")
-        
-        # 4. Fuzzy search (if enabled and results are insufficient)
-        current_count = sum(qs.count() for qs in all_querysets)
-        if ((max_count == -1 or current_count < max_count) and 
-            (method == "fuzzySearch" or method == "auto")):
-            trigram_queryset = self.builder.build_trigram_query(keywords, query_args, fields)
-            all_querysets.append(trigram_queryset)
-            if debug:
-                logger.debug(f"trigram search count {trigram_queryset.count()}")
-        
-        queryset = self.merge_querysets(all_querysets)        
-        queryset = self.sort_and_deduplicate_by_addr(queryset)
+                branches.append(("vector_hits", self.builder.build_ranked_branch(
+                    branch_query(embedding_queryset), F("distance").asc(), limit=candidates)))
+
+        # 4. Fuzzy search
+        if method in ("fuzzySearch", "auto", "hybridSearch"):
+            trigram_queryset = self.builder.build_trigram_query(keywords, query_args, branch_fields)
+            branches.append(("trigram_hits", self.builder.build_ranked_branch(
+                branch_query(trigram_queryset), F("similarity").desc())))
+
+        queryset = self.builder.build_hybrid_query(branches, fields, max_count, ef_search)
         if debug:
-            logger.debug(f"final count {len(queryset)}")
-        
+            logger.debug(f"hybrid search branches {[name for name, _qs in branches]}")
         return queryset
     
     def search(self, keywords, query_args, max_count=-1, fields=None, method="auto", exclude=None, case_sensitive=False, debug=False):
@@ -668,13 +811,15 @@ class EntrySearchEngine:
                 query_args['block_id'] = 0
                 queryset = self.builder.build_title_query(keyword_array, query_args, fields, case_sensitive)
                 # logger.error(f"file search count {queryset.count()}")
-            else:  # keyword search
-                queryset = self.execute_keyword_search(
-                    keyword_array, keywords, query_args, fields, max_count, method, case_sensitive, debug
+            else:  # keyword search, limit and exclude are applied inside the statement
+                return self.execute_keyword_search(
+                    keyword_array, keywords, query_args, max_count, method, fields, exclude, case_sensitive, debug
                 )
 
             # Apply exclude logic if provided
-            queryset = self.apply_exclusion_filter(queryset, exclude)
+            exclude_q = self.builder.build_exclude_q(exclude)
+            if exclude_q is not None:
+                queryset = queryset.exclude(exclude_q)
         else:
             query_args['block_id'] = 0
             queryset = StoreEntry.objects.filter(**query_args).values(*fields)
@@ -690,13 +835,8 @@ def get_entry_list(keywords, query_args, max_count=-1, fields=None, method="auto
     search_engine = EntrySearchEngine()
     result_list = search_engine.search(keywords, query_args, max_count, fields, method, exclude, case_sensitive, debug)
 
-    if isinstance(result_list, QuerySet):
+    if isinstance(result_list, (QuerySet, HybridQuerySet)):
         return result_list
-    elif isinstance(result_list, list) and len(result_list) > 0:
-        idx_list = [item['idx'] for item in result_list if 'idx' in item]
-        if idx_list:
-            preserved_order = Case(*[When(idx=pk, then=pos) for pos, pk in enumerate(idx_list)])
-            return StoreEntry.objects.filter(idx__in=idx_list).order_by(preserved_order)
     return StoreEntry.objects.none()
 
 def get_type_options(ctype):
@@ -728,27 +868,8 @@ def get_type_options(ctype):
 
 
 def get_file_content_by_path(path, user, debug=False):
-    meta_data = {}
-    content = None
-    ret_convert = False
-
-    if converter.is_markdown(path):
-        md_path = path
-        ret_convert = True
-    elif converter.is_support(path):
-        md_path = filecache.get_tmpfile(".md")
-        ret_convert, md_path = convert_to_md(
-            path, md_path, force=True, use_ocr=user.privilege.b_ocr
-        )
-    if debug:
-        logger.info("after convert")
-    if ret_convert:
-        parser = MarkdownParser(md_path)
-        meta_data = parser.fm
-        content = parser.content
-    if content is None and is_plain_text(path):
-        content = open(path, "r").read()
-    return meta_data, content
+    artifact = ConversionArtifactCache.get_instance().convert(path, user, debug=debug)
+    return artifact.meta, artifact.content
 
 
 def add_data(obj, data=None, use_llm=True, debug=False):
@@ -1,16 +1,33 @@
 import pytz
 import traceback
 import json
+import difflib
+import hashlib
 from typing import Optional
 from loguru import logger
 import numpy as np
+from django.db import transaction
+from django.db.models import Max
 from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from backend.common.llm.embedding import embedding_manager
+from backend.common.llm.embedding_service import EMBEDDING_TIMEOUT
 from backend.common.files import utils_filemanager
 from .models import StoreEntry
 from .entry_item import EntryItem
+from .embedding_index import EmbeddingIndexManager
+from .sync_manifest import SyncManifest
+from .dir_index import DirectoryIndex, INDEXED_ETYPES
+from .conversion_cache import ConversionArtifactCache
+
+# block fields that are not synced from the entry when only the block content is diffed
+BLOCK_UNTRACKED_FIELDS = ['idx', 'created_time', 'updated_time', 'md5', 'meta', 'raw', 'embeddings', 'emb_model']
+
+
+def get_block_hash(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
 
 class EntryStorage:
 
@@ -19,6 +36,7 @@ class EntryStorage:
         entry: EntryItem,
         content: Optional[str] = None,
         has_new_content: bool = True,
+        chunks: Optional[list] = None,
         debug: bool = False
     ) -> tuple:        
         try:
@@ -47,9 +65,12 @@ class EntryStorage:
                     pass
             
             if db_entry:
-                ret_emb = EntryStorage._update_entry(entry, has_new_content, content, debug=debug)
+                ret_emb = EntryStorage._update_entry(entry, has_new_content, content, chunks=chunks, debug=debug)
+                if has_new_content and db_entry.md5 and entry.md5 and db_entry.md5 != entry.md5:
+                    ConversionArtifactCache.get_instance().release(entry.user_id, [db_entry.md5])
             else:
-                ret_emb = EntryStorage._create_entry(entry, content, debug=debug)
+                ret_emb = EntryStorage._create_entry(entry, content, chunks=chunks, debug=debug)
+            EntryStorage.mark_changed(entry.user_id, entry.etype, [entry.addr])
             
             return True, ret_emb, operation
             
@@ -59,7 +80,8 @@ class EntryStorage:
             return False, False, _("add_failed")
 
     @staticmethod
-    def _update_entry(entry: EntryItem, has_new_content: bool, content: Optional[str] = None, debug: bool = False):
+    def _update_entry(entry: EntryItem, has_new_content: bool, content: Optional[str] = None,
+                      chunks: Optional[list] = None, debug: bool = False):
         ret_emb = True
         if has_new_content:
             db_entry = StoreEntry.objects.get(idx=entry.idx) # block_id=0
@@ -82,6 +104,7 @@ class EntryStorage:
                     if ret:
                         db_entry.embeddings = embeddings[0]
                         db_entry.emb_model = embedding_manager.get_model_name(entry.user_id)
+                        EntryStorage._ensure_embedding_index(db_entry.emb_model, embeddings[0])
                     else:
                         db_entry.embeddings = None
                         db_entry.emb_model = None
@@ -91,7 +114,7 @@ class EntryStorage:
                 logger.info(f"update entry {entry.idx} {entry.addr} {entry.etype} {entry.user_id} {db_entry.raw[:100]}")
             db_entry.save()
             if content:
-                ret_emb = EntryStorage._save_content_blocks(entry, content, debug=debug)
+                ret_emb = EntryStorage._save_content_blocks(entry, content, chunks=chunks, debug=debug)
         else: # 没有新文件上传/更新文件，只改属性值
             entries = StoreEntry.objects.filter(
                 user_id=entry.user_id,
@@ -113,7 +136,8 @@ class EntryStorage:
         return ret_emb
 
     @staticmethod 
-    def _create_entry(entry: EntryItem, content: Optional[str] = None, debug: bool = False):
+    def _create_entry(entry: EntryItem, content: Optional[str] = None,
+                      chunks: Optional[list] = None, debug: bool = False):
         ret_emb = True
             
         entry_dict = entry.to_model_dict()
@@ -128,6 +152,7 @@ class EntryStorage:
                 ret, embeddings = embedding_manager.do_embedding(entry.user_id, [abstract])
                 if ret:
                     entry_dict['embeddings'] = embeddings[0]
+                    EntryStorage._ensure_embedding_index(entry_dict['emb_model'], embeddings[0])
                 else:
                     entry_dict['embeddings'] = None
                     entry_dict['emb_model'] = None
@@ -135,106 +160,223 @@ class EntryStorage:
                     logger.warning(f"embedding failed for user {entry.user_id}, will continue with empty embeddings")
         StoreEntry.objects.create(**entry_dict)
         if content:
-            ret_emb = EntryStorage._save_content_blocks(entry, content, debug=debug)
+            ret_emb = EntryStorage._save_content_blocks(entry, content, chunks=chunks, debug=debug)
         return ret_emb
 
     @staticmethod
-    def _save_content_blocks(entry: EntryItem, content: str, debug: bool=False) -> bool:
+    def _save_content_blocks(entry: EntryItem, content: str, chunks: Optional[list] = None,
+                             debug: bool=False) -> bool:
+        """
+        Align the old and new blocks by content hash like a sequence diff,
+        only inserted, changed, moved and removed blocks are written,
+        with one bulk_create, one bulk_update and one delete in a transaction
+        """
         ret = True
-        existing_blocks = StoreEntry.objects.filter(
+        existing_blocks = list(StoreEntry.objects.filter(
             user_id=entry.user_id,
             addr=entry.addr,
             block_id__gt=0
-        ).order_by('block_id')
-        
-        has_existing = existing_blocks.count() > 0
+        ).order_by('block_id'))
         
         if not content:
-            existing_blocks.delete()
+            if len(existing_blocks) > 0:
+                StoreEntry.objects.filter(idx__in=[block.idx for block in existing_blocks]).delete()
             return ret
             
-        blocks = embedding_manager.split(content) or [content]
-        
-        if len(blocks) != (existing_blocks.count() if has_existing else 0):
-            existing_blocks.delete()
-            has_existing = False
-        
+        # chunks of a cached conversion artifact spare the split
+        blocks = chunks or embedding_manager.split(content) or [content]
+        emb_model = embedding_manager.get_model_name(entry.user_id)
         embedding_scope = embedding_manager.get_embedding_scope(entry.user_id)
-        if embedding_scope != 'all':
-            embeddings = []
-            for i, block_text in enumerate(blocks):
-                if has_existing:
-                    old_block = existing_blocks[i]
-                    embeddings.append(old_block.embeddings if old_block.raw == block_text else None)
-                else:
-                    embeddings.append(None)
-        else:
-            embeddings = []
-            blocks_need_embedding = []
-            embedding_indices = []
-            
-            for i, block_text in enumerate(blocks):
-                embeddings.append(None)
-                if has_existing:
-                    old_block = existing_blocks[i]
-                    if (safe_equals(old_block.raw, block_text) and 
-                        old_block.embeddings is not None and 
-                        old_block.emb_model == embedding_manager.get_model_name(entry.user_id)):
-                        embeddings[i] = old_block.embeddings
-                        continue
-                
+
+        # matched[j] = (old block, same content) for new block j, None for a new row
+        matched = [None] * len(blocks)
+        to_delete = []
+        matcher = difflib.SequenceMatcher(
+            None,
+            [get_block_hash(block.raw) for block in existing_blocks],
+            [get_block_hash(block_text) for block_text in blocks],
+            autojunk=False
+        )
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                for k in range(i2 - i1):
+                    matched[j1 + k] = (existing_blocks[i1 + k], True)
+            elif tag in ('replace', 'delete'):
+                reuse = min(i2 - i1, j2 - j1)
+                for k in range(reuse):  # changed blocks keep their rows
+                    matched[j1 + k] = (existing_blocks[i1 + k], False)
+                to_delete.extend(existing_blocks[i1 + reuse:i2])
+
+        embeddings = [None] * len(blocks)
+        blocks_need_embedding = []
+        embedding_indices = []
+        for i, block_text in enumerate(blocks):
+            if matched[i] is not None:
+                old_block, same = matched[i]
+                if same and old_block.embeddings is not None and (
+                    embedding_scope != 'all' or old_block.emb_model == emb_model):
+                    embeddings[i] = old_block.embeddings
+                    continue
+            if embedding_scope == 'all':
                 blocks_need_embedding.append(block_text)
                 embedding_indices.append(i) # 只更新不一样的块
-            
-            if len(blocks_need_embedding) > 0:
-                batch_size = 100
-                for batch_start in range(0, len(blocks_need_embedding), batch_size):
-                    batch_end = min(batch_start + batch_size, len(blocks_need_embedding))
-                    batch_blocks = blocks_need_embedding[batch_start:batch_end]
-                    batch_indices = embedding_indices[batch_start:batch_end]
-                    
-                    ret, batch_embeddings = embedding_manager.do_embedding(entry.user_id, batch_blocks)
-                    if debug:
-                        logger.debug(f"batch {batch_start//batch_size + 1} embeddings {ret} {len(batch_embeddings)}")
-                    
-                    if ret:
-                        for idx, embedding in zip(batch_indices, batch_embeddings):
-                            embeddings[idx] = embedding
-                    else:
-                        for idx in batch_indices:
-                            embeddings[idx] = None
-                
-                successful_embeddings = sum(1 for emb in embeddings if emb is not None)
-                if debug:
-                    logger.info(f"Successfully embedded {successful_embeddings} out of {len(blocks)} blocks for user {entry.user_id}")
-                if successful_embeddings == 0:
-                    ret = False
-                    logger.warning(f"No embeddings were created for user {entry.user_id}, check embedding service or model configuration")
-                
+
+        if len(blocks_need_embedding) > 0:
+            # all blocks are queued at once, the embedding service batches them concurrently
+            futures = embedding_manager.submit_embedding(entry.user_id, blocks_need_embedding) or []
+            for idx, future in zip(embedding_indices, futures):
+                try:
+                    embeddings[idx] = future.result(timeout=EMBEDDING_TIMEOUT)
+                except Exception as e:
+                    logger.warning(f"embedding block {idx} failed {e}")
+                    embeddings[idx] = None
+
+            successful_embeddings = sum(1 for i in embedding_indices if embeddings[i] is not None)
+            if debug:
+                logger.info(f"Successfully embedded {successful_embeddings} out of {len(blocks_need_embedding)} blocks for user {entry.user_id}")
+            if successful_embeddings == 0:
+                ret = False
+                logger.warning(f"No embeddings were created for user {entry.user_id}, check embedding service or model configuration")
+            else:
+                EntryStorage._ensure_embedding_index(
+                    emb_model, next(embeddings[i] for i in embedding_indices if embeddings[i] is not None)
+                )
+
+        to_create = []
+        to_update = []
+        update_fields = set()
         for i, (block_text, embedding) in enumerate(zip(blocks, embeddings)):
             block_entry = entry.clone(
                 block_id=i+1,
                 raw=block_text,
                 embeddings=embedding,
-                emb_model=embedding_manager.get_model_name(entry.user_id) if embedding is not None else None,
+                emb_model=emb_model if embedding is not None else None,
                 idx=None,
                 meta=None
             )
-            
-            if has_existing:
-                old_block = existing_blocks[i]
-                for key, value in block_entry.to_model_dict().items():
-                    if key not in ['idx', 'created_time']:
-                        setattr(old_block, key, value)
-                if embedding is None: # if embedding is None, not in key/value
-                    setattr(old_block, 'embeddings', None)
-                    setattr(old_block, 'emb_model', None)
-                old_block.save()
+            block_dict = block_entry.to_model_dict()
+            if matched[i] is None:
+                to_create.append(StoreEntry(**block_dict))
+                continue
+
+            old_block, same = matched[i]
+            changed = set()
+            for key, value in block_dict.items():
+                if key in BLOCK_UNTRACKED_FIELDS:
+                    continue
+                if getattr(old_block, key) != value:
+                    setattr(old_block, key, value)
+                    changed.add(key)
+            if not same:
+                old_block.raw = block_text
+                changed.add('raw')
+            if not same or (embedding is not None and embedding is not old_block.embeddings):
+                old_block.embeddings = embedding
+                old_block.emb_model = emb_model if embedding is not None else None
+                changed.update(['embeddings', 'emb_model'])
+            if len(changed) > 0:
+                old_block.updated_time = entry.updated_time
+                changed.add('updated_time')
+                update_fields.update(changed)
+                to_update.append(old_block)
+
+        with transaction.atomic():
+            if len(to_delete) > 0:
+                StoreEntry.objects.filter(idx__in=[block.idx for block in to_delete]).delete()
+            if len(to_update) > 0:
+                StoreEntry.objects.bulk_update(to_update, list(update_fields), batch_size=500)
+            if len(to_create) > 0:
+                StoreEntry.objects.bulk_create(to_create, batch_size=500)
+        if debug:
+            logger.debug(f"blocks {len(blocks)}, create {len(to_create)}, update {len(to_update)}, delete {len(to_delete)}")
+        return ret
+
+    @staticmethod
+    def append_entry(entry: EntryItem, content: Optional[str] = None, debug: bool = False) -> tuple:
+        """
+        Save an append-only entry such as a chat, content is only the part added since
+        the last save, it is split and embedded into blocks after the existing ones
+        """
+        try:
+            entry.updated_time = timezone.now().astimezone(pytz.UTC)
+            db_entry = StoreEntry.objects.filter(user_id=entry.user_id, addr=entry.addr, block_id=0).first()
+            if db_entry is None:
+                ret_emb = EntryStorage._create_entry(entry, content, debug=debug)
+                return True, ret_emb, _("add_success")
+
+            entry.idx = db_entry.idx
+            exclude_fields = ['idx', 'block_id', 'raw', 'embeddings', 'emb_model', 'created_time']
+            EntryStorage._update_db_entry_fields(db_entry, entry.to_model_dict(), exclude_fields, debug=debug)
+            db_entry.save()
+            ret_emb = True
+            if content:
+                ret_emb = EntryStorage._append_content_blocks(entry, content, debug=debug)
+            return True, ret_emb, _("update_success")
+        except Exception as e:
+            logger.error(f"append_entry failed: {str(e)}")
+            traceback.print_exc()
+            return False, False, _("add_failed")
+
+    @staticmethod
+    def _append_content_blocks(entry: EntryItem, content: str, debug: bool = False) -> bool:
+        ret = True
+        last_block_id = StoreEntry.objects.filter(
+            user_id=entry.user_id, addr=entry.addr, block_id__gt=0
+        ).aggregate(last=Max('block_id'))['last'] or 0
+        if last_block_id > 0:
+            content = "\n" + content  # get_content joins the blocks without separator
+        blocks = embedding_manager.split(content) or [content]
+        emb_model = embedding_manager.get_model_name(entry.user_id)
+        embeddings = [None] * len(blocks)
+        if embedding_manager.get_embedding_scope(entry.user_id) == 'all':
+            futures = embedding_manager.submit_embedding(entry.user_id, blocks) or []
+            for i, future in enumerate(futures):
+                try:
+                    embeddings[i] = future.result(timeout=EMBEDDING_TIMEOUT)
+                except Exception as e:
+                    logger.warning(f"embedding block {last_block_id + i + 1} failed {e}")
+            if all(embedding is None for embedding in embeddings):
+                ret = False
             else:
-                StoreEntry.objects.create(**block_entry.to_model_dict())
-            
+                EntryStorage._ensure_embedding_index(
+                    emb_model, next(embedding for embedding in embeddings if embedding is not None)
+                )
+
+        rows = []
+        for i, (block_text, embedding) in enumerate(zip(blocks, embeddings)):
+            block_entry = entry.clone(
+                block_id=last_block_id + i + 1,
+                raw=block_text,
+                embeddings=embedding,
+                emb_model=emb_model if embedding is not None else None,
+                idx=None,
+                meta=None
+            )
+            rows.append(StoreEntry(**block_entry.to_model_dict()))
+        StoreEntry.objects.bulk_create(rows, batch_size=500)
+        if debug:
+            logger.debug(f"append {len(rows)} blocks after {last_block_id} to {entry.addr}")
         return ret
 
+    @staticmethod
+    def mark_changed(uid, etype, addrs):
+        """
+        Keep the sync manifest and the directory index in step with the addrs,
+        etype None stands for any of them
+        """
+        if etype in (None, "note"):
+            SyncManifest.get_instance().mark_dirty(uid, addrs)
+        for indexed_etype in INDEXED_ETYPES:
+            if etype in (None, indexed_etype):
+                DirectoryIndex.get_instance().mark_dirty(uid, indexed_etype, addrs)
+
+    @staticmethod
+    def _ensure_embedding_index(emb_model, embedding):
+        try:
+            EmbeddingIndexManager.get_instance().ensure_index(emb_model, len(embedding))
+        except Exception as e:
+            logger.warning(f"ensure embedding index failed {e}")
+
     @staticmethod
     def get_content(user_id: str, addr: str) -> str:
         blocks = StoreEntry.objects.filter(
@@ -250,25 +392,29 @@ class EntryStorage:
     @staticmethod
     def delete_entry(uid, filelist):
         logger.debug(f"real delete total {len(filelist)}")
+        md5s = []
         for item in filelist:
             addr = item["addr"]
             filter_args = {"user_id": uid, "addr": addr}
             if "etype" in item:
                 filter_args["etype"] = item["etype"]
             entrys = StoreEntry.objects.filter(**filter_args)
-            logger.warning(f"real delete {uid} addr {addr}, {entrys.count()}")
-            for entry in entrys:
-                if entry.block_id == 0:
-                    if entry.path is not None:
-                        utils_filemanager.get_file_manager().delete_file(
-                            uid, entry.path
-                        )
-                        logger.info(f"real delete server file {entry.path}")
-                    entry.is_deleted = True
-                    entry.updated_time = timezone.now().astimezone(pytz.UTC)
-                    entry.save()
-                else:
-                    entry.delete()
+            logger.warning(f"real delete {uid} addr {addr}")
+            for path, md5 in entrys.filter(block_id=0).values_list("path", "md5"):
+                md5s.append(md5)
+                if path is not None:
+                    utils_filemanager.get_file_manager().delete_file(uid, path)
+                    logger.info(f"real delete server file {path}")
+            with transaction.atomic():
+                entrys.filter(block_id__gt=0).delete()
+                entrys.filter(block_id=0).update(
+                    is_deleted=True, updated_time=timezone.now().astimezone(pytz.UTC)
+                )
+        for etype in set(item.get("etype") for item in filelist):
+            EntryStorage.mark_changed(
+                uid, etype, [item["addr"] for item in filelist if item.get("etype") == etype]
+            )
+        ConversionArtifactCache.get_instance().release(uid, md5s)
 
     @staticmethod
     def _update_db_entry_fields(db_entry, entry_dict, exclude_fields=None, update_meta_condition=True, debug=False):
@@ -299,7 +299,7 @@ def get_features_by_llm(user_id, content, etype, title=None, use_llm=True, debug
         
         # logger.error(f"now llm_query {query[:1000]}") # for debugging
         ret, result, detail = llm_query_json(
-            user_id, RECORD_ROLE, query, "data_manager", debug=debug
+            user_id, RECORD_ROLE, query, "data_manager", use_cache=True, debug=debug
         )
         
         if not ret or not isinstance(result, dict):
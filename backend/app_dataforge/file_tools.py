@@ -5,14 +5,19 @@ from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from backend.common.files import utils_filemanager, filecache
-from backend.common.utils.file_tools import get_ext
-from backend.common.parser import converter
+from backend.common.utils.file_tools import get_ext, is_plain_text
+from backend.common.parser.conversion_service import ConversionService
+from backend.common.user.user import UserManager
 from .models import StoreEntry
 from .entry import delete_entry, add_data, REL_DIR_FILES, REL_DIR_NOTES
 from .zipfile import is_compressed_file, uncompress_file
 from .entry_item import EntryItem
+from .ingest import IngestPipeline
+from .conversion_cache import ConversionArtifactCache
+from .entry_storage import EntryStorage
+from .folder_ops import move_folder, delete_folder, FOLDER_PROGRESS_STEP
 
-def update_file(dic, addr, file_path, md5, vault, is_unzip, is_createSubDir, progress_callback=None, task_id=None, debug=False):
+def get_dic_item(dic, addr, md5, vault):
     if addr.startswith("/"):
         addr = addr[1:]
     dic_item = dic.copy()
@@ -21,7 +26,11 @@ def update_file(dic, addr, file_path, md5, vault, is_unzip, is_createSubDir, pro
     else:
         dic_item["addr"] = addr
     dic_item["md5"] = md5
+    return dic_item
+
 
+def update_file(dic, addr, file_path, md5, vault, is_unzip, is_createSubDir, progress_callback=None, task_id=None, debug=False):
+    dic_item = get_dic_item(dic, addr, md5, vault)
     if is_unzip and is_compressed_file(file_path):
         return uncompress_file(dic_item, file_path, is_createSubDir, progress_callback, task_id)
     else:
@@ -30,15 +39,40 @@ def update_file(dic, addr, file_path, md5, vault, is_unzip, is_createSubDir, pro
         
 def update_files(file_paths, filepaths, filemd5s, dic, vault, is_unzip, is_createSubDir, 
                  progress_callback=None, task_id=None, debug=False):
+    """
+    Archives are unpacked one by one, the other files go through the bulk ingest pipeline
+    return success_list, emb_status, stats (per stage throughput)
+    """
     success_list = []
     if len(file_paths) > 0 and len(filemd5s) == 0:
         filemd5s = [None] * len(file_paths)
 
-    total = len(file_paths)
     emb_status = "success" 
-    for idx, (file_path, addr, md5) in enumerate(zip(file_paths, filepaths, filemd5s)):
+    archives = []
+    dic_items = []
+    ingest_paths = []
+    for file_path, addr, md5 in zip(file_paths, filepaths, filemd5s):
+        if is_unzip and is_compressed_file(file_path):
+            archives.append((file_path, addr, md5))
+        else:
+            dic_items.append(get_dic_item(dic, addr, md5, vault))
+            ingest_paths.append(file_path)
+
+    stats = {}
+    if len(dic_items) > 0:
+        pipeline = IngestPipeline(
+            dic["user_id"],
+            progress_callback if len(archives) == 0 else None,
+            task_id,
+            debug=debug,
+        )
+        success_list += pipeline.run(dic_items, ingest_paths)
+        stats = pipeline.stats
+        emb_status = pipeline.emb_status
+
+    for idx, (file_path, addr, md5) in enumerate(archives):
         if debug:
-            logger.info(f"update_files idx:{idx}, path:{file_path}, addr:{addr}, md5:{md5}")
+            logger.info(f"update_files archive idx:{idx}, path:{file_path}, addr:{addr}, md5:{md5}")
         if len(file_paths) == 1:
             ret, ret_emb, detail = update_file(dic, addr, file_path, md5, vault, is_unzip, is_createSubDir, 
                                            progress_callback, task_id, debug=debug) # for single file, such as: zip
@@ -48,21 +82,42 @@ def update_files(file_paths, filepaths, filemd5s, dic, vault, is_unzip, is_creat
             emb_status = "failed"
         if ret:
             success_list.append(addr)
-        if progress_callback:
-            progress_callback((idx + 1) * 100 / total, task_id)    
+        if progress_callback and len(file_paths) > 1:
+            progress_callback((len(dic_items) + idx + 1) * 100 / len(file_paths), task_id)
     if debug:
         logger.info(f"upload_files success {str(success_list)[:200]}")
 
-    return success_list, emb_status
+    return success_list, emb_status, stats
 
 def real_import(user_id, process_list, progress_callback=None, task_id=None, debug=False):
+    """
+    All sources are downloaded and queued on the conversion service first,
+    so they convert in parallel while the results are stored in order.
+    Sources with a cached conversion artifact are neither downloaded nor converted
+    """
     success_list = []
     try:
         total = len(process_list)
-        for idx, (base_src_path, dst_path, need_delete) in enumerate(process_list):
+        service = ConversionService.get_instance()
+        artifact_cache = ConversionArtifactCache.get_instance()
+        user = UserManager.get_instance().get_user(user_id)
+        source_md5s = dict(
+            StoreEntry.objects.filter(
+                user_id=user_id,
+                path__in=[base_src_path for base_src_path, _dst, _del in process_list],
+                block_id=0,
+            ).values_list("path", "md5")
+        )
+        jobs = []
+        for base_src_path, dst_path, need_delete in process_list:
             if need_delete:
                 delete_entry(user_id, [{"addr": dst_path, "etype": "note"}])
-            
+
+            artifact = artifact_cache.get(user_id, source_md5s.get(base_src_path), user.privilege.b_ocr)
+            if artifact is not None and artifact.content is not None:
+                jobs.append((base_src_path, dst_path, artifact, None))
+                continue
+
             src_ext = get_ext(base_src_path) 
             src_path = filecache.get_tmpfile(src_ext)
             ret = utils_filemanager.get_file_manager().get_file(
@@ -73,14 +128,22 @@ def real_import(user_id, process_list, progress_callback=None, task_id=None, deb
                 continue
             
             filecache.TmpFileManager.get_instance().add_file(src_path)
-            
-            md_path = filecache.get_tmpfile('.md')
-            ret = converter.convert(src_path, md_path)
-            if not ret:
+            if not is_plain_text(src_path):
+                service.submit(src_path, use_ocr=user.privilege.b_ocr)
+            jobs.append((base_src_path, dst_path, None, src_path))
+
+        for idx, (base_src_path, dst_path, artifact, src_path) in enumerate(jobs):
+            if artifact is None:
+                # the submitted job is reused, the result is kept as an artifact
+                artifact = artifact_cache.convert(src_path, user, debug=debug)
+            if artifact.content is None:
                 logger.warning(f"Failed to convert file: {base_src_path}")
                 continue
+            md_path = filecache.get_tmpfile(".md")
+            artifact.save_markdown(md_path)
+            filecache.TmpFileManager.get_instance().add_file(md_path)
 
-            if debug: logger.info(f"## convert file {src_path} to {md_path}")
+            if debug: logger.info(f"## convert file {base_src_path} to {md_path}")
 
             dic = {
                 "user_id": user_id,
@@ -116,9 +179,19 @@ def real_refresh(user_id, addr, etype, is_folder, progress_callback=None, task_i
     if entries.count() == 0:
         logger.warning(f"real_refresh {user_id} {addr} etype:{etype}, is_folder:{is_folder}, entries {len(entries)}")
         return success_list
+    artifact_cache = ConversionArtifactCache.get_instance()
+    user = UserManager.get_instance().get_user(user_id)
+    total = len(entries)
+    reported = 0
     for i, entry in enumerate(entries):
         entry = EntryItem.from_model(entry)
+        artifact = None
         if etype == "file" or etype == "note":
+            # an unchanged source with a cached conversion is not downloaded again
+            artifact = artifact_cache.get(user_id, entry.md5, user.privilege.b_ocr)
+        if artifact is not None:
+            ret, ret_emb, detail = add_data(entry, {"artifact": artifact})
+        elif etype == "file" or etype == "note":
             ext = get_ext(entry.path)
             file_path = filecache.get_tmpfile(ext)
             ret = utils_filemanager.get_file_manager().get_file(
@@ -133,8 +206,10 @@ def real_refresh(user_id, addr, etype, is_folder, progress_callback=None, task_i
             ret, ret_emb, detail = add_data(entry)
         if ret:
             success_list.append(entry.addr)
-        if progress_callback:
-            progress_callback((i + 1) * 100 / len(entries), task_id)
+        progress = (i + 1) * 100 / total
+        if progress_callback and (progress - reported >= FOLDER_PROGRESS_STEP or i + 1 == total):
+            reported = progress
+            progress_callback(progress, task_id)
 
     return success_list
 
@@ -153,6 +228,7 @@ def rename_file(uid, oldaddr, newaddr, dic, debug=False):
     if ret:
         StoreEntry.objects.filter(user_id=uid, addr=oldaddr, etype=dic['etype']).update(addr=newaddr, path=newpath, 
                                   updated_time = timezone.now().astimezone(pytz.UTC))
+        EntryStorage.mark_changed(uid, dic['etype'], [oldaddr, newaddr])
         return True
     return False
 
@@ -165,19 +241,16 @@ def real_delete(user_id, path, etype, is_folder, progress_callback=None, task_id
                 normalized_path = path.replace('\\', '/').replace('//', '/')
                 entries = StoreEntry.objects.filter(user_id=user_id, addr=normalized_path, etype=etype, block_id=0)
         else:
-            dirname = path if path.endswith('/') else path + '/'
-            entries = StoreEntry.objects.filter(user_id=user_id, etype=etype, addr__startswith=dirname, block_id=0)
+            return delete_folder(user_id, etype, path, progress_callback, task_id)
             
         if entries.count() == 0:
             logger.warning(f"real_delete {user_id} {path} etype:{etype}, is_folder:{is_folder}")
             return success_list
 
-        for i, entry in enumerate(entries):
-            delete_entry(user_id, [{"addr": entry.addr, "etype": etype}])
-            success_list.append(entry.addr)
-            if progress_callback:
-                progress_callback((i + 1) * 100 / len(entries), task_id)
-                
+        delete_entry(user_id, [{"addr": entry.addr, "etype": etype} for entry in entries])
+        success_list += [entry.addr for entry in entries]
+        if progress_callback:
+            progress_callback(100, task_id)
         return success_list
     except Exception as e:
         logger.error(f"Error during delete: {str(e)}")
@@ -201,19 +274,7 @@ def real_move(user_id, source, target, etype, is_folder, progress_callback=None,
                 else:
                     success_list.append(target)
         else:
-            dirname = source if source.endswith('/') else source + '/'
-            entries = StoreEntry.objects.filter(user_id=user_id, etype=etype, addr__startswith=dirname, block_id=0)
-            
-            total = len(entries)
-            for i, entry in enumerate(entries):
-                rel_path = entry.addr[len(dirname):]
-                new_dst = os.path.join(target, rel_path)
-                dic = entry.__dict__.copy()
-                ret = rename_file(user_id, entry.addr, new_dst, dic)
-                if ret:
-                    success_list.append(new_dst)
-                if progress_callback:
-                    progress_callback((i + 1) * 100 / total, task_id)
+            success_list = move_folder(user_id, etype, source, target, progress_callback, task_id)
 
         return success_list
     except Exception as e:
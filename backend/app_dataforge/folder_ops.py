@@ -0,0 +1,170 @@
+"""
+Set based folder operations
+
+Moving or deleting a folder changes the rows of all its entries with one UPDATE
+(and one DELETE for the blocks), the storage objects are renamed or removed
+concurrently in a bounded thread pool. Progress is reported in FOLDER_PROGRESS_STEP
+percent steps instead of once per entry.
+"""
+
+import os
+import pytz
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+from django.db import transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Concat, Substr
+from django.utils import timezone
+
+from backend.common.files import utils_filemanager
+from .models import StoreEntry
+from .entry import REL_DIR_FILES, REL_DIR_NOTES
+from .entry_storage import EntryStorage
+from .conversion_cache import ConversionArtifactCache
+
+FOLDER_OP_WORKERS = int(os.getenv("FOLDER_OP_WORKERS", 16))
+FOLDER_PROGRESS_STEP = 5  # percent
+
+REL_DIRS = {"file": REL_DIR_FILES, "note": REL_DIR_NOTES}
+
+
+def get_folder_prefix(path):
+    """
+    "a/b" and "a/b/" both give "a/b/", the root "" stays ""
+    """
+    return os.path.join(path, "") if path else ""
+
+
+def is_root_prefix(prefix):
+    """
+    An empty folder path matches every entry of the user
+    """
+    return prefix.strip().strip("/") == ""
+
+
+def run_storage_ops(func, items, progress_callback=None, task_id=None):
+    """
+    Call func on every item in the pool, return the items func succeeded on
+    """
+    done = []
+    if len(items) == 0:
+        return done
+    reported = 0
+    with ThreadPoolExecutor(max_workers=min(FOLDER_OP_WORKERS, len(items))) as executor:
+        futures = {executor.submit(func, item): item for item in items}
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                if future.result():
+                    done.append(futures[future])
+            except Exception as e:
+                logger.warning(f"storage op {futures[future]} failed {e}")
+            progress = (i + 1) * 100 / len(items)
+            if progress_callback and (progress - reported >= FOLDER_PROGRESS_STEP or i + 1 == len(items)):
+                reported = progress
+                progress_callback(progress, task_id)
+    return done
+
+
+def move_folder(uid, etype, source, target, progress_callback=None, task_id=None):
+    """
+    Move all entries below source to target, return the new addrs
+    """
+    rel_dir = REL_DIRS.get(etype)
+    if rel_dir is None:
+        return []
+    src_prefix = get_folder_prefix(source)
+    dst_prefix = get_folder_prefix(target)
+    if is_root_prefix(src_prefix):
+        logger.warning(f"move_folder {uid} etype:{etype} refuse to move the root folder")
+        return []
+    if src_prefix == dst_prefix:
+        return []
+    if dst_prefix.startswith(src_prefix):
+        logger.warning(f"move_folder {uid} etype:{etype} refuse to move {src_prefix} into itself")
+        return []
+    entries = StoreEntry.objects.filter(
+        user_id=uid, etype=etype, addr__startswith=src_prefix, block_id=0, is_deleted=False
+    )
+    addrs = list(entries.values_list("addr", flat=True))
+    if len(addrs) == 0:
+        logger.warning(f"move_folder {uid} {source} etype:{etype} no entries")
+        return []
+
+    # a live entry at the target keeps its file, the entries that would replace it stay
+    taken = set(
+        StoreEntry.objects.filter(
+            user_id=uid, etype=etype, block_id=0, is_deleted=False,
+            addr__in=[dst_prefix + addr[len(src_prefix):] for addr in addrs],
+        ).values_list("addr", flat=True)
+    )
+    if len(taken) > 0:
+        logger.warning(f"move_folder {uid} {source} to {target} {len(taken)} targets exist, skipped")
+    movable = [addr for addr in addrs if dst_prefix + addr[len(src_prefix):] not in taken]
+
+    file_manager = utils_filemanager.get_file_manager()
+
+    def rename(addr):
+        new_addr = dst_prefix + addr[len(src_prefix):]
+        return file_manager.rename_file(
+            uid, os.path.join(rel_dir, addr), os.path.join(rel_dir, new_addr)
+        )
+
+    moved = run_storage_ops(rename, movable, progress_callback, task_id)
+    failed = set(addrs) - set(moved)
+    if len(failed) > len(taken):
+        logger.warning(f"move_folder {uid} {source} {len(failed) - len(taken)} storage renames failed")
+    if len(moved) == 0:
+        return []
+
+    # blocks share the addr of their entry, one UPDATE moves entries and blocks
+    rows = StoreEntry.objects.filter(
+        user_id=uid, etype=etype, addr__startswith=src_prefix, is_deleted=False
+    ).exclude(addr__in=failed)
+    new_addr = Concat(
+        Value(dst_prefix), Substr("addr", len(src_prefix) + 1), output_field=CharField()
+    )
+    count = rows.update(
+        addr=new_addr,
+        path=Concat(Value(os.path.join(rel_dir, "")), new_addr, output_field=CharField()),
+        updated_time=timezone.now().astimezone(pytz.UTC),
+    )
+    logger.info(f"move_folder {uid} {src_prefix} to {dst_prefix}, {len(moved)} entries, {count} rows")
+
+    new_addrs = [dst_prefix + addr[len(src_prefix):] for addr in moved]
+    EntryStorage.mark_changed(uid, etype, moved + new_addrs)
+    return new_addrs
+
+
+def delete_folder(uid, etype, path, progress_callback=None, task_id=None):
+    """
+    Soft delete all entries below path, drop their blocks and storage files,
+    return the deleted addrs
+    """
+    prefix = get_folder_prefix(path)
+    if is_root_prefix(prefix):
+        logger.warning(f"delete_folder {uid} etype:{etype} refuse to delete the root folder")
+        return []
+    entries = StoreEntry.objects.filter(
+        user_id=uid, etype=etype, addr__startswith=prefix, block_id=0, is_deleted=False
+    )
+    rows = list(entries.values_list("addr", "path", "md5"))
+    if len(rows) == 0:
+        logger.warning(f"delete_folder {uid} {path} etype:{etype} no entries")
+        return []
+
+    addrs = [addr for addr, _path, _md5 in rows]
+    with transaction.atomic():
+        StoreEntry.objects.filter(
+            user_id=uid, etype=etype, addr__startswith=prefix, block_id__gt=0
+        ).delete()
+        entries.update(is_deleted=True, updated_time=timezone.now().astimezone(pytz.UTC))
+    EntryStorage.mark_changed(uid, etype, addrs)
+
+    file_manager = utils_filemanager.get_file_manager()
+    paths = [file_path for _addr, file_path, _md5 in rows if file_path is not None]
+    # conversion artifacts no other entry uses go with the sources
+    paths += ConversionArtifactCache.get_instance().get_release_paths(uid, [md5 for _addr, _path, md5 in rows])
+    run_storage_ops(lambda file_path: file_manager.delete_file(uid, file_path), paths,
+                    progress_callback, task_id)
+    logger.info(f"delete_folder {uid} {prefix}, {len(addrs)} entries, {len(paths)} files")
+    return addrs
@@ -0,0 +1,311 @@
+"""
+Bulk ingest pipeline for multi-file uploads
+
+Files go through distinct stages: upload, convert, feature, chunk, embedding and write.
+Every stage works on the whole batch, I/O and LLM bound stages run in thread pools,
+embeddings are submitted at once and rows are written with bulk_create.
+Files whose addr already exists are updated through add_data so block diffing still applies.
+"""
+
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+from django.db import transaction
+
+from backend.common.llm.embedding import embedding_manager
+from backend.common.llm.embedding_service import EMBEDDING_TIMEOUT
+from backend.common.files import utils_filemanager
+from backend.common.parser import converter, utils_md
+from backend.common.parser.md_parser import MarkdownParser
+from backend.common.user.user import UserManager
+
+from .models import StoreEntry
+from .entry import EntryService, REL_DIR_FILES, REL_DIR_NOTES
+from .entry import add_data
+from .entry_item import EntryItem
+from .feature import EntryFeatureTool
+from .entry_storage import EntryStorage
+from .conversion_cache import ConversionArtifactCache
+
+INGEST_IO_WORKERS = int(os.getenv("INGEST_IO_WORKERS", 8))
+INGEST_LLM_WORKERS = int(os.getenv("INGEST_LLM_WORKERS", 4))
+INGEST_DB_BATCH_SIZE = 500
+
+# share of the overall progress after each stage finished
+STAGE_PROGRESS = {
+    "update": 10,  # 100 when the batch has no new files
+    "upload": 15,
+    "convert": 35,
+    "feature": 60,
+    "chunk": 65,
+    "embedding": 90,
+    "write": 100,
+}
+
+
+class IngestItem:
+    def __init__(self, entry: EntryItem, file_path: str):
+        self.entry = entry
+        self.file_path = file_path
+        self.content = None
+        self.meta_dic = {}
+        self.blocks = []
+        self.abstract_embedding = None
+        self.block_embeddings = []
+        self.error = None
+
+
+class IngestPipeline:
+    def __init__(self, user_id, progress_callback=None, task_id=None, debug=False):
+        self.user_id = user_id
+        self.user = UserManager.get_instance().get_user(user_id)
+        self.progress_callback = progress_callback
+        self.task_id = task_id
+        self.debug = debug
+        self.stats = {}
+        self.emb_status = "success"
+
+    def _record_stage(self, name, count, start):
+        duration = time.time() - start
+        self.stats[name] = {
+            "count": count,
+            "seconds": round(duration, 3),
+            "per_second": round(count / duration, 2) if duration > 0 else count,
+        }
+
+    def _run_stage(self, name, items, func, workers=1):
+        """
+        Run func on every item that has no error yet, record the stage throughput
+        """
+        start = time.time()
+        active = [item for item in items if item.error is None]
+
+        def wrapper(item):
+            try:
+                func(item)
+            except Exception as e:
+                traceback.print_exc()
+                item.error = f"{name}: {e}"
+                logger.warning(f"ingest {item.entry.addr} failed at {name} {e}")
+
+        if workers > 1 and len(active) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(wrapper, active))
+        else:
+            for item in active:
+                wrapper(item)
+
+        self._record_stage(name, len(active), start)
+        if self.debug:
+            logger.debug(f"ingest stage {name} {self.stats[name]}")
+        if self.progress_callback:
+            self.progress_callback(STAGE_PROGRESS[name], self.task_id)
+
+    def _upload(self, item):
+        entry = item.entry
+        if entry.etype == "note":
+            entry.path = os.path.join(REL_DIR_NOTES, entry.addr)
+        else:
+            entry.path = os.path.join(REL_DIR_FILES, entry.addr)
+        if not utils_filemanager.get_file_manager().save_file(
+            entry.user_id, entry.path, item.file_path
+        ):
+            raise Exception("save file failed")
+        if entry.md5 is None:
+            entry.md5 = utils_md.get_file_md5(item.file_path)
+
+    def _convert(self, item):
+        entry = item.entry
+        if (entry.etype == "note" and self.user.get("note_save_content")) or (
+            entry.etype == "file" and self.user.get("file_save_content")
+        ):
+            artifact = ConversionArtifactCache.get_instance().convert(item.file_path, self.user)
+            item.meta_dic, item.content = artifact.meta, artifact.content
+            item.blocks = artifact.chunks
+        elif converter.is_markdown(item.file_path):
+            item.meta_dic = MarkdownParser(item.file_path).fm
+        EntryService._apply_meta_to_entry(entry, item.meta_dic)
+
+    def _feature(self, item):
+        entry = item.entry
+        filename = os.path.basename(entry.addr)
+        if item.content is None:
+            EntryFeatureTool.get_instance().parse(entry, filename)
+        else:
+            entry.title = entry.title or filename
+            EntryFeatureTool.get_instance().parse(entry, item.content)
+
+    def _chunk(self, item):
+        if item.content and len(item.blocks) == 0:
+            item.blocks = embedding_manager.split(item.content) or [item.content]
+
+    def _embedding(self, items):
+        """
+        Abstracts and blocks of the whole batch are queued on the embedding service together
+        """
+        start = time.time()
+        embedding_scope = embedding_manager.get_embedding_scope(self.user_id)
+        texts = []
+        targets = []  # (item, block index or None for the abstract)
+        for item in items:
+            if item.error is not None:
+                continue
+            item.block_embeddings = [None] * len(item.blocks)
+            abstract = item.entry.meta.get("description") if item.entry.meta else None
+            if abstract and embedding_scope != 'none':
+                texts.append(abstract)
+                targets.append((item, None))
+            if embedding_scope == 'all':
+                for i, block_text in enumerate(item.blocks):
+                    texts.append(block_text)
+                    targets.append((item, i))
+
+        futures = embedding_manager.submit_embedding(self.user_id, texts) if len(texts) > 0 else []
+        if futures is None:
+            futures = []
+            if len(texts) > 0:
+                self.emb_status = "failed"
+        for (item, index), future in zip(targets, futures):
+            try:
+                embedding = future.result(timeout=EMBEDDING_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"ingest embedding failed {item.entry.addr} {e}")
+                embedding = None
+                self.emb_status = "failed"
+            if index is None:
+                item.abstract_embedding = embedding
+            else:
+                item.block_embeddings[index] = embedding
+
+        self._record_stage("embedding", len(texts), start)
+        if self.progress_callback:
+            self.progress_callback(STAGE_PROGRESS["embedding"], self.task_id)
+
+    def _get_rows(self, item, emb_model):
+        """
+        The entry row and its block rows
+        """
+        rows = []
+        entry = item.entry
+        entry_dict = entry.to_model_dict()
+        entry_dict['block_id'] = 0
+        entry_dict['emb_model'] = emb_model if item.abstract_embedding is not None else None
+        abstract = entry.meta.get("description") if entry.meta else None
+        if abstract:
+            entry_dict['raw'] = abstract
+            entry_dict['embeddings'] = item.abstract_embedding
+        rows.append(StoreEntry(**entry_dict))
+        for i, (block_text, embedding) in enumerate(zip(item.blocks, item.block_embeddings)):
+            block_entry = entry.clone(
+                block_id=i+1,
+                raw=block_text,
+                embeddings=embedding,
+                emb_model=emb_model if embedding is not None else None,
+                idx=None,
+                meta=None
+            )
+            rows.append(StoreEntry(**block_entry.to_model_dict()))
+        return rows
+
+    def _write(self, items):
+        start = time.time()
+        emb_model = embedding_manager.get_model_name(self.user_id)
+        item_rows = [
+            (item, self._get_rows(item, emb_model)) for item in items if item.error is None
+        ]
+        rows = [row for _item, entry_rows in item_rows for row in entry_rows]
+
+        try:
+            with transaction.atomic():
+                StoreEntry.objects.bulk_create(rows, batch_size=INGEST_DB_BATCH_SIZE)
+        except Exception as e:
+            # one bad row fails the whole batch, write the files one by one to find it
+            logger.warning(f"ingest bulk write failed {e}, write {len(item_rows)} files one by one")
+            rows = []
+            for item, entry_rows in item_rows:
+                try:
+                    with transaction.atomic():
+                        StoreEntry.objects.bulk_create(entry_rows, batch_size=INGEST_DB_BATCH_SIZE)
+                    rows += entry_rows
+                except Exception as e:
+                    item.error = f"write: {e}"
+                    logger.warning(f"ingest {item.entry.addr} failed at write {e}")
+        for etype in set(item.entry.etype for item in items):
+            EntryStorage.mark_changed(
+                self.user_id, etype, [item.entry.addr for item in items if item.error is None and item.entry.etype == etype]
+            )
+        for row in rows:
+            if row.embeddings is not None:
+                EntryStorage._ensure_embedding_index(emb_model, row.embeddings)
+                break
+
+        self._record_stage("write", len(rows), start)
+        if self.progress_callback:
+            self.progress_callback(STAGE_PROGRESS["write"], self.task_id)
+
+    def _update_existing(self, items, progress):
+        """
+        Existing entries keep the single entry path, it diffs blocks against the stored ones,
+        progress is reported up to the given percent
+        """
+        start = time.time()
+
+        def update(item):
+            ret, ret_emb, detail = add_data(item.entry.to_dict(), {"path": item.file_path}, debug=self.debug)
+            if not ret:
+                item.error = str(detail)
+            if not ret_emb:
+                self.emb_status = "failed"
+
+        with ThreadPoolExecutor(max_workers=INGEST_IO_WORKERS) as executor:
+            futures = {executor.submit(update, item): item for item in items}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    futures[future].error = f"update: {e}"
+                    logger.warning(f"ingest {futures[future].entry.addr} failed at update {e}")
+                if self.progress_callback:
+                    self.progress_callback((i + 1) * progress / len(items), self.task_id)
+        self._record_stage("update", len(items), start)
+
+    def run(self, dic_items, file_paths):
+        """
+        dic_items and file_paths are parallel lists, return the addrs saved successfully
+        """
+        items = [
+            IngestItem(EntryItem.from_dict(dic_item), file_path)
+            for dic_item, file_path in zip(dic_items, file_paths)
+        ]
+        # an addr uploaded twice in one batch is written once, the last file wins
+        latest = {item.entry.addr: item for item in items}
+        for item in items:
+            if latest[item.entry.addr] is not item:
+                item.error = "duplicate addr in the batch"
+        active = [item for item in items if item.error is None]
+        existing_addrs = set(
+            StoreEntry.objects.filter(
+                user_id=self.user_id,
+                addr__in=[item.entry.addr for item in active],
+                block_id=0,
+            ).values_list("addr", flat=True)
+        )
+        new_items = [item for item in active if item.entry.addr not in existing_addrs]
+        existing_items = [item for item in active if item.entry.addr in existing_addrs]
+
+        if len(existing_items) > 0:
+            progress = STAGE_PROGRESS["update"] if len(new_items) > 0 else 100
+            self._update_existing(existing_items, progress)
+        if len(new_items) > 0:
+            self._run_stage("upload", new_items, self._upload, INGEST_IO_WORKERS)
+            self._run_stage("convert", new_items, self._convert, INGEST_IO_WORKERS)
+            self._run_stage("feature", new_items, self._feature, INGEST_LLM_WORKERS)
+            self._run_stage("chunk", new_items, self._chunk)
+            self._embedding(new_items)
+            self._write(new_items)
+
+        success_list = [item.entry.addr for item in items if item.error is None]
+        logger.info(f"ingest {len(success_list)}/{len(items)} files, stages {self.stats}")
+        return success_list
@@ -42,7 +42,6 @@ def create_dic(url, args, status):
             "resource_path": args.get("resource_path"),
             #
             "add_date": args.get("add_date"),
-            "visit_history": args.get("visit_history", [args.get("add_date")]),
             # from bm navigate
             "clicks": dic.pop("clicks", 1),
             "weight": dic.pop("weight", 0.0),
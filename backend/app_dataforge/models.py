@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Length, Replace
 from pgvector.django import VectorField
 import uuid
 
@@ -47,6 +49,11 @@ class StoreEntry(models.Model):
         max_length=400, default=None, null=True, blank=True
     )  # Relative path to file storage
     md5 = models.CharField(max_length=200, default=None, null=True, blank=True)
+    addr_depth = models.GeneratedField(
+        expression=Length("addr") - Length(Replace("addr", Value("/"), Value(""))),
+        output_field=models.IntegerField(),
+        db_persist=True,
+    )  # number of "/" in addr, kept by postgres, see dir_index
     #
     is_deleted = models.BooleanField(default=False)
     created_time = models.DateTimeField()
@@ -55,6 +62,60 @@ class StoreEntry(models.Model):
     class Meta:
         db_table = "store_entry"
         ordering = ["-updated_time"]
+        indexes = [models.Index(fields=["user_id", "etype", "addr_depth"])]
 
     def __str__(self):
         return self.title[:30]
+
+
+class StoreSyncNode(models.Model):
+    """
+    Directory of the note hash tree used by sync, see sync_manifest
+    """
+    user_id = models.CharField(max_length=128)
+    path = models.CharField(max_length=400)  # "" for the root, otherwise ends with "/"
+    depth = models.IntegerField(default=0)  # number of "/" in path
+    hash = models.CharField(max_length=64, null=True, blank=True)
+    count = models.IntegerField(default=0)  # notes in the subtree
+    dirty = models.BooleanField(default=True)
+    updated_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "store_sync_node"
+        unique_together = ("user_id", "path")
+        indexes = [models.Index(fields=["user_id", "depth", "path"])]
+
+
+class StoreDirectory(models.Model):
+    """
+    Materialized directories of the note and file addrs, see dir_index
+    """
+    user_id = models.CharField(max_length=128)
+    etype = models.CharField(max_length=30)
+    path = models.CharField(max_length=400)  # "" for the root, otherwise ends with "/"
+    depth = models.IntegerField(default=0)  # number of "/" in path
+    count = models.IntegerField(default=0)  # entries in the subtree
+    dirty = models.BooleanField(default=True)
+    updated_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "store_directory"
+        unique_together = ("user_id", "etype", "path")
+        indexes = [models.Index(fields=["user_id", "etype", "depth", "path"])]
+
+
+class BookmarkClick(models.Model):
+    """
+    Append only visit events of bookmarks, the total is kept in meta["clicks"] of the entry
+    """
+    id = models.BigAutoField(primary_key=True)
+    user_id = models.CharField(max_length=128)
+    bookmark_id = models.UUIDField()  # idx of the StoreEntry
+    clicked_at = models.DateTimeField()
+
+    class Meta:
+        db_table = "store_bookmark_click"
+        indexes = [
+            models.Index(fields=["user_id", "clicked_at"]),
+            models.Index(fields=["bookmark_id", "clicked_at"]),
+        ]
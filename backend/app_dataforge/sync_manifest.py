@@ -0,0 +1,179 @@
+"""
+Hash tree of the notes of a user, for syncing by manifest
+
+Every directory has a node in store_sync_node. Its hash is the sha1 of the sorted lines
+    f\t<file name>\t<md5>     for every note directly in the directory
+    d\t<dir name>\t<hash>     for every subdirectory that holds notes
+joined by "\n", deleted notes are not part of it, so a client computes the same hashes
+from its local files. Writes mark the directories above the changed addrs dirty,
+a dirty node is recomputed from its own files and child nodes when it is read.
+"""
+
+import re
+import hashlib
+from collections import defaultdict
+from loguru import logger
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import StoreEntry, StoreSyncNode
+
+EMPTY_HASH = hashlib.sha1(b"").hexdigest()
+
+
+def get_dir(addr):
+    """
+    Directory of an addr, "" for the root
+    """
+    pos = addr.rfind("/")
+    return addr[: pos + 1] if pos >= 0 else ""
+
+
+def get_ancestors(addr):
+    """
+    All directories above an addr, the root first
+    """
+    ret = [""]
+    pos = addr.find("/")
+    while pos >= 0:
+        ret.append(addr[: pos + 1])
+        pos = addr.find("/", pos + 1)
+    return ret
+
+
+def get_dir_hash(files, dirs):
+    """
+    files: [(name, md5)], dirs: [(name, hash)] of the subdirectories holding notes
+    """
+    lines = [f"f\t{name}\t{md5 or ''}" for name, md5 in files]
+    lines += [f"d\t{name}\t{dir_hash}" for name, dir_hash in dirs]
+    return hashlib.sha1("\n".join(sorted(lines)).encode("utf-8")).hexdigest()
+
+
+def get_live_notes(uid):
+    return StoreEntry.objects.filter(user_id=uid, etype="note", block_id=0, is_deleted=False)
+
+
+class SyncManifest:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if SyncManifest.__instance is None:
+            SyncManifest()
+        return SyncManifest.__instance
+
+    def __init__(self):
+        if SyncManifest.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            SyncManifest.__instance = self
+
+    def mark_dirty(self, uid, addrs):
+        """
+        Called after notes were written, moved or deleted
+        """
+        paths = set()
+        for addr in addrs:
+            if addr:
+                paths.update(get_ancestors(addr))
+        if len(paths) == 0 or not StoreSyncNode.objects.filter(user_id=uid, path="").exists():
+            return  # the tree is built on the first read
+        table = StoreSyncNode._meta.db_table
+        try:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    f"INSERT INTO {table} (user_id, path, depth, hash, count, dirty, updated_time) "
+                    f"VALUES (%s, %s, %s, NULL, 0, TRUE, clock_timestamp()) "
+                    f"ON CONFLICT (user_id, path) DO UPDATE SET dirty = TRUE, updated_time = clock_timestamp()",
+                    [(uid, path, path.count("/")) for path in paths],
+                )
+        except Exception as e:
+            logger.warning(f"mark sync nodes dirty failed {e}")
+
+    def rebuild(self, uid):
+        """
+        Build the whole tree with one pass over the notes
+        """
+        files = defaultdict(list)  # dir -> [(name, md5)]
+        for addr, md5 in get_live_notes(uid).values_list("addr", "md5"):
+            if addr:
+                directory = get_dir(addr)
+                files[directory].append((addr[len(directory):], md5))
+        dirs = set()
+        for directory in files:
+            dirs.update(get_ancestors(directory + "x"))
+        children = defaultdict(list)  # dir -> [child dir]
+        for directory in dirs:
+            if directory != "":
+                children[get_dir(directory[:-1])].append(directory)
+
+        nodes = {}
+        for directory in sorted(dirs, key=lambda x: x.count("/"), reverse=True):
+            subdirs = [(child[len(directory):-1], nodes[child].hash) for child in children[directory]]
+            count = len(files[directory]) + sum(nodes[child].count for child in children[directory])
+            nodes[directory] = StoreSyncNode(
+                user_id=uid,
+                path=directory,
+                depth=directory.count("/"),
+                hash=get_dir_hash(files[directory], subdirs),
+                count=count,
+                dirty=False,
+            )
+        if "" not in nodes:
+            nodes[""] = StoreSyncNode(user_id=uid, path="", depth=0, hash=EMPTY_HASH, count=0, dirty=False)
+        with transaction.atomic():
+            StoreSyncNode.objects.filter(user_id=uid).delete()
+            StoreSyncNode.objects.bulk_create(list(nodes.values()), batch_size=1000)
+        logger.info(f"rebuild sync manifest {uid}, dirs {len(nodes)}")
+
+    def _refresh(self, uid, node):
+        """
+        Recompute a dirty node from its own notes and its child nodes
+        """
+        for child in StoreSyncNode.objects.filter(
+            user_id=uid, depth=node.depth + 1, path__startswith=node.path, dirty=True
+        ):
+            self._refresh(uid, child)
+        children = StoreSyncNode.objects.filter(
+            user_id=uid, depth=node.depth + 1, path__startswith=node.path, count__gt=0
+        ).values_list("path", "hash", "count")
+        files = (
+            get_live_notes(uid)
+            .filter(addr__startswith=node.path, addr__regex=r"^" + re.escape(node.path) + r"[^/]+$")
+            .values_list("addr", "md5")
+        )
+        files = [(addr[len(node.path):], md5) for addr, md5 in files]
+        subdirs = [(path[len(node.path):-1], dir_hash) for path, dir_hash, _count in children]
+        node.hash = get_dir_hash(files, subdirs)
+        node.count = len(files) + sum(count for _path, _hash, count in children)
+        # mark_dirty moves updated_time to clock_timestamp(), a write since the node was read
+        # keeps it dirty for the next read
+        updated = StoreSyncNode.objects.filter(pk=node.pk, updated_time=node.updated_time).update(
+            hash=node.hash, count=node.count, dirty=False, updated_time=timezone.now()
+        )
+        node.dirty = updated == 0
+
+    def get_nodes(self, uid, paths):
+        """
+        Return {path: {"hash", "count", "dirs": {name: hash}}} of the directories
+        """
+        if not StoreSyncNode.objects.filter(user_id=uid, path="").exists():
+            self.rebuild(uid)
+        ret = {}
+        for path in paths:
+            node = StoreSyncNode.objects.filter(user_id=uid, path=path).first()
+            if node is None:
+                ret[path] = {"hash": EMPTY_HASH, "count": 0, "dirs": {}}
+                continue
+            if node.dirty:
+                self._refresh(uid, node)
+            children = StoreSyncNode.objects.filter(
+                user_id=uid, depth=node.depth + 1, path__startswith=path, count__gt=0
+            ).values_list("path", "hash")
+            ret[path] = {
+                "hash": node.hash if node.count > 0 else EMPTY_HASH,
+                "count": node.count,
+                "dirs": {child[len(path):-1]: child_hash for child, child_hash in children},
+            }
+        return ret
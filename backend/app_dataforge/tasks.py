@@ -1,14 +1,9 @@
 from celery import shared_task
 from loguru import logger
 from user_tasks.models import UserTask
+from user_tasks.progress import ProgressReporter
 from .file_tools import real_import, update_files, real_refresh, real_delete, real_move
 
-def update_progress(progress, task_id):
-    task = UserTask.objects.get(task_id=task_id)
-    task.progress = progress
-    #logger.info(f"Task {task_id} progress: {progress}")
-    task.save()
-
 @shared_task(bind=True)
 def update_files_task(self, user_id, tmp_file_paths, filepaths, filemd5s, dic, vault, is_unzip, is_createSubDir):
     logger.info(f"Task {self.request.id} started with args: {user_id}, {tmp_file_paths}, {filepaths}, {filemd5s}, {dic}, {vault}, {is_unzip}, {is_createSubDir}")
@@ -19,30 +14,22 @@ def update_files_task(self, user_id, tmp_file_paths, filepaths, filemd5s, dic, v
             status='PENDING',
             task_name='update_task',
         )
+    reporter = ProgressReporter(self.request.id, user_id, 'update_task')
     try:
-        success_list, emb_status = update_files(
+        success_list, emb_status, stats = update_files(
             tmp_file_paths, filepaths, filemd5s, dic, vault, 
             is_unzip, is_createSubDir, 
-            progress_callback=update_progress,
+            progress_callback=reporter,
             task_id =self.request.id
         )
         if len(success_list) > 0:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'SUCCESS'
-            task.result = {'success_list': success_list, 'emb_status': emb_status}
-            task.save()
+            reporter.finish('SUCCESS', {'success_list': success_list, 'emb_status': emb_status, 'stages': stats})
         else:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': 'No files updated'}
-            task.save()
+            reporter.finish('FAILURE', {'error': 'No files updated'})
         return success_list
     except Exception as e:
         if user_id:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': str(e)}
-            task.save()
+            reporter.finish('FAILURE', {'error': str(e)})
         raise
 
 @shared_task(bind=True)
@@ -55,29 +42,21 @@ def import_task(self, user_id, process_list, debug=False):
             status='PENDING',
             task_name='import_task',
         )
+    reporter = ProgressReporter(self.request.id, user_id, 'import_task')
     try:
         success_list = real_import(
             user_id, process_list,
-            progress_callback=update_progress,
+            progress_callback=reporter,
             task_id = self.request.id,
         )
         if success_list is not None:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'SUCCESS' 
-            task.result = {'success_list': success_list}
-            task.save()
+            reporter.finish('SUCCESS', {'success_list': success_list})
         else:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': 'Import failed'}
-            task.save()            
+            reporter.finish('FAILURE', {'error': 'Import failed'})
         return success_list
     except Exception as e:
         if user_id:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': str(e)}
-            task.save()
+            reporter.finish('FAILURE', {'error': str(e)})
         raise
 
 @shared_task(bind=True)
@@ -90,29 +69,21 @@ def refresh_task(self, user_id, addr, etype, is_folder):
             status='PENDING',
             task_name='refresh_task',
         )
+    reporter = ProgressReporter(self.request.id, user_id, 'refresh_task')
     try:
         success_list = real_refresh(
             user_id, addr, etype, is_folder,
-            progress_callback=update_progress,
+            progress_callback=reporter,
             task_id = self.request.id,
         )
         if success_list is not None:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'SUCCESS' 
-            task.result = {'success_list': success_list}
-            task.save()
+            reporter.finish('SUCCESS', {'success_list': success_list})
         else:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': 'Refresh failed'}
-            task.save()            
+            reporter.finish('FAILURE', {'error': 'Refresh failed'})
         return success_list
     except Exception as e:
         if user_id:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': str(e)}
-            task.save()
+            reporter.finish('FAILURE', {'error': str(e)})
         raise
 
 @shared_task(bind=True)
@@ -125,29 +96,21 @@ def delete_task(self, user_id, path, etype, is_folder):
             status='PENDING',
             task_name='delete_task',
         )
+    reporter = ProgressReporter(self.request.id, user_id, 'delete_task')
     try:
         success_list = real_delete(
             user_id, path, etype, is_folder,
-            progress_callback=update_progress,
+            progress_callback=reporter,
             task_id = self.request.id,
         )
         if success_list is not None:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'SUCCESS'
-            task.result = {'success_list': success_list}
-            task.save()
+            reporter.finish('SUCCESS', {'success_list': success_list})
         else:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': 'Delete failed'}
-            task.save()
+            reporter.finish('FAILURE', {'error': 'Delete failed'})
         return success_list
     except Exception as e:
         if user_id:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': str(e)}
-            task.save()
+            reporter.finish('FAILURE', {'error': str(e)})
         raise
 
 @shared_task(bind=True)
@@ -160,27 +123,19 @@ def move_task(self, user_id, source, target, etype, is_folder):
             status='PENDING',
             task_name='move_task',
         )
+    reporter = ProgressReporter(self.request.id, user_id, 'move_task')
     try:
         success_list = real_move(
             user_id, source, target, etype, is_folder,
-            progress_callback=update_progress,
+            progress_callback=reporter,
             task_id = self.request.id,
         )
         if success_list is not None:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'SUCCESS'
-            task.result = {'success_list': success_list}
-            task.save()
+            reporter.finish('SUCCESS', {'success_list': success_list})
         else:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': 'Move failed'}
-            task.save()
+            reporter.finish('FAILURE', {'error': 'Move failed'})
         return success_list
     except Exception as e:
         if user_id:
-            task = UserTask.objects.get(task_id=self.request.id)
-            task.status = 'FAILURE'
-            task.result = {'error': str(e)}
-            task.save()
+            reporter.finish('FAILURE', {'error': str(e)})
         raise
\ No newline at end of file
@@ -124,11 +124,11 @@ class StoreEntryViewSet(viewsets.ModelViewSet):
                     )
                     return do_result(True, {"task_id": str(task_id)})
                 else:
-                    success_list, emb_status = update_files(tmp_file_paths, filepaths, filemd5s, dic, vault, is_unzip, is_createSubDir, debug=debug)
+                    success_list, emb_status, stats = update_files(tmp_file_paths, filepaths, filemd5s, dic, vault, is_unzip, is_createSubDir, debug=debug)
                     if debug:
                         logger.info(f"upload_files success {str(success_list)[:200]}..., emb_status {emb_status}")
                     else:
-                        logger.info(f"upload_files success {len(success_list)}, emb_status {emb_status}")
+                        logger.info(f"upload_files success {len(success_list)}, emb_status {emb_status}, stages {stats}")
                     if len(success_list) > 0:
                         return do_result(True, {"list": success_list, "emb_status": emb_status})
                     else:
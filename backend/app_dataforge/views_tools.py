@@ -27,6 +27,7 @@ from .entry_item import EntryItem
 from .models import StoreEntry
 from .tasks import import_task, refresh_task, delete_task, move_task
 from .file_tools import real_import, real_refresh, real_delete, real_move
+from .dir_index import DirectoryIndex, INDEXED_ETYPES
 
 
 MAX_LEVEL = 2
@@ -114,6 +115,30 @@ class EntryAPIView(APIView):
                 current_level = path_dict[current_path]['children']
         return current_level
 
+    def _indexed_tree(self, user_id, etype, path, level, debug=False):
+        """
+        Tree of the visible levels only: entries at most level deep and
+        the directories at level, which the client loads when they are opened
+        """
+        prefix = path.rstrip('/') + '/' if path else ""
+        entries = DirectoryIndex.get_entries(user_id, etype, prefix, level).only('idx', 'addr')
+        dirs = DirectoryIndex.get_instance().get_dirs(user_id, etype, prefix, level)
+        items = [(entry.addr, entry) for entry in entries]
+        items += [(dir_path, None) for dir_path in dirs]
+        items.sort(key=lambda x: x[0])
+        if debug:
+            logger.info(f'indexed tree entries: {len(entries)}, dirs: {len(dirs)}')
+
+        root = []
+        path_dict = {}
+        for addr, entry in items:
+            arr = addr[len(prefix):].rstrip('/').split('/')
+            if entry is None:
+                self._build_tree_node(path_dict, root, arr, path=path, is_last_level=True)
+            else:
+                self._build_tree_node(path_dict, root, arr, entry=entry, path=path)
+        return root
+
     def tree(self, request, debug=True):
         """
         Get file tree structure
@@ -132,6 +157,9 @@ class EntryAPIView(APIView):
             if debug:
                 logger.info(f'get file tree etype: {etype}, path: {path} level: {level}')
 
+            if etype in INDEXED_ETYPES and level != -1:
+                return Response(self._indexed_tree(user_id, etype, path, level, debug=debug))
+
             query_conditions = {
                 'user_id': user_id,
                 'is_deleted': False,
@@ -397,39 +425,21 @@ class EntryAPIView(APIView):
             if not etype:
                 return do_result(False, "Etype is empty")
 
-            query_conditions = {
-                'user_id': user_id,
-                'etype': etype,
-                'is_deleted': False,
-                'block_id': 0
-            }
-
-            if path and len(path) > 0:
-                query_conditions['addr__startswith'] = path
-
-            entries = StoreEntry.objects.filter(**query_conditions).values_list('addr', flat=True)            
-            logger.debug(f"get_dir entries: {len(entries)}")
-            dirs = set()
-            for entry in entries:
-                if path and not entry.startswith(path):
-                    continue
-                    
-                rel_path = entry
-                if path:
-                    if len(entry) > len(path):
-                        rel_path = entry[len(path):].lstrip('/')
-                    else:
-                        continue
-
-                parts = rel_path.split('/')
-                if len(parts) > 1:
+            prefix = path.rstrip('/') + '/' if path else ""
+            if etype in INDEXED_ETYPES:
+                dirs = [
+                    dir_path.rstrip('/') for dir_path in
+                    DirectoryIndex.get_instance().get_dirs(user_id, etype, prefix)
+                ]
+            else:
+                entries = StoreEntry.objects.filter(
+                    user_id=user_id, etype=etype, is_deleted=False, block_id=0, addr__startswith=prefix
+                ).values_list('addr', flat=True)
+                dirs = set()
+                for entry in entries:
+                    parts = entry[len(prefix):].split('/')
                     for i in range(len(parts)-1):
-                        dir_path = '/'.join(parts[:i+1])
-                        if path:
-                            full_path = os.path.join(path, dir_path)
-                        else:
-                            full_path = dir_path
-                        dirs.add(full_path)
+                        dirs.add(prefix + '/'.join(parts[:i+1]))
 
             dir_list = sorted(list(dirs))            
             return do_result(True, {"dirs": dir_list})
@@ -5,6 +5,9 @@ import py7zr
 import patoolib
 from loguru import logger
 from backend.common.utils.file_tools import get_ext
+from backend.common.parser import converter
+from backend.common.parser.conversion_service import ConversionService
+from backend.common.user.user import UserManager
 from .feature import EntryFeatureTool
 from .entry import add_data
 
@@ -15,6 +18,23 @@ def is_compressed_file(path):
     ext = get_ext(path).lower()
     return ext in ['.zip', '.rar']
 
+def prefetch_conversions(dic_item, temp_dir):
+    """
+    Queue every extracted document on the conversion service before the files are stored
+    one by one, add_data then picks up the finished conversions instead of converting serially
+    """
+    user = UserManager.get_instance().get_user(dic_item["user_id"])
+    etype = dic_item.get("etype", "note")
+    if not ((etype == "note" and user.get("note_save_content")) or (
+        etype == "file" and user.get("file_save_content"))):
+        return
+    service = ConversionService.get_instance()
+    for root, _, files in os.walk(temp_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not converter.is_markdown(file_path) and converter.is_support(file_path):
+                service.submit(file_path, use_ocr=user.privilege.b_ocr)
+
 def uncompress_file(dic_item, tmp_path, is_createSubDir, progress_callback=None, task_id=None, debug=False):
     try:
         base_dir = os.path.dirname(dic_item["addr"])
@@ -42,6 +62,7 @@ def uncompress_file(dic_item, tmp_path, is_createSubDir, progress_callback=None,
             filename = os.path.basename(dic_item["addr"])
             total_files = sum([len(files) for _, _, files in os.walk(temp_dir)])
             processed_files = 0
+            prefetch_conversions(dic_item, temp_dir)
 
             for root, _, files in os.walk(temp_dir):
                 if debug: logger.debug(f"root {root} {files}")
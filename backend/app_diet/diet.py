@@ -218,6 +218,14 @@ def adjust_df(df, uid):
     return df
 
 
+def is_food_answer(answer):
+    try:
+        dic = json.loads(answer)
+        return "food" in dic and "calorie" in dic
+    except Exception:
+        return False
+
+
 class Food:
     # Write as singleton pattern
     __instance = None
@@ -375,7 +383,10 @@ class Food:
             question = 'If I say I ate "{name}", what food did I most likely eat? How many kilocalories per 100 grams does it have? Please return in json format, like: {demo}, do not answer any other content.'.format(
                 name=name, demo=demo
             )
-            ret, answer, _ = llm_query(uid, ROLE_DIET, question, "diet", debug=debug)
+            ret, answer, _ = llm_query(
+                uid, ROLE_DIET, question, "diet", use_cache=True,
+                validate=is_food_answer, cache_similar=True, debug=debug
+            )
             if ret:
                 dic = json.loads(answer)
                 self.add_food(dic["food"], dic["calorie"], debug=debug)
@@ -1,5 +1,4 @@
 import time
-from openai import OpenAI
 from swarm import Agent
 from loguru import logger
 from django.utils.translation import gettext as _
@@ -16,6 +15,7 @@ from app_message.session import Session
 from app_message.exsmarm import ExSmarm
 from backend.common.user.user import UserManager
 from backend.common.llm import llm_tools
+from backend.common.llm.llm_client import LLMClientRegistry
 from backend.common.user.resource import *
 from backend.common.utils.sys_tools import is_app_installed
 
@@ -63,7 +63,9 @@ class BaseAgentManager:
         logger.info(f'llm_info {llm_info}')
         
         try:
-            llm = OpenAI(base_url=llm_info.url, api_key=llm_info.api_key)
+            llm = LLMClientRegistry.get_instance().get_client(
+                "openai", llm_info.url, llm_info.api_key, llm_info.model_name
+            ).client
             client = ExSmarm(llm)
             transfer_functions = []
             for a in alist:
@@ -6,6 +6,8 @@ from django.utils.translation import gettext as _
 from backend.common.llm.llm_tools import LLMInfo, LLM_CUSTOM
 from backend.common.user.user import UserManager
 from backend.common.llm import llm_tools
+from backend.common.llm.llm_client import LLMClientRegistry
+from backend.common.files.utils_file import count_tokens
 
 class ChatEngine:
     def __init__(self, llm_info, sdata, debug=False):
@@ -15,27 +17,25 @@ class ChatEngine:
         if debug:
             logger.info(f"ChatEngine init: {llm_info}")
             
-        if llm_info.api_method == "gemini":
-            from google import generativeai
-            generativeai.configure(api_key=self.llm_info.api_key)
-            self.llm = generativeai.GenerativeModel(model_name=self.llm_info.model_name)
-        else:
-            from openai import OpenAI
-            self.llm = OpenAI(api_key=self.llm_info.api_key, base_url=self.llm_info.url)
-            logger.info(f"ChatEngine init: url {self.llm_info.url}")
+        self.llm_client = LLMClientRegistry.get_instance().get(llm_info)
+
+    def build_messages(self, input, prompt=None):
+        messages = []
+        if prompt:
+            messages.append({"role": "system", "content": prompt})
+        
+        context_messages = self.sdata.get_context_messages(self.llm_info.model_name)
+        formatted_msgs = [{"role": m.sender, "content": m.content} for m in context_messages]
+        messages.extend(formatted_msgs)
+        
+        messages.append({"role": "user", "content": input})
+        return messages
 
     def predict(self, input, prompt = None, debug=False):
         debug = True
         ret = True
         try:
-            messages = []
-            if prompt:
-                messages.append({"role": "system", "content": prompt})
-            
-            formatted_msgs = [{"role": m.sender, "content": m.content} for m in self.sdata.get_context_messages()]
-            messages.extend(formatted_msgs)
-            
-            messages.append({"role": "user", "content": input})
+            messages = self.build_messages(input, prompt)
             
             if debug:
                 logger.debug(f'messages {messages}')
@@ -51,18 +51,58 @@ class ChatEngine:
 
     def get_llm_response(self, messages) -> tuple[str, int]:
         if self.llm_info.api_method == "gemini":
-            response = self.llm.generate_content(messages)
-            question = "\n".join([m["content"] for m in messages])
-            token_count = self.llm.count_tokens(response.text + question).total_tokens
+            with self.llm_client.slot() as llm:
+                response = llm.generate_content(messages)
+                question = "\n".join([m["content"] for m in messages])
+                token_count = llm.count_tokens(response.text + question).total_tokens
             return response.text, token_count
         else:
-            response = self.llm.chat.completions.create(
-                messages=messages,
-                model=self.llm_info.model_name
-            )
+            with self.llm_client.slot() as llm:
+                response = llm.chat.completions.create(
+                    messages=messages,
+                    model=self.llm_info.model_name
+                )
             logger.info(f"chat by model: {self.llm_info.model_name}")
             return response.choices[0].message.content, response.usage.total_tokens
 
+    def stream_response(self, messages):
+        """
+        Yield the answer piece by piece as the model generates it,
+        self.token_count is set when the stream is finished. The stream holds a stream slot,
+        closing the generator (the reader went away) releases it
+        """
+        self.token_count = 0
+        if self.llm_info.api_method == "gemini":
+            answer = ""
+            with self.llm_client.stream_slot() as llm:
+                for chunk in llm.generate_content(messages, stream=True):
+                    if chunk.text:
+                        answer += chunk.text
+                        yield chunk.text
+                question = "\n".join([m["content"] for m in messages])
+                self.token_count = llm.count_tokens(answer + question).total_tokens
+        else:
+            answer = ""
+            with self.llm_client.stream_slot() as llm:
+                stream = llm.chat.completions.create(
+                    messages=messages,
+                    model=self.llm_info.model_name,
+                    stream=True,
+                )
+                try:
+                    for chunk in stream:
+                        if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                            answer += chunk.choices[0].delta.content
+                            yield chunk.choices[0].delta.content
+                finally:
+                    # also on GeneratorExit, the connection goes back to the pool
+                    stream.close()
+            # streamed chunks carry no usage with the pinned openai client
+            question = "\n".join([m["content"] for m in messages])
+            self.token_count = count_tokens(question + answer)
+            logger.info(f"stream chat by model: {self.llm_info.model_name}")
+
+
 def do_chat(sdata, debug=False):
     """
     Provides chat services for users.
@@ -102,4 +142,42 @@ def do_chat(sdata, debug=False):
     except Exception as e:
         logger.warning(f"failed: {e}")
         traceback.print_exc()
-        return False, _("chat_call_failed")
\ No newline at end of file
+        return False, _("chat_call_failed")
+
+
+def do_chat_stream(sdata, debug=False):
+    """
+    Same as do_chat, yield (ret, text) pieces of the answer while it is generated,
+    the usage is saved when the stream is finished
+    """
+    content = sdata.current_content
+    if content is not None:
+        content = content.strip()
+    start_time = time.time()
+    user = UserManager.get_instance().get_user(sdata.user_id)
+    prompt = user.get("llm_chat_prompt", "")
+
+    ret, desc = llm_tools.check_llm_limit(user, debug)
+    if not ret:
+        yield ret, desc
+        return
+
+    try:
+        engine_type = user.get("llm_chat_model", None)
+        llm_info = LLMInfo.get_info(engine_type, "llm_chat_model")
+        if llm_info.engine_type == LLM_CUSTOM:
+            yield True, "[" + _('custom') + "] "
+        engine = ChatEngine(llm_info, sdata)
+        messages = engine.build_messages(content, prompt)
+        stream = engine.stream_response(messages)
+        try:
+            for delta in stream:
+                yield True, delta
+        finally:
+            stream.close()
+        duration = time.time() - start_time
+        llm_tools.save_llm_usage(user, "chat", llm_info.get_desc(), duration, engine.token_count)
+    except Exception as e:
+        logger.warning(f"stream chat failed: {e}")
+        traceback.print_exc()
+        yield False, _("chat_call_failed")
@@ -0,0 +1,91 @@
+"""
+Context window of a chat session
+
+The token count of a message is computed once per model and kept on the message,
+the window is collected from the newest message backwards and reversed once.
+With CHAT_CONTEXT_SUMMARY the messages that fell out of the window are summarized
+by the llm in batches, the summary is kept on the session and sent as a system message.
+"""
+
+import os
+from loguru import logger
+
+from backend.common.files.utils_file import count_tokens
+from backend.common.llm.llm_hub import llm_query
+
+CHAT_CONTEXT_SUMMARY = os.getenv("CHAT_CONTEXT_SUMMARY", "False").lower() == "true"
+CHAT_SUMMARY_BATCH = 10  # messages out of the window before the summary is extended
+CHAT_SUMMARY_MAX_LENGTH = 1000
+SUMMARY_ROLE = "You summarize conversations so they can be continued later."
+DEFAULT_TOKEN_MODEL = "gpt-3.5-turbo"
+
+
+def get_message_tokens(message, model_name=DEFAULT_TOKEN_MODEL):
+    """
+    Tokens of the message for the model, memoized on the message
+    """
+    count = message.token_counts.get(model_name)
+    if count is None:
+        count = count_tokens(message.sender + message.content, model_name)
+        message.token_counts[model_name] = count
+    return count
+
+
+class ContextBuilder:
+    def __init__(self, count, max_tokens, model_name=None, use_summary=CHAT_CONTEXT_SUMMARY):
+        self.count = count
+        self.max_tokens = max_tokens
+        self.model_name = model_name or DEFAULT_TOKEN_MODEL
+        self.use_summary = use_summary
+
+    def select(self, messages):
+        """
+        Return the index of the first message in the window
+        """
+        start = max(len(messages) - self.count, 0)
+        if self.max_tokens <= 0:
+            return start
+        total_tokens = 0
+        for idx in range(len(messages) - 1, start - 1, -1):
+            total_tokens += get_message_tokens(messages[idx], self.model_name)
+            if total_tokens > self.max_tokens:
+                return idx + 1
+        return start
+
+    def update_summary(self, session, start):
+        """
+        Extend the summary of the session with the messages before start,
+        only once CHAT_SUMMARY_BATCH of them are not summarized yet
+        """
+        summary_idx = session.summary_idx
+        if summary_idx > start:  # the session was reloaded with fewer messages
+            summary_idx = 0
+        if start - summary_idx < CHAT_SUMMARY_BATCH:
+            return
+        lines = [f"{item.sender}: {item.content}" for item in session.messages[summary_idx:start]]
+        question = "Previous summary:\n{summary}\n\nNew messages:\n{messages}\n\n" \
+            "Update the summary with the new messages, keep names, facts and open questions, " \
+            "answer in the language of the conversation within {length} characters.".format(
+                summary=session.summary or "", messages="\n".join(lines), length=CHAT_SUMMARY_MAX_LENGTH
+            )
+        ret, answer, _detail = llm_query(session.user_id, SUMMARY_ROLE, question, "chat")
+        if ret:
+            session.summary = answer[:CHAT_SUMMARY_MAX_LENGTH * 2]
+            session.summary_idx = start
+        else:
+            logger.warning(f"summarize session {session.sid} failed {answer}")
+
+    def build(self, session):
+        """
+        Return the messages sent as context, the summary first when there is one
+        """
+        if self.count == 0:
+            return []
+        start = self.select(session.messages)
+        result = session.messages[start:]
+        if self.use_summary and start > 0:
+            self.update_summary(session, start)
+            if session.summary:
+                result = [session.get_summary_message()] + result
+        logger.info(f"max_tokens {self.max_tokens}, {len(session.messages)} -> {len(result)}")
+        return result
@@ -30,7 +30,8 @@ def search_data(sdata, dic={}):
         keyword = None
     logger.info(f"condition {condition}")
     queryset = get_entry_list(keyword, condition, 5)
-    df = pd.DataFrame(queryset.values())
+    # both the hybrid search and the filters give dicts
+    df = pd.DataFrame(list(queryset))
     arr = []
     for idx, item in df.iterrows():
         label = regular_str(item["title"], del_enter=True, max_length=25)
@@ -25,7 +25,7 @@ from app_dataforge.entry_storage import EntryStorage
 from .command import *
 from .function import *
 from .session import *
-from .chat_tools import do_chat
+from .chat_tools import do_chat, do_chat_stream
 from app_message.agent import agent_manager
 from app_message.agent import data_agent
 
@@ -63,59 +63,113 @@ def msg_search_detail(dic):
             return detail
     return _("failed_to_fetch_files")
 
+def route_message(sdata:Session):
+    """
+    Handle urls, selections and commands, return None when the content goes to chat
+    """
+    agent = agent_manager.AllAgentManager.get_instance()
+    content = sdata.current_content
+    ret = False
+    detail = _("unrecognized_command")
+    prev_cmd = sdata.get_cache("prev_cmd")
+
+    if is_valid_url(content):  # Enter Website
+        ret, detail = data_agent.msg_web_main(sdata)
+    if (not ret and prev_cmd is not None):  
+        # The previous conversation was asking the user to enter information
+        sdata.current_content = prev_cmd + " " + sdata.current_content
+        prev_cmd = sdata.set_cache("prev_cmd", None)
+        ret, detail = CommandManager.get_instance().msg_do_command(sdata)
+    if not ret: # Enter a numerical value
+        ret, detail = parse_select_number(sdata)
+    if not ret: # Enter Command
+        ret, detail = CommandManager.get_instance().msg_do_command(sdata)
+    if not ret: 
+        if content.startswith('/'):
+            ret, detail = CommandManager.get_instance().msg_do_command(sdata)
+            if not ret:
+                ret, detail = agent.do_command(sdata)
+        else:
+            return None
+        logger.info(f"content:{content} ret:{ret} detail:{detail}")
+    return ret, detail
+
+
+def finish_message(sdata:Session, content, detail):
+    """
+    Append the request and response to the session, return the detail with its sid
+    """
+    if not isinstance(detail, dict):
+        detail = {"type": "text", "info": detail}
+    if "info" in detail:
+        response = detail["info"]
+    else:
+        response = None
+    sid = SessionManager.get_instance().send_message(content, response, sdata)
+    detail["sid"] = sid
+    return detail
+
+
 def do_message(sdata:Session):
     """
     Handling WeChat Chat Entry
     """
 
-    agent = agent_manager.AllAgentManager.get_instance()
     try:
         content = sdata.current_content
         if pd.isnull(content) or content == "":
             return False, _("nothing_entered")
-        ret = False
-        detail = _("unrecognized_command")
-        prev_cmd = sdata.get_cache("prev_cmd")
-
-        if is_valid_url(content):  # Enter Website
-            ret, detail = data_agent.msg_web_main(sdata)
-        if (not ret and prev_cmd is not None):  
-            # The previous conversation was asking the user to enter information
-            sdata.current_content = prev_cmd + " " + sdata.current_content
-            prev_cmd = sdata.set_cache("prev_cmd", None)
-            ret, detail = CommandManager.get_instance().msg_do_command(sdata)
-        if not ret: # Enter a numerical value
-            ret, detail = parse_select_number(sdata)
-        if not ret: # Enter Command
-            ret, detail = CommandManager.get_instance().msg_do_command(sdata)
-        if not ret: 
-            if content.startswith('/'):
-                ret, detail = CommandManager.get_instance().msg_do_command(sdata)
-                if not ret:
-                    ret, detail = agent.do_command(sdata)
-            else:
-                ret = True
-                ret, detail = do_chat(sdata)
-                if ret:
-                    #sid = SessionManager.get_instance().send_message(content, detail, sdata)
-                    #detail = {"type": "text", "info": detail, "sid": sid}
-                    detail = {"type": "text", "info": detail}
+        result = route_message(sdata)
+        if result is None:
+            ret, detail = do_chat(sdata)
+            if ret:
+                detail = {"type": "text", "info": detail}
             logger.info(f"content:{content} ret:{ret} detail:{detail}")
-        if not isinstance(detail, dict):
-            detail = {"type": "text", "info": detail}
-        if "info" in detail:
-            response = detail["info"]
         else:
-            response = None
-        sid = SessionManager.get_instance().send_message(content, response, sdata)
-        detail["sid"] = sid
-        return True, detail
+            ret, detail = result
+        return True, finish_message(sdata, content, detail)
     except Exception as e:
         traceback.print_exc()
         logger.warning(f"do_message error {e}")
         return False, {"sid": sdata.sid, "info":_("failed_to_process_information")}
 
 
+def do_message_stream(sdata:Session):
+    """
+    Same as do_message, yield events for a streaming response:
+    {"type": "delta", "info": text} while the chat answer is generated,
+    then {"type": "done", "status": ret, "info": whole response, "sid": sid}
+    Non chat content gets the done event only
+    """
+    try:
+        content = sdata.current_content
+        if pd.isnull(content) or content == "":
+            yield {"type": "done", "status": False, "info": _("nothing_entered"), "sid": sdata.sid}
+            return
+        result = route_message(sdata)
+        if result is not None:
+            ret, detail = result
+            detail = finish_message(sdata, content, detail)
+            yield {**detail, "type": "done", "status": True, "rtype": detail.get("type")}
+            return
+
+        ret = True
+        answer = ""
+        for ret, delta in do_chat_stream(sdata):
+            if not ret:
+                answer = delta
+                break
+            answer += delta
+            yield {"type": "delta", "info": delta}
+        logger.info(f"content:{content} ret:{ret} stream length:{len(answer)}")
+        detail = finish_message(sdata, content, answer)
+        yield {"type": "done", "status": ret, "info": answer, "sid": detail["sid"]}
+    except Exception as e:
+        traceback.print_exc()
+        logger.warning(f"do_message_stream error {e}")
+        yield {"type": "done", "status": False, "info": _("failed_to_process_information"), "sid": sdata.sid}
+
+
 def parse_select_number(sdata):
     content = sdata.current_content
     content = content.strip().replace(".", "")
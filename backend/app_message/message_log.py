@@ -0,0 +1,133 @@
+"""
+Append-only log of chat messages, one store_message row per message
+
+Messages are queued when they are added to a session and written behind by one
+flusher thread with bulk_create, every MESSAGE_FLUSH_INTERVAL seconds or as soon as
+MESSAGE_FLUSH_BATCH rows are waiting. The request that adds an answer and the save of
+a session flush the queue themselves, so no answered message is only in memory.
+Sessions load only their last rows from the log.
+"""
+
+import queue
+import atexit
+import threading
+from loguru import logger
+from django.db import close_old_connections, transaction
+
+from .models import StoreMessage
+
+MESSAGE_FLUSH_INTERVAL = 1.0
+MESSAGE_FLUSH_BATCH = 200
+
+
+class MessageLog:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if MessageLog.__instance is None:
+            MessageLog()
+        return MessageLog.__instance
+
+    def __init__(self):
+        if MessageLog.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            MessageLog.__instance = self
+            self.queue = queue.Queue()
+            self.flush_lock = threading.Lock()
+            self.wake = threading.Event()
+            self.flusher = threading.Thread(target=self._run, daemon=True)
+            self.flusher.start()
+            atexit.register(self.flush)
+
+    @staticmethod
+    def to_row(session, sender, content, created_time, seq):
+        return StoreMessage(
+            user_id=session.user_id,
+            sender=sender,
+            rtype="text",
+            sid=session.sid,
+            sname=session.sname,
+            is_group=session.is_group,
+            content=content,
+            source=session.source,
+            created_time=created_time,
+            seq=seq,
+        )
+
+    def append(self, session, sender, content, created_time, seq):
+        self.queue.put(self.to_row(session, sender, content, created_time, seq))
+        if self.queue.qsize() >= MESSAGE_FLUSH_BATCH:
+            self.wake.set()
+
+    def _write(self, rows):
+        if len(rows) == 0:
+            return
+        try:
+            StoreMessage.objects.bulk_create(rows, batch_size=MESSAGE_FLUSH_BATCH)
+        except Exception as e:
+            logger.warning(f"write {len(rows)} messages failed {e}")
+
+    def _run(self):
+        while True:
+            self.wake.wait(MESSAGE_FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"flush messages failed {e}")
+            close_old_connections()
+
+    def flush(self):
+        """
+        Write everything queued now, e.g. before the log is read
+        """
+        with self.flush_lock:
+            while not self.queue.empty():
+                rows = []
+                while len(rows) < MESSAGE_FLUSH_BATCH:
+                    try:
+                        rows.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._write(rows)
+
+    def load(self, user_id, sid, count):
+        """
+        Return the last count messages of the session, oldest first,
+        seq keeps the order of messages written in the same instant
+        """
+        self.flush()
+        rows = StoreMessage.objects.filter(user_id=user_id, sid=sid).order_by("-created_time", "-seq")
+        if count > 0:
+            rows = rows[:count]
+        return list(reversed(rows.values("sender", "content", "created_time", "seq")))
+
+    def import_messages(self, session, messages, created_times):
+        """
+        Move the messages of a session saved before the log existed into it,
+        return True when they are in the log, also when an earlier import wrote them
+        """
+        if len(messages) == 0:
+            return True
+        if StoreMessage.objects.filter(
+            user_id=session.user_id, sid=session.sid,
+            created_time=created_times[0], content=messages[0].content,
+        ).exists():
+            return True
+        rows = [
+            self.to_row(session, item.sender, item.content, created_time, seq)
+            for seq, (item, created_time) in enumerate(zip(messages, created_times), 1)
+        ]
+        try:
+            with transaction.atomic():
+                StoreMessage.objects.bulk_create(rows, batch_size=MESSAGE_FLUSH_BATCH)
+        except Exception as e:
+            logger.warning(f"import {len(rows)} messages of {session.sid} failed {e}")
+            return False
+        return True
+
+    def delete(self, user_id, sid):
+        self.flush()
+        StoreMessage.objects.filter(user_id=user_id, sid=sid).delete()
@@ -16,10 +16,12 @@ class StoreMessage(models.Model):
     meta = models.JSONField(default=dict)
     source = models.CharField(max_length=32, null=True, blank=True)
     created_time = models.DateTimeField("date created")
+    seq = models.BigIntegerField(default=0)  # position in the session, orders messages of the same time
 
     def __str__(self):
-        return self.title
+        return f"{self.sid} {self.sender}"
 
     class Meta:
         db_table = "store_message"
-        ordering = ["-created_time"]
\ No newline at end of file
+        ordering = ["-created_time", "-seq"]
+        indexes = [models.Index(fields=["sid", "created_time"])]
\ No newline at end of file
@@ -1,7 +1,11 @@
+import time
+import uuid
+import threading
 from collections import OrderedDict
+from contextlib import contextmanager
 from loguru import logger
-from threading import Timer
 
+from django.core.cache import cache
 from django.utils import timezone
 from backend.common.utils.net_tools import do_result
 from backend.common.utils.sys_tools import get_timezone
@@ -11,9 +15,59 @@ from app_dataforge.entry import get_entry_list, add_data
 from app_dataforge.entry_item import EntryItem
 from app_dataforge.models import StoreEntry
 from app_dataforge.feature import DEFAULT_CATEGORY
-from backend.common.files.utils_file import count_tokens
+from .message_log import MessageLog
+from .context_builder import ContextBuilder
+
+MAX_SESSIONS = 200  # sessions kept in the process, the others are in the shared cache
+SESSION_CACHE_TIMEOUT = 24 * 3600
+SESSION_IDLE_SECONDS = 600  # idle sessions are saved and leave the process
+SESSION_FLUSH_INTERVAL = 2 * 60
+SESSION_FLUSH_LOCK_TIMEOUT = 60
+SESSION_VERSION_CHECK_INTERVAL = 0.5  # seconds a local session is used without a version check
+SESSION_LOCK_TIMEOUT = 10
+SESSION_LOCK_WAIT = 5  # seconds a worker waits for a session lock
+SESSION_LOCK_POLL = 0.05
+SESSION_UPDATE_RETRIES = 3  # lock waits before an update fails
+SESSION_SAVE_STEP = 10  # unsaved messages that trigger a save
+
+
+class SessionBusyError(Exception):
+    """The session lock could not be taken, the change was not applied"""
+    pass
+
+
+def get_session_cache_key(sid):
+    return f"chat_session_{sid}"
+
+
+def get_latest_session_key(user_id, source):
+    return f"chat_session_latest_{user_id}_{source}"
+
+
+@contextmanager
+def hold_lock(lock_key, timeout, wait=0):
+    """
+    Lock shared by the workers, yields False when it is not taken within wait seconds
+    """
+    deadline = time.time() + wait
+    while True:
+        try:
+            locked = cache.add(lock_key, 1, timeout)
+        except Exception as e:
+            logger.warning(f"lock {lock_key} error {e}")
+            locked = True  # the cache is down, there is nothing to share the state with
+        if locked or time.time() >= deadline:
+            break
+        time.sleep(SESSION_LOCK_POLL)
+    try:
+        yield locked
+    finally:
+        if locked:
+            try:
+                cache.delete(lock_key)
+            except Exception:
+                pass
 
-MAX_SESSIONS = 1000
 
 class Message:
     def __init__(self, idx, sender, content, created_time):
@@ -21,6 +75,7 @@ class Message:
         self.sender = sender
         self.content = content
         self.created_time = created_time
+        self.token_counts = {}  # model -> tokens of sender and content
 
     def get_raw(self):
         raw = ""
@@ -54,6 +109,80 @@ class Session:
         self.meta = {}
         self.sync_idx = -1
         self.last_chat_time = timezone.now().astimezone(get_timezone())
+        self.summary = None  # rolling summary of the messages before summary_idx
+        self.summary_idx = 0
+        self.message_seq = 0  # seq of the last message written to the log
+        self.version = None
+
+    def to_payload(self):
+        return {
+            "sid": self.sid,
+            "user_id": self.user_id,
+            "sname": self.sname,
+            "is_group": self.is_group,
+            "source": self.source,
+            "cache": self.cache,
+            "status": self.status,
+            "atype": self.atype,
+            "ctype": self.ctype,
+            "meta": self.meta,
+            "sync_idx": self.sync_idx,
+            "last_chat_time": self.last_chat_time,
+            "messages": [item.to_dict() for item in self.messages],
+            "summary": self.summary,
+            "summary_idx": self.summary_idx,
+            "message_seq": self.message_seq,
+            "version": self.version,
+        }
+
+    def set_payload(self, payload):
+        self.sname = payload["sname"]
+        self.is_group = payload["is_group"]
+        self.source = payload["source"]
+        self.cache = payload["cache"]
+        self.status = payload["status"]
+        self.atype = payload["atype"]
+        self.ctype = payload["ctype"]
+        self.meta = payload["meta"]
+        self.sync_idx = payload["sync_idx"]
+        self.last_chat_time = payload["last_chat_time"]
+        self.messages = [
+            Message(idx, item["sender"], item["content"], item["created_time"])
+            for idx, item in enumerate(payload["messages"])
+        ]
+        self.summary = payload.get("summary")
+        self.summary_idx = payload.get("summary_idx", 0)
+        self.message_seq = payload.get("message_seq", 0)
+        self.version = payload["version"]
+
+    def publish(self):
+        """
+        Share the state with the other workers, a new version makes them reload it.
+        Compare and set: nothing is written when another worker published since this
+        state was read, use SessionManager.update_session to reload and apply a change.
+        """
+        with hold_lock(get_session_cache_key(self.sid) + "_lock", SESSION_LOCK_TIMEOUT, SESSION_LOCK_WAIT) as locked:
+            if not locked:
+                logger.warning(f"publish session {self.sid} lock timeout")
+                return False
+            return self.publish_locked()
+
+    def publish_locked(self):
+        """
+        publish() with the session lock held by the caller
+        """
+        key = get_session_cache_key(self.sid)
+        try:
+            payload = cache.get(key)
+            if payload is not None and payload["version"] != self.version:
+                logger.info(f"publish session {self.sid} conflict, version {self.version} is stale")
+                return False
+            self.version = uuid.uuid4().hex
+            cache.set(key, self.to_payload(), SESSION_CACHE_TIMEOUT)
+            cache.set(get_latest_session_key(self.user_id, self.source), self.sid, SESSION_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"publish session {self.sid} error {e}")
+        return True
 
     def get_name(self):
         if self.sname is not None:
@@ -82,6 +211,7 @@ class Session:
             show_count = int(show_count)
     
         self.messages = []
+        self.message_seq = 0
         obj = None
         condition = {"user_id": self.user_id, "etype": "chat", "addr": self.sid}
         fields = [
@@ -111,20 +241,57 @@ class Session:
             self.atype = obj.atype
             self.ctype = obj.ctype
             self.meta = obj.meta
-            for idx, item in enumerate(obj.meta["messages"]):
-                self.messages.append(Message(idx, item["sender"], item["content"], item["created_time"]))
-            logger.debug(f"load_from_db success, sid {self.sid}, len {len(self.messages)}")
         else:
-            logger.warning(f"load_from_db failed, sid {self.sid}")
-        self.messages = self.messages[-show_count:]
+            logger.warning(f"load_from_db entry not found, sid {self.sid}")
+
+        legacy = (obj.meta.get("messages") or []) if obj is not None else []
+        imported = len(legacy) > 0 and self.import_legacy_messages(legacy)
+        rows = MessageLog.get_instance().load(self.user_id, self.sid, show_count)
+        for idx, item in enumerate(rows):
+            created_time = item["created_time"].astimezone(get_timezone()).strftime("%Y-%m-%d %H:%M:%S")
+            self.messages.append(Message(idx, item["sender"], item["content"], created_time))
+            self.message_seq = max(self.message_seq, item["seq"])
+        if imported:
+            self.meta.pop("messages", None)
+        elif len(rows) == 0 and len(legacy) > 0:
+            # the import failed, show them from the meta and try again on the next load
+            items = legacy[-show_count:] if show_count > 0 else legacy
+            for idx, item in enumerate(items):
+                self.messages.append(Message(idx, item["sender"], item["content"], item["created_time"]))
+        self.sync_idx = len(self.messages)  # loaded messages are saved already
+        logger.debug(f"load_from_db sid {self.sid}, len {len(self.messages)}")
+
+    def import_legacy_messages(self, items):
+        """
+        Sessions saved before the message log kept their messages in the entry meta,
+        return True once the log has them, one worker imports them at a time
+        """
+        messages = []
+        created_times = []
+        for idx, item in enumerate(items):
+            messages.append(Message(idx, item["sender"], item["content"], item["created_time"]))
+            created_times.append(get_timezone().localize(
+                timezone.datetime.strptime(item["created_time"], "%Y-%m-%d %H:%M:%S")
+            ))
+        lock_key = get_session_cache_key(self.sid) + "_import"
+        with hold_lock(lock_key, SESSION_LOCK_TIMEOUT, SESSION_LOCK_WAIT) as locked:
+            if not locked:
+                logger.warning(f"import legacy messages {self.sid} lock timeout")
+                return False
+            return MessageLog.get_instance().import_messages(self, messages, created_times)
 
     def save_to_db(self):
+        """
+        Update the chat entry, only the messages added since the last save are appended
+        to its content, the messages themselves are in the message log
+        """
         if self.is_logged_in() == False or len(self.messages) == 0:
             return
+        # the messages counted as saved by sync_idx must be in the log, not only in its queue
+        MessageLog.get_instance().flush()
             
-        messages = [item.to_dict() for item in self.messages]
-        content = self.get_raw()
-        self.meta.update({"sid": self.sid, "is_group": self.is_group, "messages": messages})
+        content = self.get_raw(self.messages[max(self.sync_idx, 0):])
+        self.meta.update({"sid": self.sid, "is_group": self.is_group})
         entry = EntryItem(
             user_id=self.user_id,
             etype="chat",
@@ -136,9 +303,11 @@ class Session:
             meta=self.meta,
         )
         
-        data = {'reduce_msg': self.reduce_message(), 'default_title': self.get_name(), 'content': content}
+        data = {'reduce_msg': self.reduce_message(), 'default_title': self.get_name(), 'append_content': content}
         ret, ret_emb, info = add_data(entry, data)
         logger.info(f"save_to_db entry: {ret}, {ret_emb}, {info}")
+        if ret and entry.ctype is not None:
+            self.ctype = entry.ctype  # the category is parsed once, not on every save
         
         self.sync_idx = len(self.messages)
         logger.info(f"sync_idx {self.sync_idx}, len {len(self.messages)}")
@@ -147,9 +316,11 @@ class Session:
         if self.sync_idx < len(self.messages):
             self.save_to_db()
 
-    def get_raw(self):
+    def get_raw(self, messages=None):
+        if messages is None:
+            messages = self.messages
         arr = []
-        for message in self.messages:
+        for message in messages:
             arr.append(message.get_raw())
         return "\n".join(arr)
 
@@ -175,6 +346,7 @@ class Session:
         StoreEntry.objects.filter(
             user_id=self.user_id, addr=sid
         ).delete()
+        MessageLog.get_instance().delete(self.user_id, sid)
         if sid == self.sid:
             self.messages = []
 
@@ -194,10 +366,11 @@ class Session:
         #created_time = timezone.now().astimezone(pytz.UTC)
         created_time = timezone.now().astimezone(get_timezone())
         self.messages.append(Message(len(self.messages), sender, content, created_time.strftime("%Y-%m-%d %H:%M:%S")))
+        if self.is_logged_in():
+            self.message_seq += 1
+            MessageLog.get_instance().append(self, sender, content, created_time, self.message_seq)
         self.last_chat_time = created_time
         logger.info(f"after add_messages, len {len(self.messages)}, sid {self.sid}")
-        if len(self.messages) - self.sync_idx > 10:
-            self.save_to_db()
 
     def reduce_message(self):
         string = ""
@@ -215,38 +388,29 @@ class Session:
                     break
         return string
 
-    def get_context_messages(self):
+    def get_summary_message(self):
+        return Message(-1, "system", "Summary of the earlier conversation:\n" + self.summary, "")
+
+    def get_context_messages(self, model_name=None):
         user = UserManager.get_instance().get_user(self.user_id)
         count = user.get("llm_chat_memory_count", DEFAULT_CHAT_LLM_MEMORY_COUNT)
         if isinstance(count, str):
             count = int(count)
-        if count == 0:
-            return []
         
         max_tokens = user.get("llm_chat_max_context_count", DEFAULT_CHAT_MAX_CONTEXT_COUNT)
         if isinstance(max_tokens, str):
             max_tokens = int(max_tokens)
 
-        recent_messages = self.messages[-count:]
-        if max_tokens > 0:
-            result_messages = []
-            total_tokens = 0
-            
-            for msg in reversed(recent_messages):
-                current_tokens = count_tokens(msg.sender + msg.content)
-                if total_tokens + current_tokens > max_tokens:
-                    break
-                total_tokens += current_tokens
-                result_messages.insert(0, msg)
-        else:
-            result_messages = recent_messages
-        logger.info(f"max_tokens {max_tokens}, {len(self.messages)} -> {len(recent_messages)} -> {len(result_messages)}")
-        return result_messages
+        return ContextBuilder(count, max_tokens, model_name).build(self)
 
 class SessionManager:
+    """
+    Sessions are kept in a bounded process local LRU, the shared cache holds the state of
+    every active session, so a sid resolves to the same session in any worker,
+    a local session is compared with it at most every SESSION_VERSION_CHECK_INTERVAL seconds.
+    One flusher thread saves the changed sessions and drops the idle ones.
+    """
     __instance = None
-    #TIMER_INTERVAL = 5 * 60 # 5 minutes
-    TIMER_INTERVAL = 2 * 60 # 2 minutes
 
     @staticmethod
     def get_instance():
@@ -255,102 +419,183 @@ class SessionManager:
         return SessionManager.__instance
 
     def __init__(self):
-        self.sessions = OrderedDict()
-        self.timer = None
+        self.sessions = OrderedDict()  # sid -> Session, least recently used first
+        self.checked_time = {}  # sid -> last version check
+        self.evicted = []  # sessions left the LRU before they were saved
+        self.lock = threading.Lock()
+        self.flusher = None
 
-    def check_session_cache(self):
-        logger.info("Check session cache")
+    @staticmethod
+    def _get_payload(sid):
+        try:
+            return cache.get(get_session_cache_key(sid))
+        except Exception as e:
+            logger.warning(f"get session {sid} from cache error {e}")
+            return None
+
+    def start_flusher(self):
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._run_flusher, daemon=True)
+                self.flusher.start()
+                logger.info("Session flusher started")
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(SESSION_FLUSH_INTERVAL)
+            try:
+                self.flush_sessions()
+            except Exception as e:
+                logger.warning(f"flush sessions error {e}")
+
+    def flush_sessions(self):
+        """
+        Save the sessions with new messages, idle ones also leave the process
+        """
         current_time = timezone.now().astimezone(get_timezone())
-        sessions_to_remove = []
-        
-        for sid, session in self.sessions.items():
-            time_diff = current_time - session.last_chat_time
-            logger.info(f"sid {sid} time_diff {time_diff.total_seconds()}")
-            if time_diff.total_seconds() > 600:  # 600 second
-                session.close()
-                sessions_to_remove.append(sid)
-            else:
-                session.sync()
-        
-        for sid in sessions_to_remove:
-            self.sessions.pop(sid)
-            logger.info(f"Removed inactive session: {sid}")
-
-        if len(self.sessions) == 0:
-            self.stop_timer()
-
-    def start_timer(self):
-        logger.info('start_timer', self.timer)
-        if self.timer is None:
-            self.timer = Timer(self.TIMER_INTERVAL, self._timer_task)
-            self.timer.start()
-            logger.info("Timer started")
-
-    def _timer_task(self):
-        self.stop_timer()
-        logger.debug("Timer task triggered")
-        self.check_session_cache()
-        if len(self.sessions) > 0:
-            self.start_timer()
-        else:
-            logger.debug("No active session, timer stopped")
+        with self.lock:
+            sessions = list(self.sessions.values())
+            evicted = self.evicted
+            self.evicted = []
+        idle_sids = []
+        for session in sessions + evicted:
+            self.sync_session(session)
+            if (current_time - session.last_chat_time).total_seconds() > SESSION_IDLE_SECONDS:
+                idle_sids.append(session.sid)
+        with self.lock:
+            for sid in idle_sids:
+                self.sessions.pop(sid, None)
+                self.checked_time.pop(sid, None)
+        logger.debug(f"flush sessions {len(sessions)}, evicted {len(evicted)}, idle {len(idle_sids)}")
+
+    def reload_session(self, session):
+        payload = self._get_payload(session.sid)
+        if payload is None or payload["version"] == session.version:
+            return
+        if payload["user_id"] != session.user_id:
+            logger.warning(f"session {session.sid} in the cache belongs to another user")
+            return
+        session.set_payload(payload)
+
+    def update_session(self, session, func=None):
+        """
+        Apply func to the latest shared state of the session and publish it,
+        concurrent updates of one sid keep each other's changes.
+        Raise SessionBusyError when the lock is not taken, func is not applied then
+        """
+        lock_key = get_session_cache_key(session.sid) + "_lock"
+        for _ in range(SESSION_UPDATE_RETRIES):
+            with hold_lock(lock_key, SESSION_LOCK_TIMEOUT, SESSION_LOCK_WAIT) as locked:
+                if not locked:
+                    logger.warning(f"update session {session.sid} lock timeout, retry")
+                    continue
+                self.reload_session(session)
+                if func is not None:
+                    func(session)
+                session.publish_locked()
+                return
+        raise SessionBusyError(f"session {session.sid} is busy")
+
+    def sync_session(self, session, force=False):
+        """
+        Save the new messages of a session once, whichever worker gets here first,
+        force also saves a session without new messages and waits for the lock
+        """
+        self.reload_session(session)
+        if session.sync_idx >= len(session.messages) and not force:
+            return
+        lock_key = get_session_cache_key(session.sid) + "_flush"
+        wait = SESSION_LOCK_WAIT if force else 0
+        with hold_lock(lock_key, SESSION_FLUSH_LOCK_TIMEOUT, wait) as locked:
+            if not locked:
+                return
+            # the worker that held the lock may have saved the tail already
+            self.reload_session(session)
+            if session.sync_idx >= len(session.messages) and not force:
+                return
+            session.save_to_db()
+            sync_idx = session.sync_idx
+            ctype = session.ctype
+
+            def mark_synced(latest):
+                latest.sync_idx = max(latest.sync_idx, sync_idx)
+                latest.ctype = ctype
 
-    def stop_timer(self):
-        if self.timer is not None:
-            self.timer.cancel()
-            self.timer = None
+            try:
+                self.update_session(session, mark_synced)
+            except SessionBusyError as e:
+                # saved, the other workers only miss the new sync_idx until they save again
+                logger.warning(f"mark synced {e}")
 
-    def __del__(self):
-        self.stop_timer()
+    def _load_session(self, sid, user_id, is_group, source):
+        """
+        Return the session of the shared cache or the database, checked against the local one
+        """
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(sid)
+            if session is not None:
+                self.sessions.move_to_end(sid)
+                if now - self.checked_time.get(sid, 0) < SESSION_VERSION_CHECK_INTERVAL:
+                    return session
+
+        payload = self._get_payload(sid)
+        if (session is not None and session.user_id != user_id) or (
+            payload is not None and payload["user_id"] != user_id):
+            # never hand out or overwrite the session of another user
+            logger.warning(f"session {sid} belongs to another user, create a new one for {user_id}")
+            return Session.create_session(user_id, is_group, source)
+        if session is None:
+            session = Session(sid, user_id, is_group, source)
+            if payload is not None:
+                session.set_payload(payload)
+            else:
+                session.load_from_db()
+                try:
+                    self.update_session(session)
+                except SessionBusyError as e:
+                    logger.warning(f"publish loaded {e}")
+        elif payload is not None and payload["version"] != session.version:
+            session.set_payload(payload)
+        self.add_session(session)
+        return session
 
     def get_session_by_user(self, user_id, is_group, source):
         logger.info(f'get_session_by_user {user_id}, {is_group}, {source}')
-        # get last session from db
-        items = StoreEntry.objects.filter(is_deleted=False, user_id=user_id, etype="chat", source=source).order_by('-updated_time').values("addr", "title", "meta")[:1]
-        if len(items) > 0:
-            sid = items[0]["addr"]
-            if sid not in self.sessions:
-                session = Session(sid, user_id, is_group, source)
-                session.load_from_db()
-                self.add_session(session)
+        try:
+            sid = cache.get(get_latest_session_key(user_id, source))
+        except Exception as e:
+            logger.warning(f"get latest session error {e}")
+            sid = None
+        if sid is None:
+            # get last session from db
+            items = StoreEntry.objects.filter(is_deleted=False, user_id=user_id, etype="chat", source=source).order_by('-updated_time').values("addr")[:1]
+            if len(items) > 0:
+                sid = items[0]["addr"]
 
-        # get last session
-        current_session = None
-        most_recent_time = None
-        last_time = timezone.now().astimezone(get_timezone())
-        for sid, sess in self.sessions.items():
+        # check the session is active in 24 hour
+        if sid is not None:
+            current_session = self._load_session(sid, user_id, is_group, source)
             try:
-                if sess.user_id == user_id and sess.source == source:
-                    if len(sess.messages) == 0:
-                        logger.info(f'sid {sid}')
-                        if sid.rfind('_') != -1:
-                            time_str = sid.split('_')[-1]
-                            # sid: xx_20241128093936091810
-                            last_time = timezone.datetime.strptime(
-                                time_str,
-                                "%Y%m%d%H%M%S%f"
-                            ).replace(tzinfo=timezone.get_current_timezone())                    
-                    else:
-                        last_time = timezone.datetime.strptime(
-                            sess.messages[-1].created_time,
-                            "%Y-%m-%d %H:%M:%S"
-                        ).replace(tzinfo=timezone.get_current_timezone())
-                    if most_recent_time is None or last_time > most_recent_time:
-                        most_recent_time = last_time
-                        current_session = sess
+                if len(current_session.messages) == 0:
+                    # sid: xx_20241128093936091810
+                    time_str = current_session.sid.split('_')[-1]
+                    last_time = timezone.datetime.strptime(
+                        time_str,
+                        "%Y%m%d%H%M%S%f"
+                    ).replace(tzinfo=timezone.get_current_timezone())
+                else:
+                    last_time = timezone.datetime.strptime(
+                        current_session.messages[-1].created_time,
+                        "%Y-%m-%d %H:%M:%S"
+                    ).replace(tzinfo=timezone.get_current_timezone())
+                time_diff = timezone.now().astimezone(get_timezone()) - last_time
+                if time_diff <= timezone.timedelta(hours=24):
+                    return current_session
             except Exception as e:
                 logger.warning(f"get_session_by_user error {e}")
-        
-        # check the session is active in 24 hour
-        if current_session is not None and most_recent_time is not None:
-            time_diff = timezone.now().astimezone(get_timezone()) - most_recent_time
-            if time_diff > timezone.timedelta(hours=24):
-                current_session.close()
-                self.remove_session(current_session.sid)
-                current_session = None
-        
-        if current_session is not None:
-            return current_session
+            self.sync_session(current_session)
+            self.remove_session(current_session.sid)
             
         return Session.create_session(user_id, is_group, source)
         
@@ -359,39 +604,50 @@ class SessionManager:
             session = Session.create_session(user_id, is_group, source)
         elif sid == "" or sid is None or sid == 'null':
             session = self.get_session_by_user(user_id, is_group, source)
-        elif sid in self.sessions:
-            session = self.sessions[sid]
-        else: # session in db
-            session = Session(sid, user_id, is_group, source)
-            session.load_from_db()
+        else:
+            return self._load_session(sid, user_id, is_group, source)
         self.add_session(session)
         return session
     
     def add_session(self, session):
-        if session.sid not in self.sessions:
-            if len(self.sessions) >= MAX_SESSIONS:
-                oldest_sid, oldest_session = self.sessions.popitem(last=False)
-                oldest_session.close()
-            self.sessions[session.sid] = session        
-        # update visit position
-        if session.sid in self.sessions:
+        with self.lock:
+            self.sessions[session.sid] = session
+            # update visit position
             self.sessions.move_to_end(session.sid)
+            self.checked_time[session.sid] = time.time()
+            while len(self.sessions) > MAX_SESSIONS:
+                oldest_sid, oldest_session = self.sessions.popitem(last=False)
+                self.checked_time.pop(oldest_sid, None)
+                if oldest_session.sync_idx < len(oldest_session.messages):
+                    self.evicted.append(oldest_session)
 
     def rename_session(self, sdata, sid, sname):
         if sname is None or sid is None:
             return do_result(False, 'session not found')
-        if sid in self.sessions:
-            logger.info(f"sid {sid}, sessions {self.sessions.keys()}")
-            self.sessions[sid].sname = sname
-            self.sessions[sid].save_to_db()
+        session = self._load_session(sid, sdata.user_id, sdata.is_group, sdata.source)
+        if len(session.messages) > 0:
+            def rename(latest):
+                latest.sname = sname
+
+            try:
+                self.update_session(session, rename)
+            except SessionBusyError as e:
+                logger.warning(f"rename {e}")
+                return do_result(False, 'session busy, try again')
+            self.sync_session(session, force=True)
             return do_result(True, 'session renamed')
         else:
             logger.info(f'cannot get, rename session {sid} {sname}')
             return do_result(False, 'session not found')
 
     def remove_session(self, sid):
-        if sid in self.sessions:
-            self.sessions.pop(sid)
+        with self.lock:
+            self.sessions.pop(sid, None)
+            self.checked_time.pop(sid, None)
+        try:
+            cache.delete(get_session_cache_key(sid))
+        except Exception as e:
+            logger.warning(f"remove session {sid} from cache error {e}")
         return True
 
     def get_sessions(self, user_id):
@@ -414,7 +670,9 @@ class SessionManager:
                         d = timezone.now().astimezone(get_timezone())
                 sinfo[item["addr"]] = (item["title"], d)
         
-        for session in self.sessions.values():
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
             if session.user_id == user_id:
                 if session.sid not in sinfo:
                     sinfo[session.sid] = (session.get_name(), session.last_chat_time)
@@ -447,12 +705,14 @@ class SessionManager:
             sdata.close()
             self.remove_session(sdata.sid)
             sdata = Session.create_session(sdata.user_id, sdata.is_group, sdata.source)
-            self.add_session(sdata)
-        sdata.send_message(msg1, msg2)
-        if sdata.sid in self.sessions:
-            self.sessions.move_to_end(sdata.sid)
-
-        self.start_timer()
+        # the messages go on top of the latest state, not the one this request read
+        self.update_session(sdata, lambda latest: latest.send_message(msg1, msg2))
+        # the answer is written before the request returns, a worker that dies loses no message
+        MessageLog.get_instance().flush()
+        self.add_session(sdata)
+        self.start_flusher()
+        if len(sdata.messages) - sdata.sync_idx > SESSION_SAVE_STEP:
+            self.sync_session(sdata)
 
         logger.info(f'add_message ret {sdata.sid}')
         return sdata.sid
@@ -1,6 +1,8 @@
+import json
 import traceback
 from loguru import logger
 
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 from knox.auth import TokenAuthentication
 from django.utils.translation import gettext as _
@@ -70,6 +72,8 @@ class MessageAPIView(APIView):
             rtype = request.POST.get("rtype", "text")
             try:
                 if rtype == "text":
+                    if request.POST.get("stream", "false") == "true":
+                        return self.stream_message(sdata)
                     ret, detail = do_message(sdata)
                     logger.debug(f"{ret}, {detail}")
                     return do_result(ret, detail)
@@ -103,6 +107,19 @@ class MessageAPIView(APIView):
             else:
                 return do_result(True, {"type": "text", "info": detail, "sid": sdata.sid})
 
+    def stream_message(self, sdata):
+        """
+        Server-sent events, one "data: {json}" event per piece of the answer
+        """
+        def events():
+            for event in do_message_stream(sdata):
+                yield f"data: {json.dumps(event, ensure_ascii=False, default=str)}\n\n"
+
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # nginx must not buffer the stream
+        return response
+
     def upload_file(self, sdata, request):
         ret, path, filename = real_upload_file(request)
         if ret:
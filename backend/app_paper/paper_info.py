@@ -3,7 +3,7 @@ import re
 import json
 from easy_literature.arxiv import arxivInfo
 from scholarly import scholarly, ProxyGenerator
-from backend.common.llm.llm_hub import llm_query
+from backend.common.llm.llm_hub import llm_query, llm_query_async
 from django.utils.translation import gettext as _
 
 PAPER_ROLE = "You are a paper reading expert robot, automatically collecting, extracting, and summarizing effective information for students from the perspective of paper learning."
@@ -40,32 +40,53 @@ def get_title(string, debug=False):
         return string[:1000]
 
 
-def parse_paper_title(uid, string, debug=False):
-    """
-    Parse the description at the beginning of the paper, include institution
-    demo: ret_dic, total_tokens = parse_paper_title(xxx)
-    """
-    if string is None or len(string.strip()) == 0:
-        return {}, 0
+def get_paper_title_query(string):
     string = get_title(string)
-
     ret_format = '{"title":"","title_zh":"","author":"","institution":""}'
-    text = f"""
+    return f"""
 Below is the opening information of a paper, please return the information: English Title, Chinese Title (please translate the English Title to Chinese Title), Author, Institution; 
 where institution names should be translated into Chinese and deduplicated into a comma-separated string in dictionary format, 
 such as: {ret_format} Content as follows: '{string}'
 """
-    if debug:
-        print("req", text)
 
-    rt, answer, detail = llm_query(uid, PAPER_ROLE, text[:4096], "paper", debug=debug)
+
+def load_paper_title(answer):
     try:
-        answer = json.loads(answer)
+        return json.loads(answer)
     except Exception as e:
         print("failed", e)
         print("ret", answer)
-        answer = {}
-    return answer, detail["token_count"]
+        return {}
+
+
+def is_paper_title(answer):
+    try:
+        return isinstance(json.loads(answer), dict)
+    except Exception:
+        return False
+
+
+def parse_paper_title(uid, string, debug=False):
+    """
+    Parse the description at the beginning of the paper, include institution
+    demo: ret_dic, total_tokens = parse_paper_title(xxx)
+    """
+    if string is None or len(string.strip()) == 0:
+        return {}, 0
+    text = get_paper_title_query(string)
+    if debug:
+        print("req", text)
+
+    rt, answer, detail = llm_query(uid, PAPER_ROLE, text[:4096], "paper", use_cache=True, validate=is_paper_title, debug=debug)
+    return load_paper_title(answer), detail.get("token_count", 0)
+
+
+async def parse_paper_title_async(uid, string, debug=False):
+    if string is None or len(string.strip()) == 0:
+        return {}, 0
+    text = get_paper_title_query(string)
+    rt, answer, detail = await llm_query_async(uid, PAPER_ROLE, text[:4096], "paper", use_cache=True, validate=is_paper_title, debug=debug)
+    return load_paper_title(answer), detail.get("token_count", 0)
 
 
 def get_info_by_google(title, proxy=None, debug=False):
@@ -9,6 +9,7 @@ from loguru import logger
 from django.utils.translation import gettext as _
 from backend.common.parser import converter, pdf_parser, block
 from backend.common.llm.llm_hub import llm_query, llm_query_json
+from backend.common.llm.llm_hub import llm_query_async, llm_query_json_async, llm_run
 from backend.common.files import utils_file
 from backend.common.files import filecache
 from .paper_info import *
@@ -17,6 +18,7 @@ from .paper_info import *
 # Please summarize this paper in bullet points and structure the bullet points in different categories, out in Chinese.
 
 PAPER_ROLE = "You are an academic research expert, primarily specializing in the fields of computer science and medicine."
+TRANSLATE_CHUNK_LEN = 3500
 PAPER_KEYWORDS = [
     "Abstract",
     "Introduction",
@@ -123,23 +125,62 @@ def get_status(tags):
     return _("unknown")
 
 
+def get_translate_query(string, lang):
+    return f"""
+Please translate into {lang} and output only the translated {lang} content: '{string}'
+"""
+
+
+def split_text(string, max_length=TRANSLATE_CHUNK_LEN):
+    """
+    Split by lines into pieces of at most max_length
+    """
+    pieces = []
+    current = ""
+    for line in string.split("\n"):
+        while len(line) > max_length:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(line[:max_length])
+            line = line[max_length:]
+        if current and len(current) + len(line) + 1 > max_length:
+            pieces.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
 def translate_text(uid, string, lang="zh-CN", debug=False):
     """
-    Translation
+    Translation, long text is split into pieces translated concurrently
     """
     if string is None or len(string.strip()) == 0:
         return {}, 0
 
     if lang == "zh-CN":
         lang = _("chinese")
-    text = f"""
-Please translate into {lang} and output only the translated {lang} content: '{string}'
-"""
+    pieces = split_text(string)
     if debug:
-        print("req", text)
+        print("req", pieces[0][:100], "pieces", len(pieces))
+
+    if len(pieces) == 1:
+        ret, answer, detail = llm_query(
+            uid, PAPER_ROLE, get_translate_query(pieces[0], lang), "paper", debug=True
+        )
+        return answer, detail.get("token_count", 0)
 
-    ret, answer, detail = llm_query(uid, PAPER_ROLE, text[:4096], "paper", debug=True)
-    return answer, detail["token_count"]
+    results = llm_run(
+        [
+            llm_query_async(uid, PAPER_ROLE, get_translate_query(piece, lang), "paper")
+            for piece in pieces
+        ]
+    )
+    answer = "\n".join([answer for ret, answer, detail in results])
+    return answer, sum([detail.get("token_count", 0) for ret, answer, detail in results])
 
 
 def test_translate_text():
@@ -148,6 +189,18 @@ def test_translate_text():
     print(ret_all)
 
 
+PAPER_ABSTRACT_ROLE = "You are a paper reading expert robot, automatically collecting, extracting, and summarizing valid information for students from a paper learning perspective."
+
+
+def get_paper_abstract_query(string):
+    ret_format = '{"purpose": "xxx", "method": "xxx", "result": "xxx"}'
+    return f"""
+Please extract the following from the summary in the shortest, professional, and easy-to-understand language: purpose, method, experimental results.
+Return in json format, content in Chinese, as follows: {ret_format}
+Content is as follows: '{string}'
+"""
+
+
 def parse_paper_abstract(uid, string, debug=False):
     """
     Parse paper abstract
@@ -156,20 +209,24 @@ def parse_paper_abstract(uid, string, debug=False):
     if string is None or len(string.strip()) == 0:
         return {}, 0
 
-    sys_info = "You are a paper reading expert robot, automatically collecting, extracting, and summarizing valid information for students from a paper learning perspective."
-    ret_format = '{"purpose": "xxx", "method": "xxx", "result": "xxx"}'
-    text = f"""
-Please extract the following from the summary in the shortest, professional, and easy-to-understand language: purpose, method, experimental results.
-Return in json format, content in Chinese, as follows: {ret_format}
-Content is as follows: '{string}'
-"""
+    text = get_paper_abstract_query(string)
     if debug:
         print("req", text)
 
     ret, answer, detail = llm_query_json(
-        uid, sys_info, text[:4096], "paper", debug=True
+        uid, PAPER_ABSTRACT_ROLE, text[:4096], "paper", debug=True
+    )
+    return answer, detail.get("token_count", 0)
+
+
+async def parse_paper_abstract_async(uid, string, debug=False):
+    if string is None or len(string.strip()) == 0:
+        return {}, 0
+    text = get_paper_abstract_query(string)
+    ret, answer, detail = await llm_query_json_async(
+        uid, PAPER_ABSTRACT_ROLE, text[:4096], "paper", debug=debug
     )
-    return answer, detail["token_count"]
+    return answer, detail.get("token_count", 0)
 
 
 def get_doi_id(text):
@@ -338,13 +395,24 @@ def get_paper(dir_path, addr, save=True, debug=False):
 
 def parse_paper_info(uid, root_block, use_llm=True, debug=False):
     """
-    Using a large model to parse paper information
+    Using a large model to parse paper information,
+    the abstract and the title are parsed concurrently
     """
     info = {}
+    abstract_tokens = 0
+    title_tokens = 0
     ablock = block.get_block_by_heading(root_block, ["Abstract", _("abstract")])
     if ablock is not None:
-        if use_llm:
-            ret_dic, abstract_tokens = parse_paper_abstract(uid, ablock.get_text())
+        info["abstract"] = ablock.get_text()
+
+    if use_llm:
+        aws = [parse_paper_title_async(uid, root_block.get_text(), debug=debug)]
+        if ablock is not None:
+            aws.append(parse_paper_abstract_async(uid, ablock.get_text()))
+        results = llm_run(aws)
+        info_title, title_tokens = results[0]
+        if ablock is not None:
+            ret_dic, abstract_tokens = results[1]
             if "purpose" in ret_dic:
                 info["desc"] = ret_dic["purpose"][: pdf_parser.MAX_DESC_LEN]
                 info["purpose"] = ret_dic["purpose"][: pdf_parser.MAX_DESC_LEN]
@@ -352,12 +420,6 @@ def parse_paper_info(uid, root_block, use_llm=True, debug=False):
                 info["method"] = ret_dic["method"][: pdf_parser.MAX_DESC_LEN]
             if "result" in ret_dic:
                 info["result"] = ret_dic["result"][: pdf_parser.MAX_DESC_LEN]
-        info["abstract"] = ablock.get_text()
-
-    if use_llm:
-        info_title, title_tokens = parse_paper_title(
-            uid, root_block.get_text(), debug=debug
-        )
         print(f"### use_llm {info_title}")
         info.update(info_title)
     if debug:
@@ -12,15 +12,16 @@ from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from django.utils import timezone
 from django.utils.translation import gettext as _
-from django.db.models import Max
+from django.db.models import Max, Q
 from knox.auth import TokenAuthentication
 
 from backend.common.llm.embedding import embedding_manager
 from backend.common.user.utils import parse_common_args
 from backend.common.utils.net_tools import do_result
 
-from app_dataforge.entry import delete_entry, regerate_embedding
+from app_dataforge.entry import delete_entry, regerate_embeddings
 from app_dataforge.models import StoreEntry
+from app_dataforge.sync_manifest import SyncManifest
 
 
 class SyncAPIView(APIView):
@@ -42,6 +43,8 @@ class SyncAPIView(APIView):
         logger.info(f"rtype {rtype}")
         if rtype == "compare":
             return self.do_compare(args, request)
+        elif rtype == "manifest":
+            return self.do_manifest(args, request)
         elif rtype == "check_update": # check update status on server
             return self.check_update(args, request)
         elif rtype == "check_embedding":
@@ -57,26 +60,20 @@ class SyncAPIView(APIView):
             return file_dic
         new_dic = {}
         if include != "":
-            include_list = include.split(",")
+            include_list = tuple(include.split(","))
             for key, value in file_dic.items():
-                for item in include_list:
-                    if key.startswith(item):
-                        new_dic[key] = value
-                        break
+                if key.startswith(include_list):
+                    new_dic[key] = value
         else:
             new_dic = file_dic
         if exclude != "":
             exclude_list = exclude.split(",")
-            exclude_rules = []
-            for item in exclude_list:
-                rule = item.replace(".", "\.").replace("*", ".*")
-                exclude_rules.append(rule)
-            logger.warning(exclude_rules)
-            for key in list(new_dic.keys()):
-                for rule in exclude_rules:
-                    if re.search(rule, key):
-                        del new_dic[key]
-                        break
+            # one compiled pattern for all rules
+            exclude_rule = re.compile(
+                "|".join(item.replace(".", "\\.").replace("*", ".*") for item in exclude_list)
+            )
+            logger.warning(exclude_rule.pattern)
+            new_dic = {key: value for key, value in new_dic.items() if not exclude_rule.search(key)}
         logger.info(f"base_dic {len(file_dic)}, new_dic {len(new_dic)}")
         return new_dic
 
@@ -91,11 +88,11 @@ class SyncAPIView(APIView):
         emb_model = embedding_manager.get_model_name(uid)
         if emb_model is None:
             return do_result(False, {"emb_status": "no embedding model"})
-        for addr in addrs:
-            if regerate_embedding(uid, addr, emb_model) is False:
-                emb_status = "failed"
-                logger.warning(f"regerate embedding failed {addr}")
-                break
+        result = regerate_embeddings(uid, addrs, emb_model)
+        failed = [addr for addr, ret in result.items() if ret is False]
+        if len(failed) > 0:
+            emb_status = "failed"
+            logger.warning(f"regerate embedding failed {len(failed)} {failed[0]}...")
         return do_result(True, {"emb_status": emb_status})
 
     def do_check_embedding(self, args, request):
@@ -150,12 +147,34 @@ class SyncAPIView(APIView):
         else:
             return do_result(True, {"update": False})
     
+    @staticmethod
+    def get_vault_prefix(vault):
+        if vault is None or vault == "":
+            return ""
+        return vault if vault.endswith("/") else vault + "/"
+
+    def do_manifest(self, args, request):
+        """
+        Hashes of directories of the vault, see app_dataforge.sync_manifest
+        paths: json list of directories relative to the vault, "" is the vault itself.
+        The client compares them with the hashes of its local directories, descends
+        into the differing subdirectories only, then calls compare with these
+        directories as dirs and only their files
+        """
+        vault = self.get_vault_prefix(request.GET.get("vault", request.POST.get("vault", None)))
+        paths = json.loads(request.GET.get("paths", request.POST.get("paths", '[""]')))
+        nodes = SyncManifest.get_instance().get_nodes(args["user_id"], [vault + path for path in paths])
+        return do_result(True, {path: nodes[vault + path] for path in paths})
+
     def do_compare(self, args, request, debug=False):
         """
         Compare Local Files and Cloud Files
+        dirs (optional): json list of directories relative to the vault,
+        only the notes directly in them are compared, files holds just their files
         """
         vault = request.GET.get("vault", request.POST.get("vault", None))
         files = request.GET.get("files", request.POST.get("files", "[]"))
+        dirs = request.GET.get("dirs", request.POST.get("dirs", None))
         include = request.GET.get("include", request.POST.get("include", ""))
         exclude = request.GET.get("exclude", request.POST.get("exclude", ""))
         files = json.loads(files)
@@ -173,11 +192,19 @@ class SyncAPIView(APIView):
                 vault = vault + "/"
             entries = StoreEntry.objects.filter(
                 block_id=0, etype="note", addr__startswith=vault, user_id=uid
-            ).values("idx", "updated_time", "md5", "is_deleted", "addr")
+            )
         else:
             entries = StoreEntry.objects.filter(
                 block_id=0, etype="note", user_id=uid
-            ).values("idx", "updated_time", "md5", "is_deleted", "addr")
+            )
+        if dirs is not None:
+            prefix = vault or ""
+            query = Q(pk__in=[])
+            for item in json.loads(dirs):
+                path = prefix + item
+                query |= Q(addr__startswith=path, addr__regex=r"^" + re.escape(path) + r"[^/]+$")
+            entries = entries.filter(query)
+        entries = entries.values("idx", "updated_time", "md5", "is_deleted", "addr")
 
         cloud_dic = {}
         for entry in entries:
@@ -189,6 +189,7 @@ def translate_word_gpt(word, user_id, debug=False):
         req,
         "translate",
         # engine_type='deepseek',
+        use_cache=True,
         debug=False,
     )
     if ret:
@@ -204,7 +205,7 @@ def generate_sentence_example(user_id, word, debug=False):
     )
     try:
         ret, dic, detail = llm_query_json(
-            user_id, MSG_ROLE, query, "translate", debug=debug
+            user_id, MSG_ROLE, query, "translate", use_cache=True, debug=debug
         )
         if ret and dic is not None and "sentence" in dic and "sentence_meaning" in dic and "word_meaning" in dic:
             return True, dic
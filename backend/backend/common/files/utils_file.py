@@ -1,6 +1,7 @@
 import os
 import re
 import json
+import functools
 import chardet
 from chardet.universaldetector import UniversalDetector
 from langdetect import detect
@@ -143,11 +144,22 @@ def check_language_by_data(text):
         return "UNKNOWN"
 
 
+@functools.lru_cache(maxsize=32)
+def get_encoding(model_name="gpt-3.5-turbo"):
+    """
+    Encoder of the model, loaded once, models unknown to tiktoken use cl100k_base
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
 def count_tokens(string, model_name="gpt-3.5-turbo"):
     """
     Count the number of tokens
     """
-    enc = tiktoken.encoding_for_model(model_name)
+    enc = get_encoding(model_name)
     return len(enc.encode(string))
 
 
@@ -157,7 +169,7 @@ def count_file_token(path, model_name="gpt-3.5-turbo"):
     """
     with open(path, errors="ignone") as fp:
         data = fp.read()
-        enc = tiktoken.encoding_for_model(model_name)
+        enc = get_encoding(model_name)
         count = len(enc.encode(data))
         return count
     return -1
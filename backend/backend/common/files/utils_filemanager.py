@@ -109,7 +109,7 @@ class LocalFileManager:
             path_dst = os.path.join(self.base_path, uid, filename)
             file_dir = os.path.dirname(path_dst)
             if not os.path.exists(file_dir):
-                os.makedirs(file_dir)
+                os.makedirs(file_dir, exist_ok=True)  # concurrent saves may create it too
                 logger.debug(f"create dir {file_dir}")
             if not os.path.exists(path_dst) or not os.path.samefile(path, path_dst):
                 shutil.copyfile(path, path_dst)
@@ -144,9 +144,8 @@ class LocalFileManager:
         real_oldpath = f"{self.base_path}/{uid}/{oldpath}"
         real_newpath = f"{self.base_path}/{uid}/{newpath}"
         try:
-            target_dir = os.path.dirname(real_newpath)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
+            # folder moves rename in parallel, several renames create the same dir
+            os.makedirs(os.path.dirname(real_newpath), exist_ok=True)
 
             os.rename(real_oldpath, real_newpath)
             return True
@@ -0,0 +1,5 @@
+from django.apps import AppConfig
+
+
+class LlmConfig(AppConfig):
+    name = "backend.common.llm"
@@ -11,6 +11,7 @@ from django.utils.translation import gettext as _
 
 from backend.common.user.user import *
 from backend.common.user.resource import *
+from backend.common.llm.embedding_service import EmbeddingService
 
 EMBEDDING_CHUNK_SIZE = 512
 
@@ -74,6 +75,13 @@ class EmbeddingManager:
     
     def do_embedding(self, uid: str, all_splits: list, debug: bool = False) -> tuple:
         return self.get_embedding_tools(uid).do_embedding(all_splits, debug)
+
+    def submit_embedding(self, uid: str, all_splits: list, flush: bool = False) -> list:
+        """
+        Queue texts on the embedding service without waiting, return futures or None,
+        flush when the caller waits for them right away
+        """
+        return self.get_embedding_tools(uid).submit_embedding(all_splits, flush)
     
     def clear_user_cache(self, uid: str):
         keys_to_remove = [k for k in self._user_embeddings.keys() if k.startswith(f"{uid}_")]
@@ -241,6 +249,16 @@ class EmbeddingTools:
         
         return True
     
+    def submit_embedding(self, all_splits, flush=False):
+        if not self.use_embedding():
+            return None
+        model = self.get_model()
+        if model is None:
+            return None
+        return EmbeddingService.get_instance().submit(
+            self._current_config, model, all_splits, self.get_model_name(), flush
+        )
+
     def do_embedding(self, all_splits, debug=True):
         ret = False
         use_embedding = self.use_embedding()
@@ -261,7 +279,11 @@ class EmbeddingTools:
                         logger.info(f"embedding block model {model} {len(all_splits)} splits")
                         for idx, split in enumerate(all_splits):
                             logger.info(f"split: {idx}, len: {len(split)}, {split[:50]}...")
-                    embeddings = model.embed_documents(all_splits)
+                    # the caller blocks on the result, do not wait for other texts
+                    futures = EmbeddingService.get_instance().submit(
+                        self._current_config, model, all_splits, self.get_model_name(), flush=True
+                    )
+                    embeddings = EmbeddingService.wait(futures)
                     ret = True
                 else:
                     embeddings = [None for split in all_splits]
@@ -0,0 +1,144 @@
+"""
+Content addressed embedding cache, keyed by (emb_model, sha256(text))
+
+A small in-process LRU sits in front of the store_embedding_cache table,
+rows not read for EMBEDDING_CACHE_TTL_DAYS are removed by the cron job.
+"""
+
+import os
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from loguru import logger
+from django.utils import timezone
+from django_cron import CronJobBase, Schedule
+
+from .models import StoreEmbeddingCache
+
+EMBEDDING_CACHE_MEMORY_SIZE = 2000
+EMBEDDING_CACHE_TTL_DAYS = int(os.getenv("EMBEDDING_CACHE_TTL_DAYS", 30))
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", 2000000))
+
+
+def get_text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if EmbeddingCache.__instance is None:
+            EmbeddingCache()
+        return EmbeddingCache.__instance
+
+    def __init__(self):
+        if EmbeddingCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            EmbeddingCache.__instance = self
+            self.memory = OrderedDict()  # (emb_model, text_hash) -> embedding
+            self.lock = threading.Lock()
+            self.hits = 0
+            self.misses = 0
+
+    def _remember(self, key, embedding):
+        with self.lock:
+            self.memory[key] = embedding
+            self.memory.move_to_end(key)
+            while len(self.memory) > EMBEDDING_CACHE_MEMORY_SIZE:
+                self.memory.popitem(last=False)
+
+    def get_many(self, emb_model, texts):
+        """
+        Return {index: embedding} for the texts already in the cache
+        """
+        if emb_model is None or len(texts) == 0:
+            return {}
+        result = {}
+        db_hashes = {}  # text_hash -> [index]
+        for i, text in enumerate(texts):
+            key = (emb_model, get_text_hash(text))
+            with self.lock:
+                embedding = self.memory.get(key)
+                if embedding is not None:
+                    self.memory.move_to_end(key)
+            if embedding is not None:
+                result[i] = embedding
+            else:
+                db_hashes.setdefault(key[1], []).append(i)
+
+        if len(db_hashes) > 0:
+            try:
+                rows = StoreEmbeddingCache.objects.filter(
+                    emb_model=emb_model, text_hash__in=list(db_hashes.keys())
+                ).values_list("text_hash", "embeddings")
+                for text_hash, embedding in rows:
+                    embedding = list(embedding)
+                    self._remember((emb_model, text_hash), embedding)
+                    for i in db_hashes[text_hash]:
+                        result[i] = embedding
+                # refresh the access time at most once a day so hits don't rewrite rows
+                if len(rows) > 0:
+                    now = timezone.now()
+                    StoreEmbeddingCache.objects.filter(
+                        emb_model=emb_model,
+                        text_hash__in=[text_hash for text_hash, _emb in rows],
+                        accessed_time__lt=now - datetime.timedelta(days=1),
+                    ).update(accessed_time=now)
+            except Exception as e:
+                logger.warning(f"embedding cache read failed {e}")
+
+        self.hits += len(result)
+        self.misses += len(texts) - len(result)
+        return result
+
+    def put_many(self, emb_model, texts, embeddings):
+        if emb_model is None or len(texts) == 0:
+            return
+        objs = {}
+        for text, embedding in zip(texts, embeddings):
+            if embedding is None:
+                continue
+            text_hash = get_text_hash(text)
+            self._remember((emb_model, text_hash), embedding)
+            objs[text_hash] = StoreEmbeddingCache(
+                emb_model=emb_model, text_hash=text_hash, embeddings=embedding
+            )
+        try:
+            StoreEmbeddingCache.objects.bulk_create(
+                list(objs.values()), batch_size=500, ignore_conflicts=True
+            )
+        except Exception as e:
+            logger.warning(f"embedding cache write failed {e}")
+
+    def clear(self):
+        """
+        Remove expired rows, then the least recently used rows above EMBEDDING_CACHE_MAX_ROWS
+        """
+        with self.lock:
+            self.memory.clear()
+        expire_time = timezone.now() - datetime.timedelta(days=EMBEDDING_CACHE_TTL_DAYS)
+        count, _detail = StoreEmbeddingCache.objects.filter(accessed_time__lt=expire_time).delete()
+        logger.info(f"embedding cache removed {count} expired rows")
+        total = StoreEmbeddingCache.objects.count()
+        if total > EMBEDDING_CACHE_MAX_ROWS:
+            boundary = (
+                StoreEmbeddingCache.objects.order_by("-accessed_time")
+                .values_list("accessed_time", flat=True)[EMBEDDING_CACHE_MAX_ROWS]
+            )
+            count, _detail = StoreEmbeddingCache.objects.filter(accessed_time__lte=boundary).delete()
+            logger.info(f"embedding cache removed {count} least recently used rows")
+
+
+class ClearEmbeddingCacheCronJob(CronJobBase):
+    RUN_AT_TIMES = ["04:30"]
+
+    schedule = Schedule(run_at_times=RUN_AT_TIMES)
+    code = "backend.common.clear_embedding_cache_cron"
+
+    def do(self):
+        logger.info("cronjob clear embedding cache")
+        EmbeddingCache.get_instance().clear()
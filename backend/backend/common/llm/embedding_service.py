@@ -0,0 +1,193 @@
+"""
+Embedding service, one worker pool per (type, url, model) config,
+the apikey is part of the key as well so requests never run on another user's key.
+
+Texts submitted by any caller are queued, coalesced into provider sized batches
+and embedded by the pool, every text gets a Future of its vector. A caller that waits
+for its texts (a search query) submits them with flush, their batch is sent without
+waiting EMBEDDING_MAX_WAIT for more texts.
+At most EMBEDDING_MAX_BATCHERS configs keep a pool, the least recently used one is shut down.
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from loguru import logger
+
+from .embedding_cache import EmbeddingCache
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", 4))
+EMBEDDING_MAX_WAIT = 0.05  # seconds to wait for more texts before a batch is sent
+EMBEDDING_MAX_RETRIES = 3
+EMBEDDING_RETRY_DELAY = 1.0
+EMBEDDING_TIMEOUT = 300
+EMBEDDING_MAX_BATCHERS = int(os.getenv("EMBEDDING_MAX_BATCHERS", 32))
+
+
+class EmbeddingBatcher:
+    """
+    Queue and worker pool of one embedding config
+    """
+
+    def __init__(self, name, model, emb_model=None, batch_size=EMBEDDING_BATCH_SIZE, workers=EMBEDDING_WORKERS):
+        self.name = name
+        self.model = model
+        self.emb_model = emb_model
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.pending = {}  # text -> Future, identical pending texts share one request
+        self.lock = threading.Lock()
+        self.closed = False
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"embedding_{name}"
+        )
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, texts, flush=False):
+        """
+        Return one Future per text, None once the batcher is shut down,
+        flush sends the batch of the texts at once
+        """
+        futures = []
+        with self.lock:
+            if self.closed:
+                return None
+            for text in texts:
+                future = self.pending.get(text)
+                if future is None:
+                    future = Future()
+                    self.pending[text] = future
+                    self.queue.put((text, flush))
+                futures.append(future)
+        return futures
+
+    def _dispatch(self):
+        stopped = False
+        while not stopped:
+            item = self.queue.get()
+            if item is None:
+                break
+            text, flush = item
+            batch = [text]
+            deadline = time.time() + EMBEDDING_MAX_WAIT
+            while len(batch) < self.batch_size:
+                # after a flush text only the texts already queued join the batch
+                timeout = 0 if flush else deadline - time.time()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                text, text_flush = item
+                flush = flush or text_flush
+                batch.append(text)
+            self.executor.submit(self._embed_batch, batch)
+        # the submitted batches still finish
+        self.executor.shutdown(wait=False)
+        logger.info(f"EmbeddingService: batcher {self.name} stopped")
+
+    def _embed_batch(self, batch):
+        embeddings = None
+        error = None
+        for attempt in range(EMBEDDING_MAX_RETRIES):
+            try:
+                embeddings = self.model.embed_documents(batch)
+                break
+            except Exception as e:
+                error = e
+                if attempt + 1 == EMBEDDING_MAX_RETRIES:
+                    logger.warning(f"embedding batch {self.name} size {len(batch)} failed {e}, give up")
+                    break
+                delay = EMBEDDING_RETRY_DELAY * (2 ** attempt)
+                logger.warning(
+                    f"embedding batch {self.name} size {len(batch)} failed {e}, retry in {delay}s"
+                )
+                time.sleep(delay)
+
+        with self.lock:
+            futures = [self.pending.pop(text) for text in batch]
+        if embeddings is None or len(embeddings) != len(batch):
+            error = error or Exception("embedding result size mismatch")
+            for future in futures:
+                future.set_exception(error)
+        else:
+            for future, embedding in zip(futures, embeddings):
+                future.set_result(embedding)
+            EmbeddingCache.get_instance().put_many(self.emb_model, batch, embeddings)
+
+    def shutdown(self):
+        """
+        Stop taking texts, the queued ones are still embedded
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.put(None)
+
+
+class EmbeddingService:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if EmbeddingService.__instance is None:
+            EmbeddingService()
+        return EmbeddingService.__instance
+
+    def __init__(self):
+        if EmbeddingService.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            EmbeddingService.__instance = self
+            self.batchers = OrderedDict()  # config_key -> EmbeddingBatcher, least recently used first
+            self.lock = threading.Lock()
+
+    def get_batcher(self, config_key, model, emb_model=None):
+        evicted = []
+        with self.lock:
+            batcher = self.batchers.get(config_key)
+            if batcher is None:
+                batcher = EmbeddingBatcher(config_key, model, emb_model)
+                self.batchers[config_key] = batcher
+                logger.info(f"EmbeddingService: create batcher {config_key}")
+                while len(self.batchers) > EMBEDDING_MAX_BATCHERS:
+                    evicted.append(self.batchers.popitem(last=False)[1])
+            else:
+                self.batchers.move_to_end(config_key)
+        for item in evicted:
+            logger.info(f"EmbeddingService: evict batcher {item.name}")
+            item.shutdown()
+        return batcher
+
+    def submit(self, config_key, model, texts, emb_model=None, flush=False):
+        """
+        Return one Future per text, texts found in the embedding cache of emb_model
+        get a finished Future and never reach the provider
+        """
+        futures = [None] * len(texts)
+        cached = EmbeddingCache.get_instance().get_many(emb_model, texts)
+        for i, embedding in cached.items():
+            futures[i] = Future()
+            futures[i].set_result(embedding)
+        missing = [i for i in range(len(texts)) if i not in cached]
+        if len(missing) > 0:
+            submitted = None
+            while submitted is None:
+                # a batcher evicted after get_batcher returned it takes no texts, get a new one
+                batcher = self.get_batcher(config_key, model, emb_model)
+                submitted = batcher.submit([texts[i] for i in missing], flush)
+            for i, future in zip(missing, submitted):
+                futures[i] = future
+        return futures
+
+    @staticmethod
+    def wait(futures, timeout=EMBEDDING_TIMEOUT):
+        return [future.result(timeout=timeout) for future in futures]
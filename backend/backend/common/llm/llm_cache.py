@@ -0,0 +1,224 @@
+"""
+Response cache of deterministic LLM queries, keyed by (user, model, role, app, normalized prompt)
+
+Callers opt in with llm_query(..., use_cache=True), entries are never shared between users.
+A small in-process LRU sits in front of the store_llm_cache table, rows older than
+LLM_CACHE_TTL_DAYS are not used and are removed by the cron job together with the least
+recently used rows above LLM_CACHE_MAX_ROWS.
+With LLM_CACHE_SIMILARITY > 0 a miss of a caller passing similar=True also looks for a
+cached prompt of the same user, model, role and app whose embedding has at least this
+cosine similarity. Prompts that embed document content must not pass similar=True.
+"""
+
+import os
+import re
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict
+from loguru import logger
+from django.db.models import F
+from django.utils import timezone
+from django_cron import CronJobBase, Schedule
+from pgvector.django import CosineDistance
+
+from backend.common.user.resource import ResourceManager
+from .models import StoreLLMCache
+from .embedding import embedding_manager
+from .embedding_service import EmbeddingService
+
+LLM_CACHE_MEMORY_SIZE = 500
+LLM_CACHE_TTL_DAYS = int(os.getenv("LLM_CACHE_TTL_DAYS", 30))
+LLM_CACHE_MAX_ROWS = int(os.getenv("LLM_CACHE_MAX_ROWS", 200000))
+LLM_CACHE_SIMILARITY = float(os.getenv("LLM_CACHE_SIMILARITY", 0))  # 0 disables the lookup
+LLM_CACHE_EMBEDDING_TIMEOUT = 10
+
+
+def normalize_prompt(text):
+    """
+    Whitespace differences do not make a new prompt
+    """
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def get_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_prompt_hash(llm_model, role, question, app):
+    return get_hash("\n".join([llm_model, app, normalize_prompt(role), normalize_prompt(question)]))
+
+
+class LLMCache:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if LLMCache.__instance is None:
+            LLMCache()
+        return LLMCache.__instance
+
+    def __init__(self):
+        if LLMCache.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            LLMCache.__instance = self
+            self.memory = OrderedDict()  # (uid, prompt_hash) -> (answer, token_count, created timestamp)
+            self.lock = threading.Lock()
+            self.hits = 0
+            self.misses = 0
+
+    def _remember(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > LLM_CACHE_MEMORY_SIZE:
+                self.memory.popitem(last=False)
+
+    @staticmethod
+    def _get_embedding(uid, text):
+        """
+        Return (emb_model, embedding) of the prompt with the user's embedding model, or (None, None)
+        """
+        tools = embedding_manager.get_embedding_tools(uid)
+        futures = tools.submit_embedding([text], flush=True)
+        if not futures:
+            return None, None
+        embedding = EmbeddingService.wait(futures, timeout=LLM_CACHE_EMBEDDING_TIMEOUT)[0]
+        return tools.get_model_name(), embedding
+
+    def get(self, uid, llm_model, role, question, app, similar=False):
+        """
+        Return (answer, token_count) of a cached response of the user, None on a miss
+        """
+        prompt_hash = get_prompt_hash(llm_model, role, question, app)
+        key = (uid, prompt_hash)
+        expire_time = time.time() - LLM_CACHE_TTL_DAYS * 86400
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                if value[2] >= expire_time:
+                    self.memory.move_to_end(key)
+                else:
+                    del self.memory[key]
+                    value = None
+        if value is not None:
+            self.hits += 1
+            return value[0], value[1]
+
+        try:
+            expire = timezone.now() - datetime.timedelta(days=LLM_CACHE_TTL_DAYS)
+            data = StoreLLMCache.objects.filter(user_id=uid, created_time__gte=expire)
+            obj = data.filter(prompt_hash=prompt_hash).first()
+            if obj is None and similar and LLM_CACHE_SIMILARITY > 0:
+                emb_model, embedding = self._get_embedding(uid, normalize_prompt(question))
+                if embedding is not None:
+                    obj = (
+                        data.filter(
+                            llm_model=llm_model,
+                            app=app,
+                            role_hash=get_hash(normalize_prompt(role)),
+                            emb_model=emb_model,
+                        )
+                        .annotate(distance=CosineDistance("embeddings", embedding))
+                        .filter(distance__lte=1 - LLM_CACHE_SIMILARITY)
+                        .order_by("distance")
+                        .first()
+                    )
+            if obj is not None:
+                StoreLLMCache.objects.filter(id=obj.id).update(
+                    hit_count=F("hit_count") + 1, accessed_time=timezone.now()
+                )
+                self._remember(key, (obj.answer, obj.token_count, obj.created_time.timestamp()))
+                self.hits += 1
+                return obj.answer, obj.token_count
+        except Exception as e:
+            logger.warning(f"llm cache read failed {e}")
+        self.misses += 1
+        return None
+
+    def put(self, uid, llm_model, role, question, app, answer, token_count, similar=False):
+        prompt_hash = get_prompt_hash(llm_model, role, question, app)
+        self._remember((uid, prompt_hash), (answer, token_count, time.time()))
+        try:
+            emb_model, embedding = None, None
+            if similar and LLM_CACHE_SIMILARITY > 0:
+                emb_model, embedding = self._get_embedding(uid, normalize_prompt(question))
+            StoreLLMCache.objects.update_or_create(
+                user_id=uid,
+                prompt_hash=prompt_hash,
+                defaults={
+                    "llm_model": llm_model[:64],
+                    "app": app[:32],
+                    "role_hash": get_hash(normalize_prompt(role)),
+                    "answer": answer,
+                    "token_count": token_count,
+                    "emb_model": emb_model if embedding is not None else None,
+                    "embeddings": embedding,
+                    "created_time": timezone.now(),
+                    "accessed_time": timezone.now(),
+                },
+            )
+        except Exception as e:
+            logger.warning(f"llm cache write failed {e}")
+
+    def delete(self, uid, llm_model, role, question, app):
+        """
+        Drop a cached answer the caller could not use
+        """
+        prompt_hash = get_prompt_hash(llm_model, role, question, app)
+        with self.lock:
+            self.memory.pop((uid, prompt_hash), None)
+        try:
+            StoreLLMCache.objects.filter(user_id=uid, prompt_hash=prompt_hash).delete()
+        except Exception as e:
+            logger.warning(f"llm cache delete failed {e}")
+
+    @staticmethod
+    def save_hit(user, app, engine_type, token_count):
+        """
+        A hit is recorded as llm_cache usage, it does not count against the llm limit
+        """
+        dic = {
+            "token_count": token_count,
+            "engine_type": engine_type,
+            "duration": 0,
+            "cached": True,
+        }
+        try:
+            ResourceManager.get_instance().add(
+                user.user_id, app, "llm_cache", engine_type[:30], token_count, 0, "success", dic
+            )
+        except Exception as e:
+            logger.warning(f"save llm cache usage failed {e}")
+        return dic
+
+    def clear(self):
+        """
+        Remove expired rows, then the least recently used rows above LLM_CACHE_MAX_ROWS
+        """
+        with self.lock:
+            self.memory.clear()
+        expire_time = timezone.now() - datetime.timedelta(days=LLM_CACHE_TTL_DAYS)
+        count, _detail = StoreLLMCache.objects.filter(created_time__lt=expire_time).delete()
+        logger.info(f"llm cache removed {count} expired rows")
+        total = StoreLLMCache.objects.count()
+        if total > LLM_CACHE_MAX_ROWS:
+            boundary = (
+                StoreLLMCache.objects.order_by("-accessed_time")
+                .values_list("accessed_time", flat=True)[LLM_CACHE_MAX_ROWS]
+            )
+            count, _detail = StoreLLMCache.objects.filter(accessed_time__lte=boundary).delete()
+            logger.info(f"llm cache removed {count} least recently used rows")
+
+
+class ClearLLMCacheCronJob(CronJobBase):
+    RUN_AT_TIMES = ["04:40"]
+
+    schedule = Schedule(run_at_times=RUN_AT_TIMES)
+    code = "backend.common.clear_llm_cache_cron"
+
+    def do(self):
+        logger.info("cronjob clear llm cache")
+        LLMCache.get_instance().clear()
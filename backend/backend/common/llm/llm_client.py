@@ -0,0 +1,239 @@
+"""
+Registry of reusable LLM clients
+
+One client per endpoint and api key (per model for gemini) keeps its HTTP connection pool,
+so keep-alive and TLS sessions survive between queries. Every client limits the
+requests in flight, sync and async ones together, clients idle for
+LLM_CLIENT_IDLE_SECONDS are closed. Streamed answers last as long as their reader,
+they hold a slot of their own LLM_MAX_STREAMS limit instead.
+Async queries run on one long lived event loop thread, so their clients and
+connection pools are reused as well.
+
+    with LLMClientRegistry.get_instance().get(llm_info).slot() as client:
+        client.chat.completions.create(...)
+    async with LLMClientRegistry.get_instance().get(llm_info).async_slot() as client:
+        await client.chat.completions.create(...)
+    results = LLMClientRegistry.get_instance().run(coroutine)
+"""
+
+import os
+import time
+import asyncio
+import weakref
+import threading
+from contextlib import contextmanager, asynccontextmanager
+import httpx
+from loguru import logger
+from openai import OpenAI, AsyncOpenAI
+import google.generativeai as genai
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_STREAMS = int(os.getenv("LLM_MAX_STREAMS", 32))
+LLM_CLIENT_IDLE_SECONDS = 600
+LLM_KEEPALIVE_SECONDS = 60
+LLM_SLOT_POLL_SECONDS = 0.05
+
+
+class LLMClient:
+    def __init__(self, key, api_method, url, api_key, model_name):
+        self.key = key
+        self.api_method = api_method
+        self.api_key = api_key
+        self.model_name = model_name
+        self.semaphore = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        self.stream_semaphore = threading.BoundedSemaphore(LLM_MAX_STREAMS)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.last_used = time.time()
+        self.url = url
+        self.http_client = None
+        self.async_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncOpenAI
+        if api_method == "gemini":
+            self.client = genai.GenerativeModel(model_name=model_name)
+        else:
+            self.http_client = httpx.Client(
+                timeout=LLM_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONCURRENCY + LLM_MAX_STREAMS,
+                    max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                    keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+                ),
+            )
+            self.client = OpenAI(
+                base_url=url,
+                api_key=api_key,
+                timeout=LLM_TIMEOUT,
+                max_retries=LLM_MAX_RETRIES,
+                http_client=self.http_client,
+            )
+
+    def slot(self):
+        """
+        Hold one of the LLM_MAX_CONCURRENCY request slots of this client
+        """
+        return self._hold(self.semaphore)
+
+    def stream_slot(self):
+        """
+        Hold one of the LLM_MAX_STREAMS stream slots, a slow reader of a stream
+        does not take the slots of the other requests
+        """
+        return self._hold(self.stream_semaphore)
+
+    @contextmanager
+    def _hold(self, semaphore):
+        semaphore.acquire()
+        with self.lock:
+            self.in_use += 1
+        try:
+            if self.api_method == "gemini":
+                LLMClientRegistry.get_instance().configure_gemini(self.api_key)
+            yield self.client
+        finally:
+            with self.lock:
+                self.in_use -= 1
+                self.last_used = time.time()
+            semaphore.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        """
+        Same slots as slot(), waiting for one does not block the event loop
+        """
+        while not self.semaphore.acquire(blocking=False):
+            await asyncio.sleep(LLM_SLOT_POLL_SECONDS)
+        with self.lock:
+            self.in_use += 1
+        try:
+            yield self.get_async_client()
+        finally:
+            with self.lock:
+                self.in_use -= 1
+                self.last_used = time.time()
+            self.semaphore.release()
+
+    def get_async_client(self):
+        """
+        Async clients hold connections of one event loop, each running loop gets its own
+        """
+        if self.api_method == "gemini":
+            LLMClientRegistry.get_instance().configure_gemini(self.api_key)
+            return self.client
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            client = self.async_clients.get(loop)
+            if client is None:
+                client = AsyncOpenAI(
+                    base_url=self.url,
+                    api_key=self.api_key,
+                    timeout=LLM_TIMEOUT,
+                    max_retries=LLM_MAX_RETRIES,
+                    http_client=httpx.AsyncClient(
+                        timeout=LLM_TIMEOUT,
+                        limits=httpx.Limits(
+                            max_connections=LLM_MAX_CONCURRENCY,
+                            max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                            keepalive_expiry=LLM_KEEPALIVE_SECONDS,
+                        ),
+                    ),
+                )
+                self.async_clients[loop] = client
+            self.last_used = time.time()
+            return client
+
+    def close(self):
+        if self.http_client is not None:
+            self.http_client.close()
+        # async clients are closed on the loop they belong to
+        for loop, client in list(self.async_clients.items()):
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.close(), loop)
+
+
+class LLMClientRegistry:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if LLMClientRegistry.__instance is None:
+            LLMClientRegistry()
+        return LLMClientRegistry.__instance
+
+    def __init__(self):
+        if LLMClientRegistry.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            LLMClientRegistry.__instance = self
+            self.clients = {}  # key -> LLMClient
+            self.lock = threading.Lock()
+            self.gemini_key = None
+            self.loop = None
+            self.loop_thread = None
+
+    def get_loop(self):
+        """
+        The event loop of the async queries, started on first use
+        """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(
+                    target=self.loop.run_forever, name="llm_loop", daemon=True
+                )
+                self.loop_thread.start()
+            return self.loop
+
+    def run(self, coroutine):
+        """
+        Run a coroutine on the llm loop and wait for its result
+        """
+        loop = self.get_loop()
+        if threading.current_thread() is self.loop_thread:
+            coroutine.close()
+            raise RuntimeError("can not wait on the llm loop from inside it, await the coroutine")
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def configure_gemini(self, api_key):
+        """
+        genai keeps the api key globally, it is only set again when it changes
+        """
+        with self.lock:
+            if self.gemini_key != api_key:
+                genai.configure(api_key=api_key)
+                self.gemini_key = api_key
+
+    def _evict(self):
+        now = time.time()
+        for key, client in list(self.clients.items()):
+            if client.in_use == 0 and now - client.last_used > LLM_CLIENT_IDLE_SECONDS:
+                del self.clients[key]
+                try:
+                    client.close()
+                except Exception as e:
+                    logger.warning(f"close llm client failed {e}")
+
+    def get_client(self, api_method, url, api_key, model_name):
+        # openai clients are shared by the models of one endpoint
+        if api_method == "gemini":
+            key = (api_method, api_key, model_name)
+        else:
+            key = (api_method, url, api_key)
+        with self.lock:
+            self._evict()
+            client = self.clients.get(key)
+            if client is None:
+                if api_method == "gemini" and self.gemini_key != api_key:
+                    genai.configure(api_key=api_key)
+                    self.gemini_key = api_key
+                client = LLMClient(key, api_method, url, api_key, model_name)
+                self.clients[key] = client
+                logger.info(f"LLMClientRegistry: create client {api_method} {url} {model_name}")
+            client.last_used = time.time()
+            return client
+
+    def get(self, llm_info):
+        return self.get_client(
+            llm_info.api_method, llm_info.url, llm_info.api_key, llm_info.model_name
+        )
@@ -2,19 +2,72 @@ import os
 import re
 import time
 import json
+import asyncio
+import functools
 import traceback
 from loguru import logger
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
 from django.utils.translation import gettext as _
 
 from backend.common.llm import llm_tools
+from backend.common.llm.llm_cache import LLMCache
+from backend.common.llm.llm_client import LLMClientRegistry
 from backend.common.user.user import *
 from backend.common.user.resource import *
 from backend.common.utils import text_tools 
 
-def llm_query(uid, role, question, app, engine_type=None, llm_type='llm_tool_model', debug=False):
+LLM_GATHER_LIMIT = int(os.getenv("LLM_GATHER_LIMIT", 4))
+
+def get_cached_answer(user, llm_info, role, question, app, validate=None, similar=False):
+    """
+    Return (answer, usage dic) of a cached response, None on a miss,
+    an answer validate rejects is dropped from the cache
+    """
+    llm_cache = LLMCache.get_instance()
+    cached = llm_cache.get(user.user_id, llm_info.get_desc(), role, question, app, similar=similar)
+    if cached is None:
+        return None
+    answer, token_count = cached
+    if validate is not None and not validate(answer):
+        llm_cache.delete(user.user_id, llm_info.get_desc(), role, question, app)
+        return None
+    return answer, LLMCache.save_hit(user, app, llm_info.get_desc(), token_count)
+
+
+def put_cached_answer(uid, llm_info, role, question, app, answer, token_count, validate=None, similar=False):
+    """
+    Only answers the caller can use are cached
+    """
+    if validate is not None and not validate(answer):
+        return
+    LLMCache.get_instance().put(
+        uid, llm_info.get_desc(), role, question, app, answer, token_count, similar=similar
+    )
+
+
+def is_json_answer(answer):
+    return text_tools.parse_json(answer) is not None
+
+
+def llm_query(uid, role, question, app, engine_type=None, llm_type='llm_tool_model', use_cache=False,
+              validate=None, cache_similar=False, debug=False):
+    """
+    use_cache: deterministic lookups reuse the answer of the same user, model, role, app and prompt
+    validate: answers it rejects are not cached
+    cache_similar: also reuse answers of similar prompts, never for prompts with document content
+    """
     start_time = time.time()
     user = UserManager.get_instance().get_user(uid)
 
+    if use_cache:
+        llm_info = llm_tools.LLMInfo.get_info(engine_type or user.get(llm_type, None), llm_type)
+        cached = get_cached_answer(user, llm_info, role, question, app, validate, cache_similar)
+        if cached is not None:
+            if debug:
+                logger.debug(f"llm cache hit {app} {llm_info.get_desc()}")
+            return True, cached[0], cached[1]
+
     ret, desc = llm_tools.check_llm_limit(user, debug)
     if not ret:
         return ret, desc, {}
@@ -43,6 +96,10 @@ def llm_query(uid, role, question, app, engine_type=None, llm_type='llm_tool_mod
         if ret:
             duration = round(time.time() - start_time, 3)    
             dic = llm_tools.save_llm_usage(user, app, llm_info.get_desc(), duration, token_count)
+            if use_cache:
+                put_cached_answer(
+                    uid, llm_info, role, question, app, answer, token_count, validate, cache_similar
+                )
             if debug:
                 logger.debug("---------------------------")
                 logger.debug("Answer: {answer}...".format(answer=answer[:50]))
@@ -69,11 +126,126 @@ def find_first_json(s):
     return None
 
 
-def llm_query_json(uid, role, question, app, engine_type=None, debug=False):
-    ret, answer, dic = llm_query(uid, role, question, app, engine_type=engine_type, debug=debug)
+def llm_query_json(uid, role, question, app, engine_type=None, use_cache=False, debug=False):
+    ret, answer, dic = llm_query(
+        uid, role, question, app, engine_type=engine_type, use_cache=use_cache,
+        validate=is_json_answer, debug=debug
+    )
+    if ret:
+        json_object = text_tools.parse_json(answer)
+        if json_object is not None:
+            return ret, json_object, dic
+    return ret, {}, dic
+
+
+
+def _prepare_query(uid, engine_type, llm_type, debug=False):
+    """
+    Check the limit and resolve the model, return (user, llm_info, error)
+    """
+    user = UserManager.get_instance().get_user(uid)
+    ret, desc = llm_tools.check_llm_limit(user, debug)
+    if not ret:
+        return user, None, desc
+    if engine_type is None:
+        engine_type = user.get(llm_type, None)
+    return user, llm_tools.LLMInfo.get_info(engine_type, llm_type), None
+
+
+def sync_to_async_db(func):
+    """
+    sync_to_async for the database helpers of the llm loop, they run on a long lived
+    executor thread no request cycle cleans up, so its connection is dropped when it
+    is broken or older than CONN_MAX_AGE, before and after every call
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(wrapper)
+
+
+async def llm_query_async(uid, role, question, app, engine_type=None, llm_type='llm_tool_model', use_cache=False,
+                          validate=None, cache_similar=False, debug=False):
+    """
+    Same as llm_query on the async clients, settings and usage go through the database in a thread
+    """
+    start_time = time.time()
+    user, llm_info, desc = await sync_to_async_db(_prepare_query)(uid, engine_type, llm_type, debug)
+    if llm_info is None:
+        return False, desc, {}
+    if use_cache:
+        cached = await sync_to_async_db(get_cached_answer)(
+            user, llm_info, role, question, app, validate, cache_similar
+        )
+        if cached is not None:
+            return True, cached[0], cached[1]
+    try:
+        if llm_info.api_method == "gemini":
+            ret, answer, token_count = await llm_tools.query_gemini_async(
+                role, question, api_key=llm_info.api_key, model_name=llm_info.model_name, debug=debug
+            )
+        else:
+            ret, answer, token_count = await llm_tools.query_openai_async(
+                role,
+                question,
+                api_key=llm_info.api_key,
+                url=llm_info.url,
+                model_name=llm_info.model_name,
+                debug=debug,
+            )
+        if ret:
+            duration = round(time.time() - start_time, 3)
+            dic = await sync_to_async_db(llm_tools.save_llm_usage)(
+                user, app, llm_info.get_desc(), duration, token_count
+            )
+            if use_cache:
+                await sync_to_async_db(put_cached_answer)(
+                    uid, llm_info, role, question, app, answer, token_count, validate, cache_similar
+                )
+            if debug:
+                logger.debug("Answer: {answer}...".format(answer=answer[:50]))
+                logger.debug(f"desc: {dic}")
+            return ret, answer, dic
+    except Exception as e:
+        logger.warning(f"{engine_type} failed {e}")
+        traceback.print_exc()
+    return False, _("call_failed"), {"token_count": 0}
+
+
+async def llm_query_json_async(uid, role, question, app, engine_type=None, use_cache=False, debug=False):
+    ret, answer, dic = await llm_query_async(
+        uid, role, question, app, engine_type=engine_type, use_cache=use_cache,
+        validate=is_json_answer, debug=debug
+    )
     if ret:
         json_object = text_tools.parse_json(answer)
         if json_object is not None:
             return ret, json_object, dic
     return ret, {}, dic
 
+
+async def llm_gather(aws, limit=LLM_GATHER_LIMIT):
+    """
+    Await the queries with at most limit in flight, results keep the input order
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[run(aw) for aw in aws])
+
+
+def llm_run(aws, limit=LLM_GATHER_LIMIT):
+    """
+    Run llm_gather from synchronous code, e.g.
+        results = llm_run([llm_query_async(uid, role, q, "paper") for q in questions])
+    """
+    # one long lived loop, the async clients and their connections are reused between calls
+    return LLMClientRegistry.get_instance().run(llm_gather(aws, limit))
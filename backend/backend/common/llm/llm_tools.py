@@ -1,10 +1,9 @@
 import os
 import traceback
 from loguru import logger
-from openai import OpenAI
-import google.generativeai as genai
 from django.utils.translation import gettext as _
 from backend.common.user.resource import *
+from .llm_client import LLMClientRegistry
 LLM_DEFUALT = 'default'
 LLM_CUSTOM = 'custom'
 
@@ -133,12 +132,13 @@ def query_openai(
             logger.debug(f"api_key {api_key[:10]}...")
         else:
             logger.debug(f"api_key {api_key}")
-    client = OpenAI(base_url=url, api_key=api_key)
     message = [
         {"role": "system", "content": sys_info},
         {"role": "user", "content": text},
     ]
-    completion = client.chat.completions.create(model=model_name, messages=message)
+    llm_client = LLMClientRegistry.get_instance().get_client("openai", url, api_key, model_name)
+    with llm_client.slot() as client:
+        completion = client.chat.completions.create(model=model_name, messages=message)
 
     #print("completion", completion)
     if completion.choices is None or len(completion.choices) == 0:
@@ -156,8 +156,7 @@ def query_gemini(sys_info, text, api_key, model_name="gemini-pro", debug=False):
     """
     Query using Google's GenerativeAI API
     """
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel(model_name)
+    llm_client = LLMClientRegistry.get_instance().get_client("gemini", None, api_key, model_name)
     ret = ""
 
     if debug:
@@ -172,13 +171,73 @@ def query_gemini(sys_info, text, api_key, model_name="gemini-pro", debug=False):
         # If the generated length exceeds the set length, an error is raised directly
         # generation_config = genai.GenerationConfig(max_output_tokens=200)
         # response = model.generate_content(question, generation_config=generation_config)
-        response = model.generate_content(question)
+        with llm_client.slot() as model:
+            response = model.generate_content(question)
         ret = response.text
     except Exception as e:
         logger.warning(f"failed {e}")
         traceback.print_exc()
 
-    token_count = model.count_tokens(ret + question).total_tokens
+    with llm_client.slot() as model:
+        token_count = model.count_tokens(ret + question).total_tokens
+    if len(ret) == 0:
+        return False, _("gemini_is_temporarily_unavailable"), token_count
+    else:
+        return True, ret, token_count
+
+
+async def query_openai_async(
+    sys_info, text, api_key=None, url=None, model_name="gpt-3.5-turbo", debug=False
+):
+    """
+    Query using OpenAI's async API, same result as query_openai
+    """
+    if debug:
+        logger.debug(f"url {url}")
+        logger.debug(f"model_name {model_name}")
+    message = [
+        {"role": "system", "content": sys_info},
+        {"role": "user", "content": text},
+    ]
+    llm_client = LLMClientRegistry.get_instance().get_client("openai", url, api_key, model_name)
+    async with llm_client.async_slot() as client:
+        completion = await client.chat.completions.create(model=model_name, messages=message)
+
+    if completion.choices is None or len(completion.choices) == 0:
+        if "result" in completion:
+            ret = completion.result
+        else:
+            return False, "call llm failed", 0
+    else:
+        ret = completion.choices[0].message.content.strip()
+    token_count = completion.usage.total_tokens
+    return True, ret, token_count
+
+
+async def query_gemini_async(sys_info, text, api_key, model_name="gemini-pro", debug=False):
+    """
+    Query using Google's GenerativeAI async API, same result as query_gemini
+    """
+    llm_client = LLMClientRegistry.get_instance().get_client("gemini", None, api_key, model_name)
+    ret = ""
+
+    if debug:
+        logger.debug(f"model_name {model_name}")
+
+    if sys_info is not None and len(sys_info) > 0:
+        question = f"{sys_info}\n {text}"
+    else:
+        question = f"{text}"
+
+    async with llm_client.async_slot() as model:
+        try:
+            response = await model.generate_content_async(question)
+            ret = response.text
+        except Exception as e:
+            logger.warning(f"failed {e}")
+            traceback.print_exc()
+
+        token_count = (await model.count_tokens_async(ret + question)).total_tokens
     if len(ret) == 0:
         return False, _("gemini_is_temporarily_unavailable"), token_count
     else:
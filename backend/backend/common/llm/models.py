@@ -0,0 +1,45 @@
+from django.db import models
+from django.utils import timezone
+from pgvector.django import VectorField
+
+
+class StoreEmbeddingCache(models.Model):
+    emb_model = models.CharField(max_length=64)
+    text_hash = models.CharField(max_length=64)  # sha256 of the text
+    embeddings = VectorField(dimensions=None)
+    created_time = models.DateTimeField(auto_now_add=True)
+    accessed_time = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.emb_model} {self.text_hash}"
+
+    class Meta:
+        db_table = "store_embedding_cache"
+        unique_together = ("emb_model", "text_hash")
+        indexes = [models.Index(fields=["accessed_time"])]
+
+
+class StoreLLMCache(models.Model):
+    user_id = models.CharField(max_length=128)
+    llm_model = models.CharField(max_length=64)
+    app = models.CharField(max_length=32)
+    role_hash = models.CharField(max_length=64)  # sha256 of the role
+    prompt_hash = models.CharField(max_length=64)  # sha256 of model, role, app and normalized prompt
+    answer = models.TextField()
+    token_count = models.IntegerField(default=0)
+    emb_model = models.CharField(max_length=64, null=True, blank=True)
+    embeddings = VectorField(dimensions=None, null=True, blank=True)  # of the prompt, for near duplicates
+    hit_count = models.IntegerField(default=0)
+    created_time = models.DateTimeField(auto_now_add=True)
+    accessed_time = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.llm_model} {self.app} {self.prompt_hash}"
+
+    class Meta:
+        db_table = "store_llm_cache"
+        unique_together = ("user_id", "prompt_hash")
+        indexes = [
+            models.Index(fields=["accessed_time"]),
+            models.Index(fields=["user_id", "llm_model", "app", "role_hash"]),
+        ]
@@ -385,9 +385,9 @@ class Block:
             ret.extend(b.get_blocks())
         return ret
 
-    def to_md(self):
+    def to_md_head(self):
         """
-        Save as md
+        Markdown lines of this block itself, without the children
         """
         ret = []
         if self.is_heading():
@@ -422,7 +422,13 @@ class Block:
         else:
             ret.append(content)
             ret.append("")
+        return ret
 
+    def to_md(self):
+        """
+        Save as md
+        """
+        ret = self.to_md_head()
         try:
             for b in self.children:
                 ret.append(b.to_md())
@@ -534,6 +540,55 @@ class Block:
         return False
 
 
+class BlockStreamWriter:
+    """
+    Build the block tree incrementally and write markdown as soon as a part is complete.
+    Block.add only ever touches the last child of each level, so every other child
+    is finished, it is written and dropped, the tree keeps just the current heading path.
+    """
+
+    def __init__(self, fp, root_block):
+        self.fp = fp
+        self.root_block = root_block
+        self.head_written = set()  # id of blocks whose own lines are written
+
+    def _write_head(self, block):
+        if id(block) in self.head_written:
+            return
+        self.head_written.add(id(block))
+        lines = block.to_md_head()
+        if len(lines) > 0:
+            self.fp.write("\n".join(lines).replace("\n\n\n", "\n\n") + "\n")
+
+    def _write_rest(self, block):
+        self._write_head(block)
+        for child in block.children:
+            self._write_rest(child)
+        self.head_written.discard(id(block))
+        block.children = []
+        block.current_child = None
+
+    def add(self, block):
+        self.root_block.add(block)
+
+    def flush(self):
+        """
+        Write every finished block, keep the path of the last children
+        """
+        block = self.root_block
+        while block is not None:
+            self._write_head(block)
+            for child in block.children[:-1]:
+                self._write_rest(child)
+            block.children = block.children[-1:]
+            block = block.children[0] if len(block.children) > 0 else None
+        self.fp.flush()
+
+    def close(self):
+        self._write_rest(self.root_block)
+        self.fp.flush()
+
+
 def find_blocks_by_type(block, dtype):
     """
     Find all eligible subblocks from "block"
@@ -0,0 +1,274 @@
+"""
+Document conversion service
+
+converter.convert is CPU bound pure python, every job runs in its own process forked
+from a preloaded forkserver, so conversions use several cores, a job that runs too long
+is killed and RLIMIT_AS caps its memory. At most CONVERT_WORKERS jobs run at once.
+Daemonic processes such as celery prefork workers can not fork children, there every job
+is a python subprocess running conversion_worker with the same timeout and limits.
+
+    job_id = ConversionService.get_instance().submit(path_in)
+    ConversionService.get_instance().poll(job_id)  # {"status": "running", ...}
+    ret, md_path = ConversionService.get_instance().wait(job_id)
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import uuid
+import subprocess
+import resource
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from backend.common.files import filecache
+from backend.common.parser import converter
+
+CONVERT_WORKERS = int(os.getenv("CONVERT_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+CONVERT_TIMEOUT = int(os.getenv("CONVERT_TIMEOUT", 600))
+CONVERT_MEMORY_LIMIT_MB = int(os.getenv("CONVERT_MEMORY_LIMIT_MB", 2048))
+JOB_KEEP_SECONDS = 3600
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_SUCCESS = "success"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+
+LAUNCHER_FORK = "fork"  # forked from the preloaded forkserver
+LAUNCHER_SUBPROCESS = "subprocess"  # python -m conversion_worker, from daemonic processes
+LAUNCHER_THREAD = "thread"  # in the calling process, no timeout or memory limit
+RESULT_PREFIX = "CONVERSION_RESULT "
+
+
+def convert_job(path_in, path_out, kwargs, memory_limit):
+    """
+    Run one conversion in the current (job) process, return (ret, detail)
+    """
+    try:
+        if memory_limit > 0:
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        return converter.convert(path_in, path_out, **kwargs)
+    except MemoryError:
+        return False, "failed: memory limit exceeded"
+    except Exception as e:
+        return False, f"failed: {e}"
+
+
+def _run_job(path_in, path_out, kwargs, memory_limit, conn):
+    """
+    Entry of the forked job process
+    """
+    try:
+        # own process group, a timeout kills the page workers of the job too
+        os.setpgid(0, 0)
+        conn.send(convert_job(path_in, path_out, kwargs, memory_limit))
+    finally:
+        conn.close()
+
+
+def get_launcher():
+    if multiprocessing.current_process().daemon:
+        return LAUNCHER_SUBPROCESS
+    return LAUNCHER_FORK
+
+
+class ConversionJob:
+    def __init__(self, path_in, path_out, kwargs, timeout=CONVERT_TIMEOUT):
+        self.job_id = str(uuid.uuid4())
+        self.path_in = path_in
+        self.path_out = path_out
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.status = STATUS_PENDING
+        self.detail = None
+        self.future = None
+        self.created_time = time.time()
+        self.finished_time = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "path_out": self.path_out,
+            "detail": self.detail,
+        }
+
+
+class ConversionService:
+    __instance = None
+
+    @staticmethod
+    def get_instance():
+        if ConversionService.__instance is None:
+            ConversionService()
+        return ConversionService.__instance
+
+    def __init__(self):
+        if ConversionService.__instance is not None:
+            raise Exception("This class is a singleton!")
+        else:
+            ConversionService.__instance = self
+            self.jobs = {}  # job_id -> ConversionJob
+            self.sources = {}  # (path_in, options) -> job_id, a source is converted once
+            self.lock = threading.Lock()
+            self.executor = ThreadPoolExecutor(
+                max_workers=CONVERT_WORKERS, thread_name_prefix="conversion"
+            )
+            self.launcher = get_launcher()
+            self.context = multiprocessing.get_context("forkserver")
+            self.context.set_forkserver_preload(["backend.common.parser.conversion_worker"])
+            logger.info(f"ConversionService: {self.launcher} launcher, workers {CONVERT_WORKERS}")
+
+    def _execute(self, job):
+        job.status = STATUS_RUNNING
+        try:
+            return self._execute_job(job)
+        except Exception as e:
+            logger.warning(f"conversion {job.path_in} failed {e}")
+            return self._finish(job, STATUS_FAILED, f"failed: {e}")
+
+    def _execute_job(self, job):
+        if self.launcher == LAUNCHER_SUBPROCESS:
+            try:
+                return self._execute_subprocess(job)
+            except OSError as e:
+                logger.error(
+                    f"conversion subprocess of {job.path_in} failed to start {e}, "
+                    f"convert in this process WITHOUT timeout and memory limit"
+                )
+                return self._execute_thread(job)
+        if self.launcher == LAUNCHER_THREAD:
+            return self._execute_thread(job)
+        return self._execute_fork(job)
+
+    def _execute_thread(self, job):
+        ret, detail = converter.convert(job.path_in, job.path_out, **job.kwargs)
+        return self._finish(job, STATUS_SUCCESS if ret else STATUS_FAILED, detail)
+
+    def _execute_subprocess(self, job):
+        process = subprocess.Popen(
+            [
+                sys.executable, "-m", "backend.common.parser.conversion_worker",
+                job.path_in, job.path_out, json.dumps(job.kwargs),
+                str(CONVERT_MEMORY_LIMIT_MB * 1024 * 1024),
+            ],
+            stdout=subprocess.PIPE,
+            # own session and process group, a timeout kills the page workers of the job too
+            start_new_session=True,
+            cwd=BACKEND_DIR,
+        )
+        try:
+            stdout, _stderr = process.communicate(timeout=job.timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                process.kill()
+            process.communicate()
+            logger.warning(f"conversion timeout after {job.timeout}s {job.path_in}")
+            return self._finish(job, STATUS_TIMEOUT, f"failed: timeout after {job.timeout}s")
+
+        ret, detail = False, f"failed: worker exit code {process.returncode}"
+        for line in stdout.decode("utf-8", errors="ignore").splitlines():
+            # the parsers may print to stdout as well, the result is the marked line
+            if line.startswith(RESULT_PREFIX):
+                ret, detail = json.loads(line[len(RESULT_PREFIX):])
+        return self._finish(job, STATUS_SUCCESS if ret else STATUS_FAILED, detail)
+
+    def _execute_fork(self, job):
+        recv_conn, send_conn = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=_run_job,
+            args=(job.path_in, job.path_out, job.kwargs, CONVERT_MEMORY_LIMIT_MB * 1024 * 1024, send_conn),
+            # not daemonic, pdf_parser may parse long documents in child processes
+            daemon=False,
+        )
+        process.start()
+        send_conn.close()
+        timeout = job.timeout
+        if recv_conn.poll(timeout):
+            try:
+                ret, detail = recv_conn.recv()
+            except EOFError:
+                ret, detail = False, f"failed: worker exit code {process.exitcode}"
+            process.join(5)
+            recv_conn.close()
+            return self._finish(job, STATUS_SUCCESS if ret else STATUS_FAILED, detail)
+
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.kill()
+        process.join()
+        recv_conn.close()
+        logger.warning(f"conversion timeout after {timeout}s {job.path_in}")
+        return self._finish(job, STATUS_TIMEOUT, f"failed: timeout after {timeout}s")
+
+    def _finish(self, job, status, detail):
+        job.status = status
+        job.detail = detail
+        job.finished_time = time.time()
+        if status == STATUS_SUCCESS:
+            filecache.TmpFileManager.get_instance().add_file(job.path_out)
+        return status == STATUS_SUCCESS, job.path_out
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_time is not None and now - job.finished_time > JOB_KEEP_SECONDS:
+                del self.jobs[job_id]
+                for key, value in list(self.sources.items()):
+                    if value == job_id:
+                        del self.sources[key]
+
+    def submit(self, path_in, path_out=None, timeout=CONVERT_TIMEOUT, **kwargs):
+        """
+        Queue a conversion to markdown, return the job_id,
+        a source already queued with the same options returns the existing job
+        kwargs are passed to converter.convert, timeout (seconds) limits the job
+        """
+        kwargs.setdefault("force", True)
+        key = (path_in, tuple(sorted((k, str(v)) for k, v in kwargs.items())))
+        with self.lock:
+            self._prune()
+            job_id = self.sources.get(key)
+            if job_id is not None and job_id in self.jobs:
+                job = self.jobs[job_id]
+                if job.status in (STATUS_PENDING, STATUS_RUNNING, STATUS_SUCCESS) and (
+                    path_out is None or path_out == job.path_out):
+                    return job_id
+            if path_out is None:
+                path_out = filecache.get_tmpfile(".md")
+            job = ConversionJob(path_in, path_out, kwargs, timeout)
+            self.jobs[job.job_id] = job
+            self.sources[key] = job.job_id
+            job.future = self.executor.submit(self._execute, job)
+        return job.job_id
+
+    def poll(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return job.to_dict()
+
+    def wait(self, job_id, timeout=None):
+        """
+        Block until the job finished, return (ret, path_out)
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False, None
+        try:
+            return job.future.result(timeout=timeout)
+        except Exception as e:
+            logger.warning(f"wait conversion {job.path_in} failed {e}")
+            return False, job.path_out
+
+    def convert(self, path_in, path_out=None, **kwargs):
+        return self.wait(self.submit(path_in, path_out, **kwargs))
@@ -0,0 +1,29 @@
+"""
+Preloaded by the conversion forkserver, django and the parsers are imported once
+so every forked conversion job starts without paying for it again.
+Run as a script it converts one file, the job process of daemonic callers:
+
+    python -m backend.common.parser.conversion_worker <path_in> <path_out> <kwargs json> <memory limit>
+"""
+
+import os
+import sys
+import json
+import django
+from django.apps import apps
+
+if not apps.ready:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+    django.setup()
+    from django.db import connections
+
+    connections.close_all()  # conversion never touches the database
+
+from backend.common.parser import converter  # noqa: F401, E402
+
+
+if __name__ == "__main__":
+    from backend.common.parser.conversion_service import RESULT_PREFIX, convert_job
+
+    ret, detail = convert_job(sys.argv[1], sys.argv[2], json.loads(sys.argv[3]), int(sys.argv[4]))
+    print(RESULT_PREFIX + json.dumps([ret, str(detail)]), flush=True)
@@ -13,6 +13,9 @@ from .html_parser import HtmlParser
 from . import utils_md as tools_md
 from backend.common.files import utils_file as utils_file
 
+# bump when the output of a parser changes, cached conversion artifacts are keyed by it
+CONVERTER_VERSION = "1"
+
 
 def markdown_to_txt(path_in, path_out):
     """
@@ -94,6 +97,8 @@ def convert(path_in, path_out, **kwargs):
 
     if keywords is not None:
         parser.set_keywords(keywords)
+    if isinstance(parser, PDFParser) and parser.use_stream(kwargs.get("stream", None)):
+        return parser.save_stream(path_out, debug=debug)
     parser.root_block = parser.parse(parser.data, debug=debug)
     info = parser.get_meta_info()
 
@@ -12,6 +12,10 @@ Can solve the text in PDF, generating different titles based on different font s
 """
 
 import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import PyPDF2.generic
 import pdfplumber
 import PyPDF2
@@ -22,6 +26,7 @@ import fitz
 import traceback
 from .base_parser import BaseParser
 from .block import *
+from . import utils_md as tools_md
 from . import difflibparser as difflibparser
 from . import utils_tools as utils_tools
 from . import ocr_baidu as ocr_baidu
@@ -32,6 +37,11 @@ END_SYMBOL = ["。", "；"]
 DEFAULT_LANG = "zh-cn"
 MAX_DESC_LEN = 2048
 MAX_TITLE_LEN = 256
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES_PER_WORKER = 16
+PDF_STREAM_MIN_PAGES = int(os.getenv("PDF_STREAM_MIN_PAGES", 500))
+PDF_STREAM_WINDOW_PAGES = 8
+TOC_LOOKAHEAD = 3
 
 
 def is_near(x1, x2, size_list=None, debug=False):
@@ -411,6 +421,254 @@ def check_header_footer(block, page_height, percent=0.1, debug=False):
         return None
 
 
+def has_table_lines(fitz_page):
+    """
+    pdfplumber finds tables from ruling lines and rects, a page without any vector
+    drawing can not contain one, so extract_tables is skipped for it
+    """
+    try:
+        return len(fitz_page.get_drawings()) > 0
+    except Exception as e:
+        logger.warning(f"get drawings failed {e}")
+        return True
+
+
+def parse_pdf_page(
+    pdf_page,
+    fitz_page,
+    arr,
+    parse_table=True,
+    auto_detect=True,
+    keywords=None,
+    debug=False,
+):
+    """
+    Parse the text of one page into arr, return the page text
+    """
+    page_text = ""
+    if fitz_page is not None:
+        # font_list = fitz_page.get_fonts()
+        # for font_index in font_list:
+        #    print(font_index)
+        try:
+            text = fitz_page.get_text()
+            if pd.notnull(text) and len(text) > 0:
+                language = utils_file.check_language_by_data(text)
+                text_areas = fitz_page.get_text("dict")
+                page_height = text_areas["height"]
+                if debug:
+                    logger.info(
+                        f"  has {len(text_areas['blocks'])} blocks, language {language}"
+                    )
+                blocks = []
+                for bidx, t in enumerate(text_areas["blocks"]):
+                    b = PdfBlock(t, language)
+                    if not b.is_empty():
+                        if debug:
+                            logger.debug(b)
+                        # blocks.append(b)
+                        ptype = check_header_footer(t, page_height, debug=debug)
+                        if ptype is None:
+                            blocks.append(b)
+                        else:
+                            ftext = b.get_text().strip()
+                            if (
+                                ftext.isdigit() and int(ftext) > 0
+                            ):  # Page numbers may not necessarily match page_number
+                                if debug:
+                                    logger.debug(f"found page number {ftext}")
+                            else:
+                                blocks.append(b)
+
+                texts = [b.get_text() for b in blocks]
+                # for text in texts: # for test
+                #    logger.debug(f"@@@ {text[:30]}")
+                if parse_table:
+                    if has_table_lines(fitz_page):
+                        tables = pdf_page.extract_tables()
+                    else:
+                        tables = []
+                    PdfTable.merge_tables(
+                        texts,
+                        tables,
+                        arr,
+                        auto_detect=auto_detect,
+                        keywords=keywords,
+                        debug=debug,
+                    )
+                else:
+                    for b in blocks:
+                        text = b.get_text()
+                        arr_line = text.split("\n")
+                        for line in arr_line:
+                            arr.append(
+                                Block(
+                                    {"text": line, "auto_detect": auto_detect},
+                                    keywords=keywords,
+                                )
+                            )
+                page_text = "\n".join(texts)
+        except Exception as e:
+            logger.warning(f"Exception: {e}")
+            traceback.print_exc()
+    else:
+        text = pdf_page.extract_text()
+        if text is not None and len(text) > 0:
+            page_text = text
+            if debug:
+                logger.debug(f"  has text {len(text)}")
+            arr.append(
+                Block(
+                    {"text": text, "auto_detect": auto_detect},
+                    keywords=keywords,
+                )
+            )
+    return page_text
+
+
+def iter_pdf_pages(
+    path_in,
+    start,
+    end,
+    support_image=True,
+    use_fitz=True,
+    parse_table=True,
+    auto_detect=True,
+    use_ocr=False,
+    keywords=None,
+    debug=False,
+):
+    """
+    Parse pages [start, end) of the PDF one by one, both documents are opened once,
+    yield (pidx, page_arr, is_image) so only the current page is kept in memory
+    """
+    pdf_document = fitz.open(path_in) if use_fitz else None
+    try:
+        with pdfplumber.open(path_in) as pdf:
+            for pidx in range(start, end):
+                if debug:
+                    logger.debug(f"parse page {pidx}")
+                page = pdf.pages[pidx]
+                fitz_page = pdf_document.load_page(pidx) if use_fitz else None
+                page_arr = []
+
+                # Parsing Text
+                page_text = parse_pdf_page(
+                    page,
+                    fitz_page,
+                    page_arr,
+                    parse_table=parse_table,
+                    auto_detect=auto_detect,
+                    keywords=keywords,
+                    debug=debug,
+                )
+
+                # Extracting Image Data
+                if fitz_page is not None:
+                    image_num = len(fitz_page.get_images())
+                else:
+                    image_num = len(page.images)
+                if debug:
+                    logger.info(
+                        f"page:{pidx}, txt len:{len(page_text)}, has section image {image_num}"
+                    )
+                # if support_image and (len(page.images) > 0 or text is None): # for test
+                is_image = (
+                    support_image
+                    and (image_num > 0 or len(page_text) == 0)
+                    and len(page_text) < 50
+                )
+                if is_image:
+                    dir_path = os.path.join("/tmp/", utils_file.get_basename(path_in))
+                    if use_ocr:
+                        text = parse_image(dir_path, page, pidx, debug=debug)
+                    else:
+                        text = ""
+                    page_arr.append(
+                        Block({"text": text, "auto_detect": auto_detect}, keywords=keywords)
+                    )
+                # release the parsed objects of the page, long documents keep memory flat
+                page.flush_cache()
+                yield pidx, page_arr, is_image
+    finally:
+        if pdf_document is not None:
+            pdf_document.close()
+
+
+def parse_pdf_pages(path_in, start, end, **kwargs):
+    """
+    Parse pages [start, end) of the PDF, return (image_count, arr)
+    """
+    arr = []
+    image_count = 0
+    for _pidx, page_arr, is_image in iter_pdf_pages(path_in, start, end, **kwargs):
+        arr.extend(page_arr)
+        if is_image:
+            image_count += 1
+    return image_count, arr
+
+
+def can_parse_parallel():
+    """
+    Pages are parsed in forked processes, only safe from a single threaded, non daemonic
+    process such as a conversion job, other callers parse serially
+    """
+    if multiprocessing.current_process().daemon:
+        return False
+    return threading.active_count() == 1
+
+
+def get_page_shards(page_count, workers):
+    """
+    Split the pages into contiguous ranges, one per worker
+    """
+    shard_count = max(1, min(workers, page_count // PDF_PARALLEL_MIN_PAGES_PER_WORKER))
+    size = -(-page_count // shard_count)
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def iter_pdf_windows(path_in, page_count, workers=PDF_PARSE_WORKERS, **kwargs):
+    """
+    Parse the PDF in windows of PDF_STREAM_WINDOW_PAGES pages, yield (end, blocks) in page order.
+    The windows are parsed by the process pool, at most 2 * workers of them are in flight
+    so memory does not grow with the document
+    """
+    windows = [
+        (start, min(start + PDF_STREAM_WINDOW_PAGES, page_count))
+        for start in range(0, page_count, PDF_STREAM_WINDOW_PAGES)
+    ]
+    done = 0
+    if workers > 1 and len(windows) > 1 and can_parse_parallel():
+        try:
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                todo = iter(windows)
+                pending = deque()
+                for start, end in todo:
+                    pending.append((end, executor.submit(parse_pdf_pages, path_in, start, end, **kwargs)))
+                    if len(pending) >= workers * 2:
+                        break
+                while len(pending) > 0:
+                    end, future = pending.popleft()
+                    _image_count, arr = future.result()
+                    window = next(todo, None)
+                    if window is not None:
+                        pending.append((window[1], executor.submit(parse_pdf_pages, path_in, *window, **kwargs)))
+                    yield end, arr
+                    done = end
+            return
+        except Exception as e:
+            logger.warning(f"parse pdf windows in processes failed {e}, parse serially from page {done}")
+
+    window = []
+    for pidx, page_arr, _is_image in iter_pdf_pages(path_in, done, page_count, **kwargs):
+        window.extend(page_arr)
+        if (pidx + 1) % PDF_STREAM_WINDOW_PAGES == 0 or pidx + 1 == page_count:
+            yield pidx + 1, window
+            window = []
+
+
 def parse_pdf(
     path_in,
     page_limit=-1,
@@ -420,6 +678,7 @@ def parse_pdf(
     auto_detect=True,
     use_ocr=False,
     keywords=None,
+    workers=PDF_PARSE_WORKERS,
     debug=False,
 ):
     # def parse_pdf(path_in, page_limit = 5, support_image = True, use_fitz = True, parse_table = True, debug=False):
@@ -428,126 +687,53 @@ def parse_pdf(
     """
     Use two libraries simultaneously to parse PDF files, extracting text and images from the PDF
     auto_detect: Whether to automatically detect titles
+    workers: Long documents are split into page ranges parsed by several processes,
+             the blocks are merged in page order
     """
-    if use_fitz:
-        pdf_document = fitz.open(path_in)
-    arr = []
-    ret_info = {}
-    image_count = 0
     with pdfplumber.open(path_in) as pdf:
-        if debug:
-            logger.info(f"total page {len(pdf.pages)}")
-
-        for pidx, page in enumerate(pdf.pages):
-            if page_limit != -1 and pidx >= page_limit:
-                break
+        page_count = len(pdf.pages)
+    if debug:
+        logger.info(f"total page {page_count}")
+    if page_limit != -1:
+        page_count = min(page_count, page_limit)
+
+    kwargs = {
+        "support_image": support_image,
+        "use_fitz": use_fitz,
+        "parse_table": parse_table,
+        "auto_detect": auto_detect,
+        "use_ocr": use_ocr,
+        "keywords": keywords,
+        "debug": debug,
+    }
+    shards = get_page_shards(page_count, workers) if workers > 1 else [(0, page_count)]
+    results = None
+    if len(shards) > 1 and can_parse_parallel():
+        try:
+            with ProcessPoolExecutor(
+                max_workers=len(shards), mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                futures = [
+                    executor.submit(parse_pdf_pages, path_in, start, end, **kwargs)
+                    for start, end in shards
+                ]
+                results = [future.result() for future in futures]
             if debug:
-                logger.debug(f"parse page {pidx}")
-
-            # Parsing Text
-            page_text = ""
-            if use_fitz:
-                fitz_page = pdf_document.load_page(pidx)
-                # font_list = fitz_page.get_fonts()
-                # for font_index in font_list:
-                #    print(font_index)
-                try:
-                    text = fitz_page.get_text()
-                    if pd.notnull(text) and len(text) > 0:
-                        language = utils_file.check_language_by_data(text)
-                        text_areas = fitz_page.get_text("dict")
-                        page_height = text_areas["height"]
-                        if debug:
-                            logger.info(
-                                f"  has {len(text_areas['blocks'])} blocks, language {language}"
-                            )
-                        blocks = []
-                        for bidx, t in enumerate(text_areas["blocks"]):
-                            b = PdfBlock(t, language)
-                            if not b.is_empty():
-                                if debug:
-                                    logger.debug(b)
-                                # blocks.append(b)
-                                ptype = check_header_footer(t, page_height, debug=debug)
-                                if ptype is None:
-                                    blocks.append(b)
-                                else:
-                                    ftext = b.get_text().strip()
-                                    if (
-                                        ftext.isdigit() and int(ftext) > 0
-                                    ):  # Page numbers may not necessarily match page_number
-                                        if debug:
-                                            logger.debug(f"found page number {ftext}")
-                                    else:
-                                        blocks.append(b)
-
-                        texts = [b.get_text() for b in blocks]
-                        # for text in texts: # for test
-                        #    logger.debug(f"@@@ {text[:30]}")
-                        if parse_table:
-                            PdfTable.merge_tables(
-                                texts,
-                                page.extract_tables(),
-                                arr,
-                                auto_detect=auto_detect,
-                                keywords=keywords,
-                                debug=debug,
-                            )
-                        else:
-                            for b in blocks:
-                                text = b.get_text(language)
-                                arr_line = text.split("\n")
-                                for line in arr_line:
-                                    arr.append(
-                                        Block(
-                                            {"text": line, "auto_detect": auto_detect},
-                                            keywords=keywords,
-                                        )
-                                    )
-                        page_text = "\n".join(texts)
-                    else:
-                        page_text = ""
-                except Exception as e:
-                    logger.warning(f"Exception: {e}")
-                    traceback.print_exc()
-            else:
-                text = page.extract_text()
-                if text is not None and len(text) > 0:
-                    page_text = text
-                    if debug:
-                        logger.debug(f"  has text {len(text)}")
-                    arr.append(
-                        Block(
-                            {"text": text, "auto_detect": auto_detect},
-                            keywords=keywords,
-                        )
-                    )
+                logger.info(f"parsed {page_count} pages in {len(shards)} processes")
+        except Exception as e:
+            logger.warning(f"parse pdf in processes failed {e}, parse serially")
+            results = None
+    if results is None:
+        results = [parse_pdf_pages(path_in, 0, page_count, **kwargs)]
 
-            # Extracting Image Data
-            if debug:
-                logger.info(
-                    f"page:{pidx}, txt len:{len(page_text)}, has section image {len(page.images)}"
-                )
-            # if support_image and (len(page.images) > 0 or text is None): # for test
-            if (
-                support_image
-                and (len(page.images) > 0 or len(page_text) == 0)
-                and len(page_text) < 50
-            ):
-                dir_path = os.path.join("/tmp/", utils_file.get_basename(path_in))
-                if use_ocr:
-                    text = parse_image(dir_path, page, pidx, debug=debug)
-                else:
-                    text = ""
-                image_count += 1
-                arr.append(
-                    Block({"text": text, "auto_detect": auto_detect}, keywords=keywords)
-                )
+    arr = []
+    image_count = 0
+    for shard_image_count, shard_arr in results:
+        image_count += shard_image_count
+        arr.extend(shard_arr)
     if debug:
         logger.info(f"after convert {len(arr)} pages")
-    if use_fitz:
-        pdf_document.close()
-    ret_info["image_count"] = image_count
+    ret_info = {"image_count": image_count}
     return ret_info, arr
 
 
@@ -648,6 +834,45 @@ def reset_toc(blocks, toc_items, debug=False):
         last_idx = sim_idx
 
 
+def reset_toc_window(blocks, toc_items, toc_idx, debug=False):
+    """
+    Streaming variant of reset_toc, the pending toc items are matched in order against
+    the blocks of one page window, an item that can't be found is skipped when one of
+    the next TOC_LOOKAHEAD items matches. Return the index of the first pending item
+    """
+    last_idx = -1
+    while toc_idx < len(toc_items):
+        if len(toc_items[toc_idx]["title"]) == 0:
+            toc_idx += 1
+            continue
+        matched = False
+        for i in range(toc_idx, min(toc_idx + TOC_LOOKAHEAD, len(toc_items))):
+            real_text = toc_items[i]["title"]
+            if len(real_text) == 0:
+                continue
+            sim_idx = find_block(real_text, blocks, last_idx)
+            if sim_idx == -1:
+                continue
+            if i > toc_idx:
+                logger.warning(f"can't match toc items {toc_items[toc_idx:i]}")
+            if debug:
+                print("set toc", toc_items[i], blocks[sim_idx].get_text()[:50])
+            blocks[sim_idx].type = TYPE_HEADING_BASE
+            blocks[sim_idx].level = toc_items[i]["level"] + 1
+            last_idx = sim_idx
+            toc_idx = i + 1
+            matched = True
+            break
+        if not matched:
+            break
+    return toc_idx
+
+
+def get_page_count(path_in):
+    with fitz.open(path_in) as pdf_document:
+        return pdf_document.page_count
+
+
 class PDFParser(BaseParser):
     def __init__(self, data, with_parse=True, debug=False, **kwargs):
         self.use_ocr = kwargs.get("use_ocr", False)
@@ -685,11 +910,19 @@ class PDFParser(BaseParser):
                     data, auto_detect=True, use_ocr=self.use_ocr, debug=debug
                 )
 
+        self.set_meta(meta_info)
+        root_block = self.get_root_block(toc_items, debug=debug)
+        for block in arr:
+            root_block.add(block)
+        return root_block
+
+    def set_meta(self, meta_info):
         if "title" in meta_info and len(meta_info["title"].strip()) > 0:
             self.title = meta_info["title"]
         if "creator" in meta_info and len(meta_info["creator"].strip()) > 0:
             self.creator = meta_info["creator"]
 
+    def get_root_block(self, toc_items, debug=False):
         root_block = Block({"text": BLOCK_ROOT, "type": TYPE_HEADING_BASE, "level": 0})
         if len(toc_items) > 0:
             root_block.add(
@@ -707,10 +940,70 @@ class PDFParser(BaseParser):
                         }
                     )
                 )
-        for block in arr:
-            root_block.add(block)
         return root_block
 
+    def use_stream(self, stream=None):
+        """
+        stream None: documents with at least PDF_STREAM_MIN_PAGES pages are streamed
+        """
+        if stream is not None:
+            return stream
+        try:
+            return get_page_count(self.data) >= PDF_STREAM_MIN_PAGES
+        except Exception as e:
+            logger.warning(f"get page count failed {e}")
+            return False
+
+    def save_stream(self, path, debug=False):
+        """
+        Convert to markdown page window by page window, blocks are added to the tree and
+        written as soon as they are finished, memory is bounded by PDF_STREAM_WINDOW_PAGES
+        windows instead of the document size. The windows are parsed by the process pool.
+        """
+        meta_info, toc_items = PdfMeta.extract_pdf_info(self.data, debug=debug)
+        self.set_meta(meta_info)
+        keywords = getattr(self, "keywords", None)
+        auto_detect = len(toc_items) == 0 and keywords is None
+        page_count = get_page_count(self.data)
+        root_block = self.get_root_block(toc_items, debug=debug)
+        writer = None
+        toc_idx = 0
+        with open(path, "w", errors="ignore") as fp:
+            windows = iter_pdf_windows(
+                self.data,
+                page_count,
+                auto_detect=auto_detect,
+                use_ocr=self.use_ocr,
+                keywords=keywords,
+                debug=debug,
+            )
+            for end, window in windows:
+                if len(toc_items) > 0:
+                    toc_idx = reset_toc_window(window, toc_items, toc_idx, debug=debug)
+                if writer is None:
+                    # the front matter goes first, the fallback title is in the first window
+                    writer = self.start_stream(fp, root_block, window)
+                for block in window:
+                    writer.add(block)
+                writer.flush()
+                if debug:
+                    logger.debug(f"stream converted {end}/{page_count} pages")
+            if writer is None:
+                writer = self.start_stream(fp, root_block, [])
+            writer.close()
+        return True, "success"
+
+    def start_stream(self, fp, root_block, blocks):
+        if not hasattr(self, "title") or self.title is None:
+            for b in blocks:
+                if b.type == TYPE_CONTENT_PARAGRAPH:
+                    if len(b.get_text()) < MAX_TITLE_LEN:
+                        self.title = b.get_text()
+                    break
+        self.fm = tools_md.get_front_matter(self.data, info=self.get_meta_info())
+        tools_md.write_front_matter(fp, self.fm)
+        return BlockStreamWriter(fp, root_block)
+
     def get_meta_info(self, debug=False):
         info = {}
         if hasattr(self, "title") and self.title is not None:
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from backend.common.user.resource import ResourceManager
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily usage rollup from the resource usage rows, run once after upgrading"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", default=None, help="only rebuild the rollup of this user_id")
+
+    def handle(self, *args, **options):
+        ResourceManager.rebuild_rollup(options["user"])
+        self.stdout.write(self.style.SUCCESS("usage rollup rebuilt"))
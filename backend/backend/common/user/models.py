@@ -36,3 +36,24 @@ class StoreResourceUsage(models.Model):
     class Meta:
         db_table = "store_resource_usage"
         ordering = ["-updated_time"]
+
+
+class StoreResourceUsageRollup(models.Model):
+    """
+    Daily totals of StoreResourceUsage, updated together with every usage row
+    """
+
+    user_id = models.CharField(max_length=128)
+    rtype = models.CharField(max_length=128)
+    method = models.CharField(max_length=32)
+    day = models.DateField()
+    amount = models.BigIntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user_id} {self.rtype} {self.method} {self.day} {self.amount}"
+
+    class Meta:
+        db_table = "store_resource_usage_rollup"
+        unique_together = ("user_id", "rtype", "method", "day")
+        indexes = [models.Index(fields=["user_id", "day"])]
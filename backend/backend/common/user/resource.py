@@ -1,6 +1,73 @@
+"""
+Resource usage accounting
+
+Every usage row also adds its amount to a daily rollup row of (user, rtype, method),
+with an atomic upsert, so quota checks and summaries read a few indexed rows.
+Day, week and month totals of each rtype are kept as counters in the Django cache,
+they are incremented on add and rebuilt from the rollup after they expire.
+Counter keys carry a per user version, a counter that could not be incremented
+resets the version, so a total computed before that write is never read again.
+After upgrading, fill the rollup once with `python manage.py rebuild_usage_rollup`.
+"""
+
+import uuid
+
+from django.db import connection, transaction
+from django.db.models import Sum, Count
+from django.db.models.functions import TruncDate
+from django.core.cache import cache
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from .user import *
-from .models import StoreResourceUsage
+from .models import StoreResourceUsage, StoreResourceUsageRollup
+
+USAGE_CACHE_TIMEOUT = 3600
+USAGE_CACHED_DTYPES = ["day", "week", "month"]
+
+
+def get_period_start(dtype, today=None):
+    """
+    First day counted by dtype, None for the whole history
+    """
+    if today is None:
+        today = timezone.localdate()
+    if dtype == "day":
+        return today
+    elif dtype == "week":
+        return today - datetime.timedelta(days=today.weekday())
+    elif dtype == "month":
+        return datetime.date(today.year, today.month, 1)
+    return None
+
+
+def get_usage_rtypes(rtype, method):
+    """
+    rtype keys a usage row counts for, llm usage is also split into default and other
+    """
+    ret = [rtype]
+    if rtype == "llm":
+        if method is not None and method.startswith("default"):
+            ret.append("default_llm")
+        else:
+            ret.append("other_llm")
+    return ret
+
+
+def get_usage_version(uid):
+    key = f"usage_version_{uid}"
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        version = cache.get(key)
+    return version
+
+
+def reset_usage_version(uid):
+    cache.set(f"usage_version_{uid}", uuid.uuid4().hex, None)
+
+
+def get_usage_cache_key(uid, version, rtype, dtype, start):
+    return f"usage_{uid}_{version}_{rtype}_{dtype}_{start}"
 
 
 class ResourceManager:
@@ -15,63 +82,125 @@ class ResourceManager:
     def add(self, uid, app, rtype, method, amount, during, status, info):
         if info is not None:
             info = json.dumps(info)
-        data = StoreResourceUsage.objects.create(
-            user_id=uid,
-            app=app,
-            rtype=rtype,
-            method=method,
-            amount=amount,
-            during=during,
-            status=status,
-            info=info,
-        )
+        day = timezone.localdate()
+        with transaction.atomic():
+            data = StoreResourceUsage.objects.create(
+                user_id=uid,
+                app=app,
+                rtype=rtype,
+                method=method,
+                amount=amount,
+                during=during,
+                status=status,
+                info=info,
+            )
+            self.add_rollup(uid, rtype, method, day, amount)
+        try:
+            version = get_usage_version(uid)
+            for dtype in USAGE_CACHED_DTYPES:
+                start = get_period_start(dtype, day)
+                for key_rtype in get_usage_rtypes(rtype, method):
+                    cache.incr(get_usage_cache_key(uid, version, key_rtype, dtype, start), amount)
+        except ValueError:
+            # not cached, a total computed before this write may be added right now,
+            # the new version makes the counters read from the rollup again
+            reset_usage_version(uid)
+        except Exception as e:
+            logger.warning(f"update usage counter failed {e}")
         return data
 
+    @staticmethod
+    def add_rollup(uid, rtype, method, day, amount, count=1):
+        table = StoreResourceUsageRollup._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (user_id, rtype, method, day, amount, count) "
+                f"VALUES (%s, %s, %s, %s, %s, %s) "
+                f"ON CONFLICT (user_id, rtype, method, day) DO UPDATE SET "
+                f"amount = {table}.amount + EXCLUDED.amount, "
+                f"count = {table}.count + EXCLUDED.count",
+                [uid or "", rtype or "", method or "", day, amount, count],
+            )
+
+    @staticmethod
+    def rebuild_rollup(uid=None):
+        """
+        Recompute the rollup from the usage rows, e.g. for rows written before it existed,
+        see the rebuild_usage_rollup command
+        """
+        data = StoreResourceUsage.objects.all()
+        rollup = StoreResourceUsageRollup.objects.all()
+        if uid is not None:
+            data = data.filter(user_id=uid)
+            rollup = rollup.filter(user_id=uid)
+        rows = (
+            data.annotate(day=TruncDate("updated_time"))
+            .values("user_id", "rtype", "method", "day")
+            .annotate(total=Sum("amount"), total_count=Count("id"))
+        )
+        with transaction.atomic():
+            rollup.delete()
+            StoreResourceUsageRollup.objects.bulk_create(
+                [
+                    StoreResourceUsageRollup(
+                        user_id=row["user_id"] or "",
+                        rtype=row["rtype"] or "",
+                        method=row["method"] or "",
+                        day=row["day"],
+                        amount=row["total"] or 0,
+                        count=row["total_count"],
+                    )
+                    for row in rows
+                ],
+                batch_size=1000,
+            )
+        uids = [uid] if uid is not None else data.values_list("user_id", flat=True).distinct()
+        for user_id in uids:
+            reset_usage_version(user_id)
+
     def summarize(self, uid):
-        data = StoreResourceUsage.objects.filter(user_id=uid).all()
-        dic = {}
-        for d in data:
-            if d.method not in dic:
-                dic[d.method] = 0
-            dic[d.method] += d.amount
-        return dic
+        data = (
+            StoreResourceUsageRollup.objects.filter(user_id=uid)
+            .values("method")
+            .annotate(total=Sum("amount"))
+        )
+        return {d["method"]: d["total"] for d in data}
 
     def get_usage(self, uid, method=None, dtype="day", rtype=None, debug=False):
-        today = datetime.date.today()
-        if dtype == "day":
-            day = today
-        elif dtype == "week":
-            day = today - datetime.timedelta(days=today.weekday())
-        elif dtype == "month":
-            day = datetime.date(today.year, today.month, 1)
-        else:
-            day = -1
+        start = get_period_start(dtype)
         if debug:
             logger.debug(
-                f"get_usage: method {method}, dtype {dtype}, rtype {rtype}, {day} {uid}"
-            )
-        
-        if day == -1:
-            data = StoreResourceUsage.objects.filter(user_id=uid)
-        else:
-            data = StoreResourceUsage.objects.filter(
-                user_id=uid, updated_time__gte=day
+                f"get_usage: method {method}, dtype {dtype}, rtype {rtype}, {start} {uid}"
             )
-            
+
+        key = None
+        if method is None and rtype is not None and dtype in USAGE_CACHED_DTYPES:
+            try:
+                key = get_usage_cache_key(uid, get_usage_version(uid), rtype, dtype, start)
+                count = cache.get(key)
+                if count is not None:
+                    return count
+            except Exception as e:
+                logger.warning(f"get usage counter failed {e}")
+
+        data = StoreResourceUsageRollup.objects.filter(user_id=uid)
+        if start is not None:
+            data = data.filter(day__gte=start)
         if rtype == "default_llm":
             data = data.filter(rtype='llm', method__startswith='default')
         elif rtype == "other_llm":
             data = data.filter(rtype='llm').exclude(method__startswith='default')
         elif rtype is not None:
             data = data.filter(rtype=rtype)
-            
         if method is not None:
             data = data.filter(method=method)
-            
-        data = data.all()
-        count = 0
-        for d in data:
-            count += d.amount
+        count = data.aggregate(total=Sum("amount"))["total"] or 0
+
+        if key is not None:
+            try:
+                cache.add(key, count, USAGE_CACHE_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"set usage counter failed {e}")
         return count
 
     def get_usage_summary(self, uid):
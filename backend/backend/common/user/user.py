@@ -1,8 +1,11 @@
 import json
+import time
 import datetime
-from collections import deque
+import threading
+from collections import OrderedDict
 from loguru import logger
 from django.contrib.auth.models import User as UserSystem
+from django.core.cache import cache
 from django.utils.translation import gettext as _
 from .models import StoreUser
 from dataclasses import dataclass, asdict, field
@@ -25,6 +28,21 @@ TRUNCATE_MODE_TITLE_CONTENT = "title_content"
 TRUNCATE_MODE_FIRST_LAST = "first_last"
 DEFAULT_TRUNCATE_MODE = TRUNCATE_MODE_FIRST
 DEFAULT_TRUNCATE_MAX_LENGTH = 1024
+USER_CACHE_TIMEOUT = 24 * 3600
+USER_VERSION_CHECK_INTERVAL = 0.5  # seconds a local user is used without a version check
+
+def get_user_cache_key(uid):
+    return f"user_settings_{uid}"
+
+
+def get_user_version(data):
+    """
+    Version stamp of a StoreUser row, updated_time changes on every save
+    """
+    if data is None or data.updated_time is None:
+        return None
+    return data.updated_time.isoformat()
+
 
 def convert_units(num):
     if num >= 10**6:
@@ -206,13 +224,15 @@ class UserPrivilege:
 
 class UserOperate:
     def __init__(
-        self, uid, level=USER_LEVEL_NORMAL, password=DEFAULT_PASSWORD, create=True
+        self, uid, level=USER_LEVEL_NORMAL, password=DEFAULT_PASSWORD, create=True, load=True
     ):
         self.user_id = uid
         self.level = level
+        self.version = None
         self.settings = UserSettings()
         self.privilege = UserPrivilege(level)
-        self.load(password=password, create=create)
+        if load:
+            self.load(password=password, create=create)
 
     def get_level_desc(self):
         if self.level == USER_LEVEL_GUEST:
@@ -267,10 +287,12 @@ class UserOperate:
             if self.user_id is not None:
                 data = StoreUser.objects.filter(user_id=self.user_id).first()
         if data is not None:
+            self.settings = UserSettings()
             self.settings.set_json(data.settings)
             self.level = data.level
             self.privilege.set_level(self.level)
             self.user_id = data.user_id
+            self.version = get_user_version(data)
             if debug:
                 logger.info(f"load exist user {data}")
         else:
@@ -296,9 +318,34 @@ class UserOperate:
             # data.privilege = ''#json.dumps(self.privilege.get_json())
             data.level = self.level
             data.save()
+            self.version = get_user_version(data)
+            self.publish()
         except Exception as e:
             logger.warning(f"save user error {e}")
 
+    def get_payload(self):
+        return {
+            "version": self.version,
+            "level": self.level,
+            "settings": self.settings.get_json(),
+        }
+
+    def set_payload(self, payload):
+        self.settings = UserSettings()
+        self.settings.set_json(payload["settings"])
+        self.level = payload["level"]
+        self.privilege.set_level(self.level)
+        self.version = payload["version"]
+
+    def publish(self):
+        """
+        Share the saved settings with the other workers, they compare the version
+        """
+        try:
+            cache.set(get_user_cache_key(self.user_id), self.get_payload(), USER_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"publish user {self.user_id} error {e}")
+
     @staticmethod
     def check_user_exist(user_id):
         data = StoreUser.objects.filter(user_id=user_id).first()
@@ -334,12 +381,19 @@ class UserOperate:
 
 
 class UserManager:
+    """
+    Users are kept in a process local LRU, the shared cache holds the settings and
+    version of every saved user, a local user is compared with it at most every
+    USER_VERSION_CHECK_INTERVAL seconds, so a change saved by one worker reaches the others
+    """
+
     __instance = None
     MAX_USERS = 1000
 
     def __init__(self):
-        self.user_list = deque(maxlen=UserManager.MAX_USERS)
-        self.user_map = {}
+        self.user_map = OrderedDict()  # uid -> UserOperate, least recently used first
+        self.checked_time = {}  # uid -> last version check
+        self.lock = threading.Lock()
 
     @staticmethod
     def get_instance():
@@ -348,14 +402,68 @@ class UserManager:
         return UserManager.__instance
 
     def get_user(self, uid, level=USER_LEVEL_NORMAL):
-        if uid not in self.user_map:
-            if len(self.user_list) == UserManager.MAX_USERS:
-                oldest_uid = self.user_list.popleft()
-                del self.user_map[oldest_uid]
-            new_user = UserOperate(uid, level)
-            self.user_list.append(uid)
-            self.user_map[uid] = new_user
-        return self.user_map[uid]
+        now = time.time()
+        with self.lock:
+            user = self.user_map.get(uid)
+            if user is not None:
+                self.user_map.move_to_end(uid)
+                if now - self.checked_time.get(uid, 0) < USER_VERSION_CHECK_INTERVAL:
+                    return user
+
+        if user is None:
+            user = self._load_user(uid, level)
+        else:
+            self._refresh_user(user)
+
+        with self.lock:
+            self.user_map[uid] = user
+            self.user_map.move_to_end(uid)
+            self.checked_time[uid] = now
+            while len(self.user_map) > UserManager.MAX_USERS:
+                oldest_uid, _user = self.user_map.popitem(last=False)
+                self.checked_time.pop(oldest_uid, None)
+        return user
+
+    @staticmethod
+    def _get_payload(uid):
+        try:
+            return cache.get(get_user_cache_key(uid))
+        except Exception as e:
+            logger.warning(f"get user {uid} from cache error {e}")
+            return None
+
+    def _load_user(self, uid, level):
+        payload = self._get_payload(uid)
+        if payload is not None:
+            user = UserOperate(uid, level, load=False)
+            user.set_payload(payload)
+            return user
+        user = UserOperate(uid, level)
+        if user.version is not None:
+            user.publish()
+        return user
+
+    def _refresh_user(self, user):
+        payload = self._get_payload(user.user_id)
+        if payload is not None:
+            if payload["version"] != user.version:
+                user.set_payload(payload)
+            return
+        # not in the shared cache (expired or evicted), compare with the database
+        data = StoreUser.objects.filter(user_id=user.user_id).first()
+        if get_user_version(data) != user.version:
+            user.load(create=False)
+        if user.version is not None:
+            user.publish()
+
+    def invalidate(self, uid):
+        with self.lock:
+            self.user_map.pop(uid, None)
+            self.checked_time.pop(uid, None)
+        try:
+            cache.delete(get_user_cache_key(uid))
+        except Exception as e:
+            logger.warning(f"invalidate user {uid} error {e}")
 
     def check_user_exist(self, user_id):
         return UserOperate.check_user_exist(user_id)
@@ -380,6 +488,7 @@ class UserManager:
         try:
             StoreUser.objects.filter(user_id=user_id).delete()
             UserSystem.objects.filter(username=user_id).delete()
+            self.invalidate(user_id)
             return True
         except Exception as e:
             logger.warning(f"delete user error {e}")
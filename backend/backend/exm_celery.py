@@ -23,7 +23,13 @@ app.conf.update(
         'interval_start': 0,
         'interval_step': 0.2,
         'interval_max': 0.5,
-    }
+    },
+    beat_schedule={
+        'update-bookmark-weights': {
+            'task': 'app_bm_syncex.tasks.update_all_bookmark_weights',
+            'schedule': float(os.environ.get('BOOKMARK_WEIGHT_INTERVAL', 3600)),
+        },
+    },
 )
 
 app.autodiscover_tasks()
\ No newline at end of file
@@ -59,6 +59,7 @@ INSTALLED_APPS = [
     "app_bm_keeper",
     "user_tasks",
     "backend.common.user",
+    "backend.common.llm",
     "rest_framework",
     "corsheaders",
     "knox",
@@ -104,6 +105,8 @@ TEMPLATES = [
 
 CRON_CLASSES = [
     "backend.common.files.filecache.ClearCacheCronJob",
+    "backend.common.llm.embedding_cache.ClearEmbeddingCacheCronJob",
+    "backend.common.llm.llm_cache.ClearLLMCacheCronJob",
 ]
 
 WSGI_APPLICATION = "backend.wsgi.application"
@@ -159,6 +162,20 @@ AUTH_PASSWORD_VALIDATORS = [
 
 USE_CELERY = os.getenv("USE_CELERY", "True").lower() == "true"
 
+# Cache shared by the web and celery workers, on the redis celery uses (exm_celery.py),
+# in its own db, celery keeps the broker in db 0 and the task results in db 1
+REDIS_HOST = os.getenv("REDIS_HOST", BACKEND_ADDR_OUTER if USE_CELERY else None)
+REDIS_PORT = os.getenv("REDIS_PORT", "6379")
+REDIS_CACHE_DB = os.getenv("REDIS_CACHE_DB", "2")
+if REDIS_HOST:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_CACHE_DB}",
+            "KEY_PREFIX": "exmemo",
+        }
+    }
+
 IS_TRIAL_MODE = os.getenv("IS_TRIAL_MODE", "True").lower() == "true"
 TRIAL_MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB in bytes
 
@@ -246,6 +263,13 @@ from loguru import logger
 logger.remove()
 logger.add(sys.stdout, level="DEBUG")  # xieyan debug
 
+if not REDIS_HOST:
+    logger.warning(
+        "REDIS_HOST is not set and celery is disabled, the cache is per process (LocMem): "
+        "user settings, usage counters, llm cache, chat sessions and task progress "
+        "are not shared between workers"
+    )
+
 # 允许的请求头
 CORS_ALLOW_HEADERS = [
     'accept',
@@ -19,8 +19,8 @@ if [ "$USE_CELERY" = "False" ]; then
     echo "Celery is disabled, starting Django server only..."
     python manage.py runserver 0.0.0.0:8005
 else
-    echo "Starting Celery worker..."
-    celery -A backend worker -l info --concurrency=1 &
+    echo "Starting Celery worker with beat..."
+    celery -A backend worker -B -l info --concurrency=1 &
     CELERY_PID=$!
     
     echo "Waiting for Celery to start (PID: $CELERY_PID)..."
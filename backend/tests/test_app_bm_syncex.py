@@ -1,5 +1,12 @@
 import unittest
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase, TestCase
 from .support import BaseTestCase
+from app_dataforge.models import StoreEntry, BookmarkClick
+from app_bm_syncex.clicks import record_click, collapse_visit_history
+from app_bm_syncex.weight_utils import compute_weights, load_bookmarks, COEFFICIENTS
 
 
 class BmSyncexTestCase(BaseTestCase):
@@ -22,5 +29,78 @@ class BmSyncexTestCase(BaseTestCase):
             self.fail(f"POST request failed: {e}")
 
 
+class BookmarkWeightTestCase(SimpleTestCase):
+    def setUp(self):
+        self.now = datetime(2025, 1, 10, 12, 0, tzinfo=timezone.utc)
+        created_time = self.now - timedelta(days=1)
+        self.bookmarks = pd.DataFrame(
+            {"created_time": pd.to_datetime([created_time, created_time], utc=True)},
+            index=pd.Index(["a", "b"], name="idx"),
+        )
+
+    def get_clicks(self, rows):
+        clicks = pd.DataFrame(rows, columns=["bookmark_id", "clicked_at"])
+        clicks["clicked_at"] = pd.to_datetime(clicks["clicked_at"], utc=True)
+        return clicks
+
+    def test_clicked_bookmark_weighs_more(self):
+        clicks = self.get_clicks([
+            ("a", self.now - timedelta(minutes=90)),
+            ("a", self.now - timedelta(minutes=60)),
+            ("a", self.now - timedelta(minutes=30)),
+            ("deleted", self.now - timedelta(minutes=10)),
+        ])
+        weights = compute_weights(self.bookmarks, clicks, self.now)
+        # clicks of bookmarks that are gone are ignored
+        self.assertEqual(list(weights.index), ["a", "b"])
+        self.assertGreater(weights["a"], weights["b"])
+
+    def test_unclicked_bookmark_weight(self):
+        weights = compute_weights(self.bookmarks, self.get_clicks([]), self.now)
+        # without clicks only the freshness of the creation time counts
+        freshness = 1.0 / (1 + np.log1p(1 / 30)) * 0.4 + 1.0 / (1 + np.log1p(1 / 7)) * 0.6
+        self.assertAlmostEqual(weights["b"], round(freshness * COEFFICIENTS["freshness"], 3))
+        self.assertEqual(weights["a"], weights["b"])
+
+
+class BookmarkClickTestCase(TestCase):
+    user_id = "click_user"
+
+    def setUp(self):
+        self.now = datetime(2025, 1, 10, 12, 0, tzinfo=timezone.utc)
+        first = (self.now - timedelta(days=2)).isoformat()
+        second = (self.now - timedelta(days=1)).isoformat()
+        # the old handler appended every visit twice and counted both
+        self.bookmark = StoreEntry.objects.create(
+            user_id=self.user_id, etype="web", source="bookmark", addr="https://example.com",
+            block_id=0, title="example", created_time=self.now - timedelta(days=3),
+            meta={"visit_history": [first, first, second, second], "clicks": 4},
+        )
+
+    def test_collapse_visit_history(self):
+        self.assertEqual(collapse_visit_history(["a", "a", "b", "b", "a"]), ["a", "b", "a"])
+        self.assertEqual(collapse_visit_history(None), [])
+
+    def test_record_click(self):
+        clicks, weight = record_click(self.bookmark, self.now)
+        self.assertEqual((clicks, weight), (3, None))
+        self.assertEqual(BookmarkClick.objects.filter(bookmark_id=self.bookmark.idx).count(), 3)
+        self.bookmark.refresh_from_db()
+        self.assertNotIn("visit_history", self.bookmark.meta)
+        self.assertEqual(self.bookmark.meta["last_visit"], self.now.isoformat())
+        clicks, _weight = record_click(self.bookmark, self.now + timedelta(minutes=1))
+        self.assertEqual(clicks, 4)
+        self.assertEqual(BookmarkClick.objects.filter(bookmark_id=self.bookmark.idx).count(), 4)
+
+    def test_load_legacy_clicks(self):
+        bookmarks, clicks = load_bookmarks(self.user_id)
+        self.assertEqual(list(bookmarks.index), [self.bookmark.idx])
+        self.assertEqual(len(clicks), 2)
+        record_click(self.bookmark, self.now)
+        _bookmarks, clicks = load_bookmarks(self.user_id)
+        # moved to the click table, not counted twice
+        self.assertEqual(len(clicks), 3)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,328 @@
+import os
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from app_dataforge.models import StoreEntry, StoreSyncNode, StoreDirectory
+from app_dataforge.entry_item import EntryItem
+from app_dataforge.entry_storage import EntryStorage
+from app_dataforge.ingest import IngestPipeline, IngestItem
+from app_dataforge.conversion_cache import ConversionArtifact, ConversionArtifactCache
+from app_dataforge.folder_ops import move_folder, delete_folder
+from app_dataforge.sync_manifest import SyncManifest, get_ancestors, get_dir_hash, EMPTY_HASH
+from app_dataforge import dir_index
+from app_dataforge.dir_index import DirectoryIndex, get_max_depth
+
+
+class SyncManifestTestCase(SimpleTestCase):
+    def test_get_ancestors(self):
+        self.assertEqual(get_ancestors("note.md"), [""])
+        self.assertEqual(get_ancestors("a/b/note.md"), ["", "a/", "a/b/"])
+
+    def test_get_dir_hash(self):
+        files = [("b.md", "md5_b"), ("a.md", None)]
+        dirs = [("sub", "hash_sub")]
+        expected = hashlib.sha1(
+            "d\tsub\thash_sub\nf\ta.md\t\nf\tb.md\tmd5_b".encode("utf-8")
+        ).hexdigest()
+        self.assertEqual(get_dir_hash(files, dirs), expected)
+        # the client lists its files in any order
+        self.assertEqual(get_dir_hash(list(reversed(files)), dirs), expected)
+        self.assertEqual(get_dir_hash([], []), EMPTY_HASH)
+
+
+class SyncManifestRefreshTestCase(TestCase):
+    uid = "manifest_user"
+
+    def add_note(self, addr):
+        now = timezone.now()
+        StoreEntry.objects.create(
+            user_id=self.uid, etype="note", addr=addr, block_id=0, title=addr, raw=addr,
+            md5=addr, created_time=now, updated_time=now,
+        )
+
+    def get_node(self, path):
+        return StoreSyncNode.objects.get(user_id=self.uid, path=path)
+
+    def test_refresh_keeps_concurrent_mark(self):
+        manifest = SyncManifest.get_instance()
+        self.add_note("a/x.md")
+        manifest.get_nodes(self.uid, [""])
+        self.add_note("a/y.md")
+        manifest.mark_dirty(self.uid, ["a/y.md"])
+        node = self.get_node("a/")
+        # another write lands between reading and refreshing the node
+        self.add_note("a/z.md")
+        manifest.mark_dirty(self.uid, ["a/z.md"])
+        manifest._refresh(self.uid, node)
+        self.assertTrue(self.get_node("a/").dirty)
+        manifest._refresh(self.uid, self.get_node("a/"))
+        node = self.get_node("a/")
+        self.assertFalse(node.dirty)
+        self.assertEqual(node.count, 3)
+        self.assertEqual(manifest.get_nodes(self.uid, [""])[""]["count"], 3)
+
+
+class DirectoryRecountTestCase(TestCase):
+    uid = "dir_user"
+
+    def add_entry(self, addr):
+        now = timezone.now()
+        StoreEntry.objects.create(
+            user_id=self.uid, etype="file", addr=addr, block_id=0, title=addr, raw=addr,
+            created_time=now, updated_time=now,
+        )
+
+    def test_recount_keeps_concurrent_mark(self):
+        index = DirectoryIndex.get_instance()
+        self.add_entry("a/x.pdf")
+        self.assertEqual(index.get_dirs(self.uid, "file"), ["a/"])
+        self.add_entry("a/y.pdf")
+        index.mark_dirty(self.uid, "file", ["a/y.pdf"])
+        get_live_entries = dir_index.get_live_entries
+
+        def write_while_counting(uid, etype):
+            # another write lands between reading and recounting the directory
+            if not StoreEntry.objects.filter(user_id=self.uid, addr="a/z.pdf").exists():
+                self.add_entry("a/z.pdf")
+                index.mark_dirty(self.uid, "file", ["a/z.pdf"])
+            return get_live_entries(uid, etype)
+
+        with mock.patch("app_dataforge.dir_index.get_live_entries", write_while_counting):
+            index.get_dirs(self.uid, "file")
+        directory = StoreDirectory.objects.get(user_id=self.uid, etype="file", path="a/")
+        self.assertTrue(directory.dirty)
+        index.get_dirs(self.uid, "file")
+        directory.refresh_from_db()
+        self.assertFalse(directory.dirty)
+        self.assertEqual(directory.count, 3)
+
+
+class DirectoryEntriesTestCase(TestCase):
+    uid = "dir_user"
+
+    def setUp(self):
+        now = timezone.now()
+        for addr in ["note.md", "a/note.md", "a/b/note.md", "a/b/c/note.md"]:
+            StoreEntry.objects.create(
+                user_id=self.uid, etype="note", addr=addr, block_id=0, title=addr, raw=addr,
+                created_time=now, updated_time=now,
+            )
+
+    def get_addrs(self, path, depth):
+        query = DirectoryIndex.get_entries(self.uid, "note", path, depth)
+        return sorted(query.values_list("addr", flat=True))
+
+    def test_max_depth(self):
+        self.assertEqual(get_max_depth("", 1), 0)
+        self.assertEqual(get_max_depth("", 2), 1)
+        self.assertEqual(get_max_depth("a/", 1), 1)
+        self.assertEqual(get_max_depth("a/b/", 1), 2)
+
+    def test_entries_by_depth(self):
+        self.assertEqual(self.get_addrs("", 1), ["note.md"])
+        self.assertEqual(self.get_addrs("", 2), ["a/note.md", "note.md"])
+        self.assertEqual(self.get_addrs("a/", 1), ["a/note.md"])
+        self.assertEqual(self.get_addrs("a/", 2), ["a/b/note.md", "a/note.md"])
+        self.assertEqual(len(self.get_addrs("", None)), 4)
+
+
+class FolderOpsTestCase(TestCase):
+    uid = "folder_user"
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        env = {"FILE_STORE": "local", "LOCAL_FILE_STORE_DIR": self.tmp_dir.name}
+        self.env_patch = mock.patch.dict(os.environ, env)
+        self.env_patch.start()
+        now = timezone.now()
+        for addr, block_id in [("a/x.md", 0), ("a/x.md", 1), ("a/sub/y.md", 0), ("b/x.md", 0), ("ab/z.md", 0)]:
+            StoreEntry.objects.create(
+                user_id=self.uid, etype="note", addr=addr, block_id=block_id, title=addr,
+                raw=addr, path=f"notes/{addr}", created_time=now, updated_time=now,
+            )
+            path = self.get_file(addr)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(addr)
+
+    def tearDown(self):
+        self.env_patch.stop()
+        self.tmp_dir.cleanup()
+
+    def get_file(self, addr):
+        return os.path.join(self.tmp_dir.name, self.uid, "notes", addr)
+
+    def get_live(self):
+        return sorted(
+            StoreEntry.objects.filter(user_id=self.uid, is_deleted=False).values_list("addr", "block_id")
+        )
+
+    def test_move(self):
+        # b/x.md exists, a/x.md stays with its file, its blocks and b/x.md untouched
+        self.assertEqual(move_folder(self.uid, "note", "a", "b"), ["b/sub/y.md"])
+        self.assertEqual(self.get_live(), [
+            ("a/x.md", 0), ("a/x.md", 1), ("ab/z.md", 0), ("b/sub/y.md", 0), ("b/x.md", 0),
+        ])
+        moved = StoreEntry.objects.get(user_id=self.uid, addr="b/sub/y.md")
+        self.assertEqual(moved.path, "notes/b/sub/y.md")
+        self.assertTrue(os.path.exists(self.get_file("b/sub/y.md")))
+        with open(self.get_file("b/x.md")) as f:
+            self.assertEqual(f.read(), "b/x.md")
+
+    def test_move_into_itself(self):
+        before = self.get_live()
+        self.assertEqual(move_folder(self.uid, "note", "a", "a/sub"), [])
+        self.assertEqual(self.get_live(), before)
+        self.assertTrue(os.path.exists(self.get_file("a/x.md")))
+
+    def test_delete(self):
+        self.assertEqual(sorted(delete_folder(self.uid, "note", "a/")), ["a/sub/y.md", "a/x.md"])
+        self.assertEqual(self.get_live(), [("ab/z.md", 0), ("b/x.md", 0)])
+        # the blocks are dropped, the entries kept as deleted
+        self.assertEqual(
+            sorted(StoreEntry.objects.filter(user_id=self.uid, addr__startswith="a/").values_list("block_id", "is_deleted")),
+            [(0, True), (0, True)],
+        )
+        self.assertFalse(os.path.exists(self.get_file("a/x.md")))
+        self.assertTrue(os.path.exists(self.get_file("ab/z.md")))
+
+
+
+class BlockDiffTestCase(TestCase):
+    uid = "block_user"
+
+    def setUp(self):
+        patcher = mock.patch("app_dataforge.entry_storage.embedding_manager")
+        embedding_manager = patcher.start()
+        self.addCleanup(patcher.stop)
+        embedding_manager.get_model_name.return_value = None
+        embedding_manager.get_embedding_scope.return_value = "none"
+        self.entry = EntryItem(user_id=self.uid, etype="note", addr="diff.md", title="diff", path="notes/diff.md")
+
+    def save(self, chunks):
+        self.assertTrue(EntryStorage._save_content_blocks(self.entry, "\n".join(chunks), chunks))
+        blocks = StoreEntry.objects.filter(user_id=self.uid, addr="diff.md", block_id__gt=0).order_by("block_id")
+        self.assertEqual([block.block_id for block in blocks], list(range(1, len(chunks) + 1)))
+        self.assertEqual([block.raw for block in blocks], chunks)
+        return {block.raw: block.idx for block in blocks}
+
+    def test_keep_create_delete(self):
+        first = self.save(["A", "B", "C"])
+        second = self.save(["A", "X", "C", "D"])
+        # unchanged blocks keep their rows, a changed block reuses the row it replaces
+        self.assertEqual(second["A"], first["A"])
+        self.assertEqual(second["C"], first["C"])
+        self.assertEqual(second["X"], first["B"])
+        self.assertNotIn(second["D"], first.values())
+        third = self.save(["A", "D"])
+        # a moved block keeps its row with the new block_id, the others are deleted
+        self.assertEqual(third, {"A": first["A"], "D": second["D"]})
+
+    def test_empty_content(self):
+        self.save(["A", "B"])
+        self.assertTrue(EntryStorage._save_content_blocks(self.entry, "", None))
+        self.assertFalse(StoreEntry.objects.filter(user_id=self.uid, addr="diff.md").exists())
+
+
+class IngestPipelineTestCase(TestCase):
+    uid = "ingest_user"
+
+    def setUp(self):
+        for target in ["app_dataforge.ingest.embedding_manager", "app_dataforge.ingest.UserManager"]:
+            patcher = mock.patch(target)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pipeline = IngestPipeline(self.uid)
+
+    def get_item(self, addr, title=None):
+        entry = EntryItem(user_id=self.uid, etype="note", addr=addr, title=title or addr, path=f"notes/{addr}")
+        item = IngestItem(entry, f"/tmp/{addr}")
+        item.blocks = ["block of " + addr]
+        item.block_embeddings = [None]
+        return item
+
+    def test_write_isolates_failed_rows(self):
+        good, bad = self.get_item("good.md"), self.get_item("bad.md", "bad\x00title")
+        self.pipeline._write([good, bad])
+        self.assertIsNone(good.error)
+        self.assertTrue(bad.error.startswith("write:"))
+        addrs = StoreEntry.objects.filter(user_id=self.uid).values_list("addr", "block_id")
+        self.assertEqual(sorted(addrs), [("good.md", 0), ("good.md", 1)])
+
+    def test_batch_routing(self):
+        now = timezone.now()
+        StoreEntry.objects.create(
+            user_id=self.uid, etype="note", addr="old.md", block_id=0, title="old", raw="old",
+            created_time=now, updated_time=now,
+        )
+        dic_items = [
+            {"user_id": self.uid, "etype": "note", "addr": addr}
+            for addr in ["a.md", "old.md", "a.md"]
+        ]
+        with mock.patch.object(IngestPipeline, "_update_existing") as update_existing, \
+                mock.patch.object(IngestPipeline, "_run_stage"), \
+                mock.patch.object(IngestPipeline, "_embedding"), \
+                mock.patch.object(IngestPipeline, "_write") as write:
+            success_list = self.pipeline.run(dic_items, ["/tmp/1", "/tmp/2", "/tmp/3"])
+        # an addr uploaded twice is written once from the last file
+        self.assertEqual(success_list, ["old.md", "a.md"])
+        updated = update_existing.call_args[0][0]
+        self.assertEqual([item.entry.addr for item in updated], ["old.md"])
+        written = write.call_args[0][0]
+        self.assertEqual([(item.entry.addr, item.file_path) for item in written], [("a.md", "/tmp/3")])
+
+
+class ConversionArtifactTestCase(TestCase):
+    uid = "artifact_user"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        env = {"FILE_STORE": "local", "LOCAL_FILE_STORE_DIR": tmp_dir.name}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.artifact_cache = ConversionArtifactCache.get_instance()
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        with self.artifact_cache.lock:
+            self.artifact_cache.memory.clear()
+
+    def test_get_and_put(self):
+        self.artifact_cache.put(self.uid, ConversionArtifact("md5_a", {"title": "a"}, "content", ["content"]))
+        self.forget()
+        artifact = self.artifact_cache.get(self.uid, "md5_a")
+        self.assertEqual((artifact.meta, artifact.content, artifact.chunks), ({"title": "a"}, "content", ["content"]))
+        # ocr output and other users are kept apart
+        self.assertIsNone(self.artifact_cache.get(self.uid, "md5_a", use_ocr=True))
+        self.assertIsNone(self.artifact_cache.get("other_user", "md5_a"))
+        # a converter upgrade changes the key
+        self.forget()
+        with mock.patch("backend.common.parser.converter.CONVERTER_VERSION", "test"):
+            self.assertIsNone(self.artifact_cache.get(self.uid, "md5_a"))
+
+    def test_release(self):
+        now = timezone.now()
+        StoreEntry.objects.create(
+            user_id=self.uid, etype="file", addr="used.pdf", block_id=0, title="used", raw="used",
+            md5="md5_used", created_time=now, updated_time=now,
+        )
+        for md5 in ["md5_used", "md5_gone"]:
+            self.artifact_cache.put(self.uid, ConversionArtifact(md5, content=md5))
+        paths = self.artifact_cache.get_release_paths(self.uid, ["md5_used", "md5_gone", None])
+        self.assertEqual(sorted(paths), sorted([
+            ConversionArtifactCache.get_artifact_path("md5_gone"),
+            ConversionArtifactCache.get_artifact_path("md5_gone", use_ocr=True),
+        ]))
+        self.artifact_cache.release(self.uid, ["md5_used", "md5_gone"])
+        self.forget()
+        self.assertIsNone(self.artifact_cache.get(self.uid, "md5_gone"))
+        self.assertEqual(self.artifact_cache.get(self.uid, "md5_used").content, "md5_used")
+
+
+if __name__ == "__main__":
+    unittest.main()
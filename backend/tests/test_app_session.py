@@ -1,4 +1,12 @@
 import unittest
+from unittest import mock
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from backend.common.user.user import DEFAULT_USER
+from app_message.models import StoreMessage
+from app_message.message_log import MessageLog
+from app_message.context_builder import ContextBuilder, CHAT_SUMMARY_BATCH
+from app_message.session import Session, Message, SessionManager, SessionBusyError, get_session_cache_key
 from .support import BaseTestCase
 
 class SessionTestCase(BaseTestCase):
@@ -30,5 +38,163 @@ class SessionTestCase(BaseTestCase):
         print(info)
 
 
+class SessionSharingTestCase(TestCase):
+    """
+    Two Session objects of one sid stand for two workers sharing it through the cache
+    """
+    sid = "shared_session_test"
+
+    def tearDown(self):
+        for suffix in ["", "_lock", "_flush"]:
+            cache.delete(get_session_cache_key(self.sid) + suffix)
+
+    def get_workers(self, user_id=DEFAULT_USER):
+        first = Session(self.sid, user_id, False, "web")
+        self.assertTrue(first.publish())
+        second = Session(self.sid, user_id, False, "web")
+        second.set_payload(cache.get(get_session_cache_key(self.sid)))
+        return first, second
+
+    def get_cached_contents(self):
+        payload = cache.get(get_session_cache_key(self.sid))
+        return [item["content"] for item in payload["messages"]]
+
+    def test_publish_conflict(self):
+        first, second = self.get_workers()
+        first.send_message("q1", "a1")
+        self.assertTrue(first.publish())
+        second.send_message("q2", "a2")
+        # second read the state before first published, it must not overwrite it
+        self.assertFalse(second.publish())
+        self.assertEqual(self.get_cached_contents(), ["q1", "a1"])
+
+    def test_update_keeps_both(self):
+        first, second = self.get_workers()
+        manager = SessionManager.get_instance()
+        manager.update_session(first, lambda latest: latest.send_message("q1", "a1"))
+        manager.update_session(second, lambda latest: latest.send_message("q2", "a2"))
+        self.assertEqual(self.get_cached_contents(), ["q1", "a1", "q2", "a2"])
+
+    def test_foreign_session(self):
+        owner, _second = self.get_workers("owner_user")
+        # the owner is logged in, add the message without the message log
+        owner.messages.append(Message(0, "user", "secret", "2025-01-01 00:00:00"))
+        owner.publish()
+        manager = SessionManager.get_instance()
+        session = manager._load_session(self.sid, "other_user", False, "web")
+        self.assertNotEqual(session.sid, self.sid)
+        self.assertEqual(len(session.messages), 0)
+        # a session of the other user with that sid does not pick up the payload either
+        other = Session(self.sid, "other_user", False, "web")
+        manager.reload_session(other)
+        self.assertEqual(len(other.messages), 0)
+        self.assertEqual(self.get_cached_contents(), ["secret"])
+
+    def test_busy_session(self):
+        first, _second = self.get_workers()
+        cache.add(get_session_cache_key(self.sid) + "_lock", 1, 60)
+        func = mock.Mock()
+        with mock.patch("app_message.session.SESSION_LOCK_WAIT", 0):
+            with self.assertRaises(SessionBusyError):
+                SessionManager.get_instance().update_session(first, func)
+        func.assert_not_called()
+
+
+class ContextBuilderTestCase(SimpleTestCase):
+    def setUp(self):
+        # one token per character keeps the window easy to follow
+        patcher = mock.patch("app_message.context_builder.count_tokens",
+                             side_effect=lambda string, model_name: len(string))
+        self.count_tokens = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = Session("context_test", DEFAULT_USER, False, "web")
+        self.session.messages = [
+            Message(idx, "user" if idx % 2 == 0 else "assistant", "m" * 10, "")
+            for idx in range(20)
+        ]
+
+    def get_window(self, builder):
+        return [item.idx for item in builder.build(self.session)]
+
+    def test_window(self):
+        self.assertEqual(self.get_window(ContextBuilder(4, 0, use_summary=False)), [16, 17, 18, 19])
+        # 14 and 19 tokens per message, 55 tokens hold the newest three
+        self.assertEqual(self.get_window(ContextBuilder(10, 55, use_summary=False)), [17, 18, 19])
+        self.assertEqual(self.get_window(ContextBuilder(0, 55, use_summary=False)), [])
+        self.assertEqual(len(self.get_window(ContextBuilder(100, 0, use_summary=False))), 20)
+
+    def test_tokens_memoized(self):
+        builder = ContextBuilder(10, 1000, "gpt-4", use_summary=False)
+        builder.build(self.session)
+        self.assertEqual(self.count_tokens.call_count, 10)
+        builder.build(self.session)
+        self.assertEqual(self.count_tokens.call_count, 10)
+        # another model counts again
+        ContextBuilder(10, 1000, "gpt-3.5-turbo", use_summary=False).build(self.session)
+        self.assertEqual(self.count_tokens.call_count, 20)
+        self.assertEqual(self.session.messages[-1].token_counts, {"gpt-4": 10 + len("assistant"),
+                                                                  "gpt-3.5-turbo": 10 + len("assistant")})
+
+    def test_summary(self):
+        builder = ContextBuilder(2, 0, use_summary=True)
+        with mock.patch("app_message.context_builder.llm_query", return_value=(True, "earlier talk", {})) as query:
+            window = builder.build(self.session)
+            self.assertEqual(query.call_count, 1)
+            self.assertEqual(window[0].sender, "system")
+            self.assertIn("earlier talk", window[0].content)
+            self.assertEqual([item.idx for item in window[1:]], [18, 19])
+            self.assertEqual(self.session.summary_idx, 18)
+            # fewer than CHAT_SUMMARY_BATCH new messages reuse the summary
+            for idx in range(20, 20 + CHAT_SUMMARY_BATCH - 1):
+                self.session.messages.append(Message(idx, "user", "m" * 10, ""))
+            builder.build(self.session)
+            self.assertEqual(query.call_count, 1)
+            self.session.messages.append(Message(29, "user", "m" * 10, ""))
+            builder.build(self.session)
+            self.assertEqual(query.call_count, 2)
+            self.assertEqual(self.session.summary_idx, 28)
+
+
+class MessageLogTestCase(TestCase):
+    sid = "log_session_test"
+    user_id = "log_user"
+
+    def tearDown(self):
+        for suffix in ["", "_lock", "_flush", "_import"]:
+            cache.delete(get_session_cache_key(self.sid) + suffix)
+        SessionManager.get_instance().remove_session(self.sid)
+
+    def get_session(self):
+        return Session(self.sid, self.user_id, False, "web")
+
+    def load(self):
+        rows = MessageLog.get_instance().load(self.user_id, self.sid, 10)
+        return [(item["sender"], item["content"], item["seq"]) for item in rows]
+
+    def test_append_and_load(self):
+        session = self.get_session()
+        session.send_message("q1", "a1")
+        session.send_message("q2", "a2")
+        self.assertEqual(self.load(), [
+            ("user", "q1", 1), ("assistant", "a1", 2), ("user", "q2", 3), ("assistant", "a2", 4),
+        ])
+
+    def test_answer_is_written(self):
+        SessionManager.get_instance().send_message("q1", "a1", self.get_session())
+        # written by the request, not left to the flusher thread
+        self.assertEqual(StoreMessage.objects.filter(user_id=self.user_id, sid=self.sid).count(), 2)
+
+    def test_legacy_import(self):
+        items = [
+            {"sender": "user", "content": "old question", "created_time": "2024-01-01 10:00:00"},
+            {"sender": "assistant", "content": "old answer", "created_time": "2024-01-01 10:00:00"},
+        ]
+        session = self.get_session()
+        self.assertTrue(session.import_legacy_messages(items))
+        # a second import, e.g. by another worker, finds them and writes nothing
+        self.assertTrue(session.import_legacy_messages(items))
+        self.assertEqual(self.load(), [("user", "old question", 1), ("assistant", "old answer", 2)])
+
+
 if __name__ == "__main__":
     unittest.main() 
\ No newline at end of file
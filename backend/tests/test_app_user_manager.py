@@ -1,4 +1,9 @@
 import json
+from unittest import mock
+from django.core.cache import cache
+from django.test import TestCase
+from backend.common.user.user import UserManager, UserOperate, get_user_cache_key
+from backend.common.user.resource import ResourceManager, reset_usage_version
 from .support import BaseTestCase
 from rest_framework.test import APIClient
 from django.utils.translation import gettext as _
@@ -72,4 +77,88 @@ class UserManagerTestCase(BaseTestCase):
         print(ret)
 
 
+class UserCacheTestCase(TestCase):
+    """
+    two UserManager stand for two workers sharing the cache
+    """
+
+    uid = "cache_user"
+
+    def setUp(self):
+        UserOperate.create_user(self.uid, "1234567")
+        self.worker_a = UserManager()
+        self.worker_b = UserManager()
+
+    def tearDown(self):
+        cache.delete(get_user_cache_key(self.uid))
+
+    def test_version_bump(self):
+        user_a = self.worker_a.get_user(self.uid)
+        user_b = self.worker_b.get_user(self.uid)
+        self.assertEqual(user_a.version, user_b.version)
+        old_version = user_a.version
+        user_a.set("tts_speed", "1.5")
+        self.assertNotEqual(user_a.version, old_version)
+        self.assertEqual(cache.get(get_user_cache_key(self.uid))["version"], user_a.version)
+        # inside the check interval the local copy is used as is
+        self.assertEqual(self.worker_b.get_user(self.uid).get("tts_speed"), "1.0")
+        with mock.patch("backend.common.user.user.USER_VERSION_CHECK_INTERVAL", 0):
+            user_b = self.worker_b.get_user(self.uid)
+        self.assertEqual(user_b.get("tts_speed"), "1.5")
+        self.assertEqual(user_b.version, user_a.version)
+
+    def test_invalidate(self):
+        user_a = self.worker_a.get_user(self.uid)
+        self.worker_b.get_user(self.uid)
+        self.worker_b.invalidate(self.uid)
+        self.assertIsNone(cache.get(get_user_cache_key(self.uid)))
+        self.assertNotIn(self.uid, self.worker_b.user_map)
+        # a row saved behind the cache is found by the version check on the database
+        user_db = UserOperate(self.uid, load=True, create=False)
+        user_db.settings.set("tts_speed", "2.0")
+        user_db.save()
+        cache.delete(get_user_cache_key(self.uid))
+        with mock.patch("backend.common.user.user.USER_VERSION_CHECK_INTERVAL", 0):
+            user = self.worker_a.get_user(self.uid)
+        self.assertIs(user, user_a)
+        self.assertEqual(user.get("tts_speed"), "2.0")
+        self.assertEqual(cache.get(get_user_cache_key(self.uid))["version"], user.version)
+
+
+class ResourceUsageTestCase(TestCase):
+    uid = "usage_user"
+
+    def setUp(self):
+        reset_usage_version(self.uid)  # counters cached by an earlier run are not read
+        self.manager = ResourceManager.get_instance()
+        for rtype, method, amount in [("llm", "default_gpt", 100), ("llm", "custom", 50), ("tts", "edge", 10)]:
+            self.manager.add(self.uid, "chat", rtype, method, amount, 1.0, "success", None)
+
+    def tearDown(self):
+        reset_usage_version(self.uid)
+
+    def get_totals(self):
+        return {
+            rtype: self.manager.get_usage(self.uid, rtype=rtype, dtype="day")
+            for rtype in ["llm", "default_llm", "other_llm", "tts"]
+        }
+
+    def test_totals(self):
+        self.assertEqual(self.get_totals(), {"llm": 150, "default_llm": 100, "other_llm": 50, "tts": 10})
+        self.assertEqual(self.manager.get_usage(self.uid, rtype="llm", dtype="all"), 150)
+        self.assertEqual(self.manager.get_usage(self.uid, method="custom", dtype="month"), 50)
+        self.assertEqual(self.manager.summarize(self.uid), {"default_gpt": 100, "custom": 50, "edge": 10})
+
+    def test_cached_counters(self):
+        self.get_totals()  # the counters are cached now
+        self.manager.add(self.uid, "chat", "llm", "custom", 25, 1.0, "success", None)
+        self.assertEqual(self.get_totals(), {"llm": 175, "default_llm": 100, "other_llm": 75, "tts": 10})
+
+    def test_rebuild_rollup(self):
+        self.get_totals()
+        ResourceManager.rebuild_rollup(self.uid)
+        self.assertEqual(self.get_totals(), {"llm": 150, "default_llm": 100, "other_llm": 50, "tts": 10})
+        self.assertEqual(self.manager.summarize(self.uid), {"default_gpt": 100, "custom": 50, "edge": 10})
+
+
 # ret = chat('xieyan', '你好')
@@ -0,0 +1,70 @@
+import unittest
+from datetime import timedelta
+from unittest import mock
+from django.core.cache import cache
+from django.utils import timezone
+from user_tasks.models import UserTask
+from user_tasks.progress import ProgressReporter, get_cached_task, get_task_cache_key
+from .support import BaseTestCase
+
+
+class UserTaskTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.task = UserTask.objects.create(user_id="testuser", task_id="task_progress", task_name="move_task")
+
+    def tearDown(self):
+        cache.delete(get_task_cache_key(self.task.task_id))
+
+    def get_status(self):
+        response = self.client.get(f"/api/tasks/{self.task.task_id}/task_status/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_progress_throttling(self):
+        reporter = ProgressReporter(self.task.task_id, "testuser", "move_task")
+        for progress in range(1, 6):
+            reporter(progress)
+        # small steps inside the flush interval stay in memory
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.progress, 0)
+        reporter(12)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.progress, 12)
+        self.assertEqual(get_cached_task(self.task.task_id)["progress"], 12)
+        reporter.finish("SUCCESS")
+        self.task.refresh_from_db()
+        self.assertEqual((self.task.status, self.task.progress), ("SUCCESS", 100))
+
+    def test_status_of_running_task(self):
+        reporter = ProgressReporter(self.task.task_id, "testuser", "move_task")
+        reporter(50)
+        with mock.patch("user_tasks.views.AsyncResult") as async_result:
+            data = self.get_status()
+        async_result.assert_not_called()
+        self.assertEqual(data["progress"], 50)
+        # the same shape as the serializer
+        self.assertEqual(data["idx"], str(self.task.idx))
+        self.assertIn("created_time", data)
+
+    def test_status_of_stale_task(self):
+        """
+        a worker that died stops publishing, celery decides the status
+        """
+        reporter = ProgressReporter(self.task.task_id, "testuser", "move_task")
+        reporter(50)
+        payload = get_cached_task(self.task.task_id)
+        payload["updated_time"] = (timezone.now() - timedelta(hours=1)).isoformat()
+        cache.set(get_task_cache_key(self.task.task_id), payload)
+        with mock.patch("user_tasks.views.AsyncResult") as async_result:
+            async_result.return_value.status = "FAILURE"
+            async_result.return_value.ready.return_value = True
+            async_result.return_value.successful.return_value = False
+            async_result.return_value.result = "worker lost"
+            data = self.get_status()
+        self.assertEqual(data["status"], "FAILURE")
+        self.assertIsNone(get_cached_task(self.task.task_id))
+
+
+if __name__ == "__main__":
+    unittest.main()
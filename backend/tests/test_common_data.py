@@ -1,8 +1,24 @@
+import io
 import os
 import json
 import unittest
+from unittest import mock
 from loguru import logger
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+from app_dataforge.models import StoreEntry
+from app_dataforge.entry import get_entry_list
+from app_dataforge.embedding_index import EmbeddingIndexManager, EF_SEARCH_MIN, EF_SEARCH_MAX
+from backend.common.files import filecache
+from backend.common.parser import conversion_service
+from backend.common.parser.conversion_service import ConversionService
+from backend.common.parser.block import (
+    Block, BlockStreamWriter, get_block_list, BLOCK_ROOT, TYPE_HEADING_BASE,
+)
+from backend.common.parser import pdf_parser
+from backend.common.parser.pdf_parser import reset_toc_window, get_page_shards, iter_pdf_windows
 from .support import BaseTestCase
 
 
@@ -180,5 +196,203 @@ class EmbeddingTestCase(BaseTestCase):
         self.inner_regen_embedding(addrlist)
 
 
+class HybridSearchTestCase(TestCase):
+    def setUp(self):
+        self.user_id = "hybrid_user"
+        now = timezone.now()
+        rows = [
+            # addr, block_id, title, raw
+            ("notes/a.md", 0, "alpha guide", "alpha intro"),
+            ("notes/a.md", 1, "alpha guide", "alpha details"),
+            ("notes/b.md", 0, "other", "nothing here"),
+            ("notes/b.md", 1, "other", "more alpha"),
+            ("notes/c.md", 0, "unrelated", "unrelated"),
+        ]
+        for addr, block_id, title, raw in rows:
+            StoreEntry.objects.create(
+                user_id=self.user_id, etype="note", addr=addr, block_id=block_id,
+                title=title, raw=raw, created_time=now, updated_time=now,
+            )
+
+    def search(self):
+        return get_entry_list("alpha", {"user_id": self.user_id}, -1, method="keywordSearch")
+
+    def test_fused_ranking_and_dedup(self):
+        results = list(self.search())
+        # a.md matches the title and raw branches, b.md only the raw one, one row per addr
+        self.assertEqual([item["addr"] for item in results], ["notes/a.md", "notes/b.md"])
+        self.assertEqual(results[0]["block_id"], 0)
+
+    def test_pages_in_sql(self):
+        queryset = self.search()
+        self.assertEqual(queryset.count(), 2)
+        page = list(queryset[1:2])
+        self.assertEqual([item["addr"] for item in page], ["notes/b.md"])
+        self.assertEqual(queryset[5:10].count(), 0)
+
+    def test_fields(self):
+        results = list(get_entry_list(
+            "alpha", {"user_id": self.user_id}, 1, fields=["idx", "addr"], method="keywordSearch"
+        ))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(set(results[0].keys()), {"idx", "addr"})
+
+
+class EfSearchTestCase(TransactionTestCase):
+    """
+    outside a test transaction, so the end of search_scope really ends the settings
+    """
+
+    def get_setting(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT current_setting('hnsw.ef_search', true)")
+            return cursor.fetchone()[0]
+
+    def test_get_ef_search(self):
+        self.assertEqual(EmbeddingIndexManager.get_ef_search(5), EF_SEARCH_MIN)
+        self.assertEqual(EmbeddingIndexManager.get_ef_search(100), 200)
+        self.assertEqual(EmbeddingIndexManager.get_ef_search(10**6), EF_SEARCH_MAX)
+
+    def test_search_scope_is_local(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET hnsw.ef_search = 77")
+        try:
+            with EmbeddingIndexManager.search_scope(123):
+                self.assertEqual(self.get_setting(), "123")
+            self.assertEqual(self.get_setting(), "77")
+            with EmbeddingIndexManager.search_scope(None):
+                self.assertEqual(self.get_setting(), "77")
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("RESET hnsw.ef_search")
+
+
+class ConversionServiceTestCase(SimpleTestCase):
+    def setUp(self):
+        self.service = ConversionService.get_instance()
+        self.launcher = self.service.launcher
+        # a new source per test, the service returns the job of a source converted before
+        self.path_in = filecache.get_tmpfile(".html")
+        with open(self.path_in, "w") as fp:
+            fp.write("<html><body><h1>Title</h1><p>Some text of the page</p></body></html>")
+
+    def tearDown(self):
+        self.service.launcher = self.launcher
+
+    def test_daemon_uses_subprocess(self):
+        """
+        celery prefork workers are daemonic and can not fork the job process
+        """
+        with mock.patch.object(conversion_service.multiprocessing, "current_process") as current:
+            current.return_value.daemon = True
+            self.assertEqual(conversion_service.get_launcher(), conversion_service.LAUNCHER_SUBPROCESS)
+            current.return_value.daemon = False
+            self.assertEqual(conversion_service.get_launcher(), conversion_service.LAUNCHER_FORK)
+
+    def test_subprocess_convert(self):
+        self.service.launcher = conversion_service.LAUNCHER_SUBPROCESS
+        ret, path_out = self.service.convert(self.path_in)
+        self.assertTrue(ret)
+        self.assertTrue(os.path.exists(path_out))
+
+    def test_subprocess_timeout(self):
+        self.service.launcher = conversion_service.LAUNCHER_SUBPROCESS
+        job_id = self.service.submit(self.path_in, timeout=0)
+        ret, _path_out = self.service.wait(job_id)
+        self.assertFalse(ret)
+        self.assertEqual(self.service.poll(job_id)["status"], conversion_service.STATUS_TIMEOUT)
+
+    def test_subprocess_fallback(self):
+        """
+        a job process that can not start falls back to converting in the caller
+        """
+        self.service.launcher = conversion_service.LAUNCHER_SUBPROCESS
+        with mock.patch.object(conversion_service.subprocess, "Popen", side_effect=OSError("no fork")):
+            ret, path_out = self.service.convert(self.path_in)
+        self.assertTrue(ret)
+        self.assertTrue(os.path.exists(path_out))
+
+
+def fake_pdf_pages(path_in, start, end, **kwargs):
+    for pidx in range(start, end):
+        yield pidx, [f"page {pidx}"], False
+
+
+class PdfPageRangeTestCase(SimpleTestCase):
+    def test_page_shards(self):
+        self.assertEqual(get_page_shards(10, 4), [(0, 10)])
+        self.assertEqual(get_page_shards(64, 4), [(0, 16), (16, 32), (32, 48), (48, 64)])
+        self.assertEqual(get_page_shards(70, 4), [(0, 18), (18, 36), (36, 54), (54, 70)])
+        self.assertEqual(get_page_shards(100, 1), [(0, 100)])
+
+    @mock.patch.object(pdf_parser, "PDF_STREAM_WINDOW_PAGES", 8)
+    @mock.patch.object(pdf_parser, "iter_pdf_pages", fake_pdf_pages)
+    def test_windows_in_page_order(self):
+        expected = [(8, 0, 8), (16, 8, 16), (20, 16, 20)]
+        expected = [(end, [f"page {pidx}" for pidx in range(start, stop)]) for end, start, stop in expected]
+        with mock.patch.object(pdf_parser, "can_parse_parallel", return_value=False):
+            self.assertEqual(list(iter_pdf_windows("doc.pdf", 20, workers=4)), expected)
+        # the process pool failing to start falls back to parsing serially
+        with mock.patch.object(pdf_parser, "can_parse_parallel", return_value=True), \
+                mock.patch.object(pdf_parser, "ProcessPoolExecutor", side_effect=OSError("no fork")):
+            self.assertEqual(list(iter_pdf_windows("doc.pdf", 20, workers=4)), expected)
+
+
+class PdfStreamTestCase(SimpleTestCase):
+    @staticmethod
+    def get_root():
+        return Block({"text": BLOCK_ROOT, "type": TYPE_HEADING_BASE, "level": 0})
+
+    @staticmethod
+    def get_blocks():
+        blocks = []
+        for chapter in range(1, 4):
+            blocks.append(Block({"type": TYPE_HEADING_BASE, "text": f"Chapter {chapter}", "level": 1}))
+            for section in range(1, 3):
+                blocks.append(Block({"type": TYPE_HEADING_BASE, "text": f"Section {chapter}.{section}", "level": 2}))
+                blocks.append(Block({"text": f"text of section {chapter}.{section}", "auto_detect": False}))
+        return blocks
+
+    @staticmethod
+    def get_lines(text):
+        return [line for line in text.splitlines() if line.strip() != ""]
+
+    def test_stream_writer(self):
+        root_block = self.get_root()
+        for block in self.get_blocks():
+            root_block.add(block)
+        expected = self.get_lines(root_block.to_md())
+
+        fp = io.StringIO()
+        writer = BlockStreamWriter(fp, self.get_root())
+        blocks = self.get_blocks()
+        for start in range(0, len(blocks), 4):  # windows of a few pages
+            for block in blocks[start:start + 4]:
+                writer.add(block)
+            writer.flush()
+            # only the current heading path stays in memory
+            self.assertLessEqual(len(get_block_list(writer.root_block)), 4)
+        writer.close()
+        self.assertEqual(self.get_lines(fp.getvalue()), expected)
+
+    def test_toc_window(self):
+        toc_items = [
+            {"title": "Introduction", "level": 0},
+            {"title": "Appendix Z", "level": 0},  # not in the document
+            {"title": "Methods", "level": 0},
+            {"title": "Results", "level": 0},
+        ]
+        texts = ["Introduction", "the first words of the text", "Methods",
+                 "more words follow here", "Results", "final data table"]
+        blocks = [Block({"text": text, "auto_detect": False}) for text in texts]
+        toc_idx = reset_toc_window(blocks[:4], toc_items, 0)
+        # the missing item is skipped, Results waits for the next window
+        self.assertEqual(toc_idx, 3)
+        self.assertEqual(reset_toc_window(blocks[4:], toc_items, toc_idx), 4)
+        headings = [block.text for block in blocks if block.type == TYPE_HEADING_BASE]
+        self.assertEqual(headings, ["Introduction", "Methods", "Results"])
+        self.assertEqual(blocks[0].level, 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,20 @@
+import time
+import asyncio
+import datetime
+import threading
 import unittest
+from unittest import mock
 from .support import BaseTestCase
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from backend.common.llm import embedding_service
+from backend.common.llm.embedding_service import EmbeddingBatcher
+from backend.common.llm import llm_client
+from backend.common.llm.llm_client import LLMClient, LLMClientRegistry
+from backend.common.llm.llm_cache import LLMCache
+from backend.common.llm.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_TTL_DAYS
+from backend.common.llm.models import StoreLLMCache, StoreEmbeddingCache
+from app_message.chat_tools import ChatEngine
 from backend.common.llm import llm_hub
 from backend.common.llm import llm_tools
 from loguru import logger
@@ -38,6 +52,244 @@ class LLMTestCase(BaseTestCase):
         self.assertEqual(info.find("王小明") != -1, True)
 
 
+class FakeEmbeddingModel:
+    def __init__(self):
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+
+class EmbeddingBatcherTestCase(SimpleTestCase):
+    def setUp(self):
+        self.model = FakeEmbeddingModel()
+        self.batcher = EmbeddingBatcher("test", self.model)
+
+    def tearDown(self):
+        self.batcher.shutdown()
+
+    @mock.patch.object(embedding_service, "EMBEDDING_MAX_WAIT", 0.5)
+    def test_batches_queued_texts(self):
+        futures = self.batcher.submit(["a", "bb", "a"])
+        self.assertEqual([future.result(5) for future in futures], [[1.0], [2.0], [1.0]])
+        # identical texts share one request
+        self.assertEqual(self.model.batches, [["a", "bb"]])
+
+    @mock.patch.object(embedding_service, "EMBEDDING_MAX_WAIT", 5)
+    def test_flush_does_not_wait(self):
+        start = time.time()
+        futures = self.batcher.submit(["query"], flush=True)
+        self.assertEqual(futures[0].result(5), [5.0])
+        self.assertLess(time.time() - start, 1)
+
+
+class EmbeddingCacheTestCase(TestCase):
+    def setUp(self):
+        self.embedding_cache = EmbeddingCache.get_instance()
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        with self.embedding_cache.lock:
+            self.embedding_cache.memory.clear()
+
+    def test_get_many(self):
+        self.embedding_cache.put_many("test-emb", ["a", "b", "c"], [[1.0, 0.0], None, [0.0, 1.0]])
+        self.assertEqual(StoreEmbeddingCache.objects.filter(emb_model="test-emb").count(), 2)
+        texts = ["c", "b", "a", "c"]
+        self.assertEqual(self.embedding_cache.get_many("test-emb", texts),
+                         {0: [0.0, 1.0], 2: [1.0, 0.0], 3: [0.0, 1.0]})
+        self.forget()
+        self.assertEqual(self.embedding_cache.get_many("test-emb", texts),
+                         {0: [0.0, 1.0], 2: [1.0, 0.0], 3: [0.0, 1.0]})
+        # the key includes the model
+        self.assertEqual(self.embedding_cache.get_many("other-emb", texts), {})
+        self.assertEqual(self.embedding_cache.get_many(None, texts), {})
+
+    def test_put_existing(self):
+        self.embedding_cache.put_many("test-emb", ["a", "a"], [[1.0], [1.0]])
+        self.embedding_cache.put_many("test-emb", ["a"], [[1.0]])
+        self.assertEqual(StoreEmbeddingCache.objects.filter(emb_model="test-emb").count(), 1)
+
+    def test_clear_expired(self):
+        self.embedding_cache.put_many("test-emb", ["old", "new"], [[1.0], [2.0]])
+        StoreEmbeddingCache.objects.filter(emb_model="test-emb").update(
+            accessed_time=timezone.now() - datetime.timedelta(days=EMBEDDING_CACHE_TTL_DAYS + 1)
+        )
+        # a hit refreshes the access time of the row
+        self.forget()
+        self.assertEqual(self.embedding_cache.get_many("test-emb", ["new"]), {0: [2.0]})
+        self.embedding_cache.clear()
+        self.assertEqual(self.embedding_cache.get_many("test-emb", ["old", "new"]), {1: [2.0]})
+
+
+class FakeStream:
+    def __init__(self, pieces):
+        self.pieces = pieces
+        self.closed = False
+
+    def __iter__(self):
+        for piece in self.pieces:
+            yield mock.Mock(choices=[mock.Mock(delta=mock.Mock(content=piece))])
+
+    def close(self):
+        self.closed = True
+
+
+class LLMClientRegistryTestCase(SimpleTestCase):
+    url = "http://localhost:2"
+
+    def setUp(self):
+        self.registry = LLMClientRegistry.get_instance()
+        self.addCleanup(self.forget)
+
+    def forget(self):
+        with self.registry.lock:
+            for key in [key for key in self.registry.clients if self.url in key]:
+                self.registry.clients.pop(key).close()
+
+    def test_reuse(self):
+        first = self.registry.get_client("openai", self.url, "sk-a", "model-a")
+        # the models of one endpoint share the client and its connection pool
+        self.assertIs(self.registry.get_client("openai", self.url, "sk-a", "model-b"), first)
+        self.assertIsNot(self.registry.get_client("openai", self.url, "sk-b", "model-a"), first)
+
+    def test_idle_client_closed(self):
+        first = self.registry.get_client("openai", self.url, "sk-a", "model-a")
+        first.last_used -= llm_client.LLM_CLIENT_IDLE_SECONDS + 1
+        with mock.patch.object(first, "close") as close:
+            second = self.registry.get_client("openai", self.url, "sk-a", "model-a")
+        self.assertIsNot(second, first)
+        close.assert_called_once()
+
+    def test_busy_client_kept(self):
+        first = self.registry.get_client("openai", self.url, "sk-a", "model-a")
+        with first.slot():
+            first.last_used -= llm_client.LLM_CLIENT_IDLE_SECONDS + 1
+            self.assertIs(self.registry.get_client("openai", self.url, "sk-a", "model-a"), first)
+
+    @mock.patch.object(llm_client, "LLM_MAX_CONCURRENCY", 1)
+    def test_slot_limit(self):
+        client = self.registry.get_client("openai", self.url, "sk-limit", "model-a")
+        acquired = threading.Event()
+
+        def query():
+            with client.slot():
+                acquired.set()
+
+        with client.slot():
+            thread = threading.Thread(target=query)
+            thread.start()
+            # the second request waits for the slot
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(client.in_use, 0)
+
+    def test_run(self):
+        async def answer():
+            return asyncio.get_running_loop()
+
+        loop = self.registry.run(answer())
+        self.assertIs(self.registry.run(answer()), loop)
+
+
+class StreamSlotTestCase(SimpleTestCase):
+    def setUp(self):
+        self.llm_client = LLMClient("test", "openai", "http://localhost:1", "sk-test", "test-model")
+        self.llm_client.client = mock.Mock()
+        self.stream = FakeStream(["hello", " world"])
+        self.llm_client.client.chat.completions.create.return_value = self.stream
+        llm_info = mock.Mock(api_method="openai", model_name="test-model")
+        with mock.patch("app_message.chat_tools.LLMClientRegistry") as registry:
+            registry.get_instance.return_value.get.return_value = self.llm_client
+            self.engine = ChatEngine(llm_info, sdata=None)
+
+    def tearDown(self):
+        self.llm_client.close()
+
+    def test_stream_keeps_request_slots_free(self):
+        pieces = self.engine.stream_response([{"role": "user", "content": "hi"}])
+        self.assertEqual(next(pieces), "hello")
+        self.assertEqual(self.llm_client.in_use, 1)
+        # the other requests of this client still get a slot while the stream is read
+        self.assertTrue(self.llm_client.semaphore.acquire(blocking=False))
+        self.llm_client.semaphore.release()
+        self.assertEqual("".join(pieces), " world")
+        self.assertEqual(self.llm_client.in_use, 0)
+        self.assertTrue(self.stream.closed)
+        self.assertGreater(self.engine.token_count, 0)
+
+    def test_closed_stream_releases_its_slot(self):
+        pieces = self.engine.stream_response([{"role": "user", "content": "hi"}])
+        next(pieces)
+        pieces.close()  # the client went away
+        self.assertEqual(self.llm_client.in_use, 0)
+        self.assertTrue(self.stream.closed)
+
+
+class LLMQueryAsyncTestCase(SimpleTestCase):
+    @mock.patch("backend.common.llm.llm_hub.close_old_connections")
+    def test_db_helpers_drop_old_connections(self, close_old_connections):
+        prepare = mock.Mock(return_value=(None, None, "limit reached"))
+        with mock.patch("backend.common.llm.llm_hub._prepare_query", prepare):
+            ret, desc, _dic = asyncio.run(llm_hub.llm_query_async("testuser", "", "hi", "test"))
+        self.assertEqual((ret, desc), (False, "limit reached"))
+        prepare.assert_called_once()
+        # before and after the helper on the executor thread
+        self.assertEqual(close_old_connections.call_count, 2)
+
+
+class LLMCacheTestCase(TestCase):
+    def setUp(self):
+        self.llm_cache = LLMCache.get_instance()
+        self.llm_info = mock.Mock()
+        self.llm_info.get_desc.return_value = "test-model"
+
+    def tearDown(self):
+        with self.llm_cache.lock:
+            for key in [key for key in self.llm_cache.memory if key[0] in ("cache_a", "cache_b")]:
+                del self.llm_cache.memory[key]
+
+    def forget(self):
+        """
+        drop the in-process copies, the next get reads the table
+        """
+        self.tearDown()
+
+    def test_scoped_by_user(self):
+        self.llm_cache.put("cache_a", "test-model", "role", "what  is\nit", "test", "answer a", 10)
+        self.assertEqual(self.llm_cache.get("cache_a", "test-model", "role", "what is it", "test"), ("answer a", 10))
+        self.assertIsNone(self.llm_cache.get("cache_b", "test-model", "role", "what is it", "test"))
+        self.forget()
+        self.assertEqual(self.llm_cache.get("cache_a", "test-model", "role", "what is it", "test"), ("answer a", 10))
+        self.assertIsNone(self.llm_cache.get("cache_b", "test-model", "role", "what is it", "test"))
+        # another model or app is another prompt
+        self.assertIsNone(self.llm_cache.get("cache_a", "other-model", "role", "what is it", "test"))
+        self.assertIsNone(self.llm_cache.get("cache_a", "test-model", "role", "what is it", "other"))
+
+    def test_validate(self):
+        llm_hub.put_cached_answer("cache_a", self.llm_info, "role", "q", "test", "not json", 5,
+                                  validate=llm_hub.is_json_answer)
+        self.assertFalse(StoreLLMCache.objects.filter(user_id="cache_a").exists())
+        llm_hub.put_cached_answer("cache_a", self.llm_info, "role", "q", "test", '{"a": 1}', 5,
+                                  validate=llm_hub.is_json_answer)
+        user = mock.Mock(user_id="cache_a")
+        answer, dic = llm_hub.get_cached_answer(user, self.llm_info, "role", "q", "test",
+                                                validate=llm_hub.is_json_answer)
+        self.assertEqual(answer, '{"a": 1}')
+        self.assertTrue(dic["cached"])
+
+    def test_rejected_answer_is_dropped(self):
+        # cached before the caller validated its answers
+        self.llm_cache.put("cache_a", "test-model", "role", "q", "test", "not json", 5)
+        user = mock.Mock(user_id="cache_a")
+        self.assertIsNone(llm_hub.get_cached_answer(user, self.llm_info, "role", "q", "test",
+                                                    validate=llm_hub.is_json_answer))
+        self.assertFalse(StoreLLMCache.objects.filter(user_id="cache_a").exists())
+        self.assertIsNone(self.llm_cache.get("cache_a", "test-model", "role", "q", "test"))
+
+
 class AllLLMTestCase(TestCase):
     def __init__(self, methodName: str = "runTest") -> None:
         self.user_id = "testuser"
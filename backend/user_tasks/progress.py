@@ -0,0 +1,123 @@
+"""
+Progress reporter of a UserTask
+
+Progress updates are kept in memory and written with one UPDATE once
+PROGRESS_FLUSH_INTERVAL seconds passed or the progress grew by PROGRESS_FLUSH_STEP.
+Every write is published to the cache as well, in the shape of UserTaskSerializer,
+task_status reads running tasks from there while their progress is fresh.
+
+    reporter = ProgressReporter(task_id, user_id, "move_task")
+    real_move(..., progress_callback=reporter, task_id=task_id)
+    reporter.finish("SUCCESS", {"success_list": success_list})
+"""
+
+import os
+import time
+import threading
+from datetime import datetime
+from loguru import logger
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import UserTask
+
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", 2.0))
+PROGRESS_FLUSH_STEP = 10  # percent
+PROGRESS_CACHE_TIMEOUT = 24 * 3600
+PROGRESS_STALE_SECONDS = int(os.getenv("PROGRESS_STALE_SECONDS", 30))  # older progress is checked against celery
+FINISHED_STATUS = ["SUCCESS", "FAILURE", "REVOKED"]
+
+
+def get_task_cache_key(task_id):
+    return f"user_task_{task_id}"
+
+
+def get_cached_task(task_id):
+    return cache.get(get_task_cache_key(task_id))
+
+
+def is_live_task(payload, now=None):
+    """
+    A cached task is served while it runs and was updated recently,
+    finished or silent tasks are read from the db and reconciled with celery
+    """
+    if payload is None or payload.get("status") in FINISHED_STATUS or "idx" not in payload:
+        return False
+    try:
+        updated_time = datetime.fromisoformat(payload["updated_time"])
+    except (KeyError, TypeError, ValueError):
+        return False
+    now = now or timezone.now()
+    return (now - updated_time).total_seconds() < PROGRESS_STALE_SECONDS
+
+
+class ProgressReporter:
+    def __init__(self, task_id, user_id=None, task_name=None, publish=True):
+        self.task_id = task_id
+        self.publish = publish
+        self.lock = threading.Lock()
+        self.progress = 0
+        self.flushed_progress = 0
+        self.flushed_time = time.time()
+        self.payload = {
+            "task_id": task_id,
+            "user_id": user_id,
+            "task_name": task_name,
+            "status": "PENDING",
+            "progress": 0,
+        }
+
+    def __call__(self, progress, task_id=None):
+        """
+        Same signature as the progress_callback of the file tools
+        """
+        with self.lock:
+            self.progress = progress
+            if (
+                progress >= 100
+                or progress - self.flushed_progress >= PROGRESS_FLUSH_STEP
+                or time.time() - self.flushed_time >= PROGRESS_FLUSH_INTERVAL
+            ):
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.progress != self.flushed_progress:
+                self._flush()
+
+    def _flush(self, **fields):
+        fields["progress"] = self.progress
+        try:
+            UserTask.objects.filter(task_id=self.task_id).update(
+                updated_time=timezone.now(), **fields
+            )
+        except Exception as e:
+            logger.warning(f"update task {self.task_id} progress failed {e}")
+        self.flushed_progress = self.progress
+        self.flushed_time = time.time()
+        self._publish(fields)
+
+    def _publish(self, fields):
+        if not self.publish:
+            return
+        if "idx" not in self.payload:
+            # the serializer fields only the row knows, read once
+            row = UserTask.objects.filter(task_id=self.task_id).values("idx", "created_time").first()
+            if row is not None:
+                self.payload["idx"] = str(row["idx"])
+                self.payload["created_time"] = row["created_time"].isoformat()
+        self.payload.update(fields)
+        self.payload["updated_time"] = timezone.now().isoformat()
+        try:
+            cache.set(get_task_cache_key(self.task_id), self.payload, PROGRESS_CACHE_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"publish task {self.task_id} progress failed {e}")
+
+    def finish(self, status, result=None):
+        """
+        Write the final status together with the pending progress
+        """
+        with self.lock:
+            if status == "SUCCESS":
+                self.progress = 100
+            self._flush(status=status, result=result)
@@ -6,11 +6,13 @@ from rest_framework.permissions import IsAuthenticated
 from knox.auth import TokenAuthentication
 from celery.result import AsyncResult
 from celery.app.control import Control
+from django.core.cache import cache
 
 from backend.common.user.utils import get_user_id
 from backend.settings import USE_CELERY
 from .models import UserTask
 from .serializers import UserTaskSerializer
+from .progress import get_cached_task, get_task_cache_key, is_live_task, FINISHED_STATUS
 
 class CustomPagination(PageNumberPagination):
     page_size = 10
@@ -43,6 +45,10 @@ class UserTaskViewSet(viewsets.ModelViewSet):
     def task_status(self, request, pk=None):
         try:
             user_id = get_user_id(request)
+            # running tasks publish their progress to the cache, polling does not touch the db
+            cached = get_cached_task(pk)
+            if is_live_task(cached) and cached.get("user_id") == user_id:
+                return Response({key: cached.get(key) for key in UserTaskSerializer.Meta.fields})
             task = UserTask.objects.get(task_id=pk, user_id=user_id)
             celery_result = AsyncResult(task.task_id)
             
@@ -51,6 +57,8 @@ class UserTaskViewSet(viewsets.ModelViewSet):
                 if celery_result.ready():
                     task.result = celery_result.result if celery_result.successful() else {'error': str(celery_result.result)}
                 task.save()
+            if task.status in FINISHED_STATUS:
+                cache.delete(get_task_cache_key(task.task_id))
                 
             return Response(self.serializer_class(task).data)
         except UserTask.DoesNotExist:
@@ -68,6 +76,7 @@ class UserTaskViewSet(viewsets.ModelViewSet):
             Control(app).revoke(task.task_id, terminate=True)
             task.status = 'REVOKED'
             task.save()
+            cache.delete(get_task_cache_key(task.task_id))
             return Response({'message': 'Task terminated successfully'})
         except UserTask.DoesNotExist:
             return Response(
@@ -86,6 +95,7 @@ class UserTaskViewSet(viewsets.ModelViewSet):
             user_id = get_user_id(request)
             task = UserTask.objects.get(task_id=pk, user_id=user_id)
             task.delete()
+            cache.delete(get_task_cache_key(pk))
             return Response({'message': 'Task deleted successfully'})
         except UserTask.DoesNotExist:
             return Response(